@@ -0,0 +1,79 @@
+"""
+Benchmark how `drop_hist_false_duplicates` scales with the size of the matched data.
+
+A synthetic archive is built where every future experiment of an ensemble member shares
+the same historical windows, like the CMIP6 archive does, so that loose tolerances produce
+many false historical duplicates. Run with `python benchmarks/bench_drop_hist_false_duplicates.py`.
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+
+from stitches.fx_match import drop_hist_false_duplicates, match_neighborhood
+
+EXPERIMENTS = ["ssp126", "ssp245", "ssp370", "ssp585"]
+
+
+def make_archive(n_ensembles: int, seed: int = 0):
+    """
+    Make a synthetic matching archive.
+
+    :param n_ensembles: The number of ensemble members per experiment.
+    :type n_ensembles: int
+    :param seed: The seed of the random number generator.
+    :type seed: int
+    :return: A data frame in the matching archive format.
+    """
+    rng = np.random.default_rng(seed)
+    start_yr = np.arange(1850, 2100, 9)
+    end_yr = np.minimum(start_yr + 8, 2100)
+    hist = (start_yr + 4) <= 2010
+    dat = []
+    for ens in range(n_ensembles):
+        hist_fx = np.cumsum(rng.normal(0.02, 0.05, hist.sum()))
+        hist_dx = rng.normal(0.005, 0.01, hist.sum())
+        for exp in EXPERIMENTS:
+            fx = np.concatenate(
+                [hist_fx, hist_fx[-1] + np.cumsum(rng.normal(0.2, 0.1, (~hist).sum()))]
+            )
+            dx = np.concatenate([hist_dx, rng.normal(0.03, 0.01, (~hist).sum())])
+            dat.append(
+                pd.DataFrame(
+                    {
+                        "experiment": exp,
+                        "variable": "tas",
+                        "ensemble": f"r{ens + 1}i1p1f1",
+                        "model": "bench_model",
+                        "start_yr": start_yr,
+                        "end_yr": end_yr,
+                        "year": start_yr + 4,
+                        "fx": fx,
+                        "dx": dx,
+                    }
+                )
+            )
+    return pd.concat(dat).reset_index(drop=True)
+
+
+def main():
+    """Time drop_hist_false_duplicates on increasingly large matched data frames."""
+    target = make_archive(1, seed=42)
+    target = target.loc[target["experiment"] == "ssp245"].reset_index(drop=True)
+
+    print(f"{'ensembles':>10} {'tol':>6} {'match rows':>12} {'seconds':>10}")
+    for n_ensembles in [5, 20, 50]:
+        archive = make_archive(n_ensembles)
+        for tol in [0.05, 0.1, 0.2]:
+            matched = match_neighborhood(
+                target, archive, tol=tol, drop_hist_duplicates=False
+            )
+            start = time.perf_counter()
+            drop_hist_false_duplicates(matched)
+            seconds = time.perf_counter() - start
+            print(f"{n_ensembles:>10} {tol:>6} {len(matched):>12} {seconds:>10.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,9 +7,22 @@ into a single, coherent dataset.
 
 
 from ._version import __version__
-from .fx_match import match_neighborhood
+from .fx_cache import MatchCache
+from .fx_catalog import PangeoCatalog, pangeo_catalog
+from .fx_compact import Recipe
+from .fx_index import ArchiveIndex
+from .fx_match import far_neighbors, match_neighborhood, match_topk, update_matches
 from .fx_pangeo import fetch_nc, fetch_pangeo_table
-from .fx_recipe import generate_gridded_recipe, make_recipe, permute_stitching_recipes
+from .fx_recipe import (
+    assign_stitching_recipes,
+    generate_gridded_recipe,
+    iter_recipes,
+    make_recipe,
+    make_recipes_batch,
+    max_disjoint_recipes,
+    permute_stitching_recipes,
+    tolerance_sweep,
+)
 from .fx_stitch import gmat_stitching, gridded_stitching
 from .generate_package_data import generate_pkg_data
 from .install_pkgdata import install_package_data
@@ -19,12 +32,25 @@ from .make_tas_archive import make_tas_archive
 from .package_data import fetch_quickstarter_data
 
 __all__ = [
+    "ArchiveIndex",
+    "MatchCache",
+    "Recipe",
+    "PangeoCatalog",
+    "pangeo_catalog",
     "match_neighborhood",
+    "far_neighbors",
+    "match_topk",
     "fetch_nc",
     "fetch_pangeo_table",
     "generate_gridded_recipe",
     "make_recipe",
+    "iter_recipes",
+    "make_recipes_batch",
     "permute_stitching_recipes",
+    "assign_stitching_recipes",
+    "max_disjoint_recipes",
+    "tolerance_sweep",
+    "update_matches",
     "gmat_stitching",
     "gridded_stitching",
     "generate_pkg_data",
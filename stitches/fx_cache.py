@@ -0,0 +1,245 @@
+"""
+The `fx_cache` module holds the `MatchCache`, a cache of `match_neighborhood` results.
+
+Iterative workflows often make recipes from the same target and archive data many times, with only
+a different N_matches or seed. The matches of those calls are the same, so a `MatchCache` passed to
+`make_recipe`, `iter_recipes` or `make_recipes_batch` keeps them, keyed by a hash of the content of
+the target data, the archive data (or the fingerprint of its ArchiveIndex) and the matching
+arguments, and the recipes are drawn from the cached matches. The cache keeps a bounded number of
+match results in memory, evicting the least recently used ones, and can also keep them on disk so
+that they are shared between processes and sessions.
+"""
+
+import hashlib
+import os
+import pickle
+import re
+import tempfile
+from collections import OrderedDict
+
+import stitches.fx_util as util
+from stitches.fx_index import ArchiveIndex, metric_matrix
+from stitches.fx_match import TARGET_COLUMNS, match_neighborhood
+
+# The names of the files of the cached matches, the cache never touches other files.
+CACHE_FILE_PREFIX = "matchcache-"
+CACHE_FILE_PATTERN = re.compile(r"^matchcache-[0-9a-f]{64}\.pkl$")
+
+
+class MatchCache:
+    """
+    A least recently used cache of match_neighborhood results.
+
+    :param max_entries: The number of match results kept, the least recently used ones are
+                        evicted when there are more. Defaults to 16.
+    :type max_entries: int
+    :param path: Optional existing directory to also keep the match results in, so that they
+                 are shared with other processes and sessions using it. It keeps max_entries
+                 results as well, in matchcache-<key>.pkl files, and only ever removes
+                 those files. Defaults to None, keeping them in memory only.
+    :type path: str
+    """
+
+    def __init__(self, max_entries: int = 16, path: str = None):
+        """
+        Build an empty cache.
+
+        :param max_entries: The number of match results kept.
+        :param path: Optional directory to keep the match results in on disk.
+        """
+        if not (type(max_entries) is int and max_entries >= 1):
+            raise TypeError("max_entries: must be a positive integer")
+        if path is not None and not os.path.isdir(path):
+            raise TypeError("path: the cache directory does not exist.")
+
+        self.max_entries = max_entries
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        """Return the number of match results kept in memory."""
+        return len(self.entries)
+
+    def key(
+        self, target_data, archive_data, tol=0, drop_hist_duplicates=True, metric=None
+    ):
+        """
+        Return the key of the matches of the target and archive data.
+
+        :param target_data: Data frame of the target fx and dx values.
+        :param archive_data: Data frame of the archive fx and dx values or an ArchiveIndex.
+        :param tol: Tolerance for the neighborhood of matching.
+        :param drop_hist_duplicates: Whether the false historical duplicates are dropped.
+        :param metric: The distance metric used for matching, see match_neighborhood.
+        :return: The hexadecimal SHA-256 digest identifying the matches.
+        """
+        if isinstance(archive_data, ArchiveIndex):
+            archive_key = archive_data.fingerprint
+        else:
+            archive_key = util.hash_frame(
+                archive_data.reset_index(drop=True), ArchiveIndex.WINDOW_COLUMNS
+            )
+
+        if metric is None:
+            metric_key = "None"
+        elif isinstance(metric, dict):
+            metric_key = ",".join(
+                f"{experiment}:{metric_matrix(value).tobytes().hex()}"
+                for experiment, value in sorted(metric.items())
+            )
+        else:
+            metric_key = metric_matrix(metric).tobytes().hex()
+
+        parts = [
+            util.hash_frame(target_data, TARGET_COLUMNS),
+            archive_key,
+            repr(tol),
+            repr(bool(drop_hist_duplicates)),
+            metric_key,
+        ]
+        return hashlib.sha256("|".join(parts).encode()).hexdigest()
+
+    def match(
+        self,
+        target_data,
+        archive_data,
+        tol=0,
+        drop_hist_duplicates=True,
+        metric=None,
+        **kwargs,
+    ):
+        """
+        Match the target and archive data, reusing the cached matches when there are some.
+
+        :param target_data: Data frame of the target fx and dx values.
+        :param archive_data: Data frame of the archive fx and dx values or an ArchiveIndex.
+        :param tol: Tolerance for the neighborhood of matching.
+        :param drop_hist_duplicates: Whether the false historical duplicates are dropped.
+        :param metric: The distance metric used for matching, see match_neighborhood.
+        :param kwargs: The other arguments of match_neighborhood (method, max_memory and
+                       n_workers), they do not change the matches and are not part of the key.
+        :return: Data frame with the target data and the corresponding matched archive data.
+        """
+        key = self.key(target_data, archive_data, tol, drop_hist_duplicates, metric)
+        out = self.get(key)
+        if out is None:
+            self.misses += 1
+            out = match_neighborhood(
+                target_data,
+                archive_data,
+                tol=tol,
+                drop_hist_duplicates=drop_hist_duplicates,
+                metric=metric,
+                **kwargs,
+            )
+            self.put(key, out)
+        else:
+            self.hits += 1
+        return out.copy()
+
+    def get(self, key: str):
+        """
+        Return the cached matches of a key.
+
+        :param key: The key of the matches, see `MatchCache.key`.
+        :type key: str
+        :return: The data frame of the matches, or None when they are not cached.
+        """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if self.path is None:
+            return None
+
+        file = self.cache_file(key)
+        try:
+            with open(file, "rb") as f:
+                out = pickle.load(f)
+            os.utime(file)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            return None
+        self.remember(key, out)
+        return out
+
+    def put(self, key: str, matches):
+        """
+        Cache the matches of a key.
+
+        :param key: The key of the matches, see `MatchCache.key`.
+        :type key: str
+        :param matches: The data frame of the matches.
+        """
+        matches = matches.copy()
+        self.remember(key, matches)
+        if self.path is None:
+            return
+
+        # Write to a temporary file first so that other processes never read part of it.
+        fd, tmp = tempfile.mkstemp(
+            dir=self.path, prefix=CACHE_FILE_PREFIX, suffix=".tmp"
+        )
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(matches, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.cache_file(key))
+
+        files = self.cache_files()
+        files.sort(key=os.path.getmtime)
+        for file in files[: max(len(files) - self.max_entries, 0)]:
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                # Another process using the directory evicted it first.
+                continue
+            self.evictions += 1
+
+    def clear(self):
+        """Remove all of the cached matches, from disk as well, and reset the counters."""
+        self.entries.clear()
+        if self.path is not None:
+            for file in self.cache_files():
+                try:
+                    os.remove(file)
+                except FileNotFoundError:
+                    continue
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        """
+        Return the counters of the cache.
+
+        :return: A dictionary of the number of hits, misses, evictions (from memory and
+                 from disk) and of the match results kept in memory.
+        """
+        out = {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+        }
+        return out
+
+    def cache_file(self, key):
+        """Return the path of the file of the matches of a key in the cache directory."""
+        return os.path.join(self.path, CACHE_FILE_PREFIX + key + ".pkl")
+
+    def cache_files(self):
+        """Return the paths of the files of the cached matches in the cache directory."""
+        out = [
+            os.path.join(self.path, file)
+            for file in os.listdir(self.path)
+            if CACHE_FILE_PATTERN.match(file)
+        ]
+        return out
+
+    def remember(self, key, matches):
+        """Keep matches in memory, evicting the least recently used ones when there are too many."""
+        self.entries[key] = matches
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
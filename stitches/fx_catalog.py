@@ -0,0 +1,255 @@
+"""
+The `fx_catalog` module holds the `PangeoCatalog`, an indexed copy of the package Pangeo table.
+
+Reading and filtering the Pangeo table of the package data is the same work for every recipe, so
+the catalog is loaded once per process by `pangeo_catalog` and shared by the recipe functions. The
+catalog keeps the table with categorical columns sorted by its key columns, so looking up the files
+of a (model, experiment, ensemble, variable, domain) does not scan the table, and it remembers the
+variable coverage tables make_recipe asks for. A binary copy of the catalog can also be kept in
+a cache directory so that new processes can skip parsing the CSV file.
+"""
+
+import functools
+import hashlib
+import os
+import pickle
+import tempfile
+from importlib import resources
+
+import pandas as pd
+
+import stitches.fx_util as util
+
+# The prefix of the names of the binary copies of the catalog in a cache directory.
+CATALOG_FILE_PREFIX = "pangeo-catalog-"
+
+
+class PangeoCatalog:
+    """
+    An indexed copy of the Pangeo table of the package data.
+
+    :param pangeo_table: A data frame of the Pangeo files, such as the table written by
+                         `make_pangeo_table`.
+    :type pangeo_table: pd.DataFrame
+    """
+
+    # Increment when the attributes of the catalog change so that stale files are not loaded.
+    FORMAT_VERSION = 1
+
+    # The columns a file is looked up by, in the order of the index.
+    KEY_COLUMNS = ["model", "experiment", "ensemble", "variable", "domain"]
+
+    def __init__(self, pangeo_table):
+        """
+        Build the catalog from the Pangeo table.
+
+        :param pangeo_table: A data frame of the Pangeo files.
+        """
+        util.check_columns(pangeo_table, set(PangeoCatalog.KEY_COLUMNS + ["zstore"]))
+
+        self.format_version = PangeoCatalog.FORMAT_VERSION
+        table = pangeo_table.astype(
+            {col: "category" for col in PangeoCatalog.KEY_COLUMNS}
+        )
+        self.table = table.sort_values(
+            PangeoCatalog.KEY_COLUMNS, kind="stable"
+        ).reset_index(drop=True)
+        self.index = pd.MultiIndex.from_frame(self.table[PangeoCatalog.KEY_COLUMNS])
+        self.values = {
+            col: set(self.table[col].cat.categories)
+            for col in PangeoCatalog.KEY_COLUMNS
+        }
+        self.variables = self.values["variable"]
+        self.source = None
+        self._coverage = {}
+
+    def lookup(
+        self,
+        model=None,
+        experiment=None,
+        ensemble=None,
+        variable=None,
+        domain=None,
+    ):
+        """
+        Look up the files of the catalog.
+
+        Every argument is a single value or a list of values to select, None selects all
+        of the values of a column.
+
+        :param model: The model(s).
+        :param experiment: The experiment(s).
+        :param ensemble: The ensemble member(s).
+        :param variable: The variable(s).
+        :param domain: The domain(s), the Pangeo table_id.
+        :return: A data frame of the rows of the Pangeo table that match.
+        """
+        # Select the values the catalog has, without any of them there are no rows.
+        keys = []
+        for col, key in zip(
+            PangeoCatalog.KEY_COLUMNS, [model, experiment, ensemble, variable, domain]
+        ):
+            if key is None:
+                keys.append(slice(None))
+                continue
+            values = [key] if isinstance(key, str) else list(key)
+            values = [value for value in values if value in self.values[col]]
+            if len(values) == 0:
+                keys = None
+                break
+            keys.append(values)
+
+        rows = [] if keys is None else self.index.get_locs(keys)
+        out = self.table.take(rows).reset_index(drop=True)
+
+        # Return the key columns with the values of the table.
+        out = out.astype(
+            {
+                col: self.table[col].cat.categories.dtype
+                for col in PangeoCatalog.KEY_COLUMNS
+            }
+        )
+        return out
+
+    def coverage(self, res: str, variables):
+        """
+        Return the files of the model, ensemble and experiment with all of the variables.
+
+        The table of a (res, variables) pair is built once and kept by the catalog.
+
+        :param res: The resolution, every domain containing it is used, e.g. 'mon'.
+        :type res: str
+        :param variables: List of the variables that must be covered.
+        :return: A data frame with a row for every model, ensemble and experiment that has
+                 all of the variables, outside of AerChemMIP, and a <variable>_file column
+                 with the zstore of every variable.
+        """
+        key = (res, tuple(sorted(set(variables))))
+        if key not in self._coverage:
+            domains = [domain for domain in self.values["domain"] if res in domain]
+            pt_subset = self.lookup(variable=list(key[1]), domain=domains)
+            pt_subset = pt_subset.loc[~pt_subset["zstore"].str.contains("AerChemMIP")][
+                ["model", "ensemble", "experiment", "variable", "zstore"]
+            ]
+
+            # Format the variable column to the "file" so that we can
+            pt_subset["variable"] = pt_subset["variable"] + "_file"
+            wide_df = pt_subset.pivot(
+                index=["model", "ensemble", "experiment"],
+                columns="variable",
+                values="zstore",
+            )
+            wide_df.reset_index(inplace=True)
+            wide_df.columns.name = None
+            self._coverage[key] = wide_df.dropna()
+
+        return self._coverage[key].copy()
+
+    def save(self, path: str):
+        """
+        Save the catalog to disk so it can be reused by `PangeoCatalog.load`.
+
+        :param path: The file to write.
+        :type path: str
+        """
+        with open(path, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Load a catalog previously written by `PangeoCatalog.save`.
+
+        :param path: The file to read.
+        :type path: str
+        :return: The PangeoCatalog.
+        """
+        with open(path, "rb") as f:
+            out = pickle.load(f)
+
+        if not isinstance(out, PangeoCatalog):
+            raise TypeError(f"{path} does not contain a PangeoCatalog.")
+        if out.format_version != PangeoCatalog.FORMAT_VERSION:
+            raise TypeError(
+                f"{path} was written by an incompatible version of PangeoCatalog, rebuild it."
+            )
+        return out
+
+
+# Internal fx
+@functools.lru_cache(maxsize=4)
+def read_catalog(path: str, source, cache_dir: str = None):
+    """
+    Read the catalog of a Pangeo table, from its binary copy when there is one.
+
+    The binary copy is the pickle of the PangeoCatalog, kept in cache_dir as
+    pangeo-catalog-<sha256 of the CSV file>.pkl, so it is only ever used for a CSV
+    file with the same content. It is written to a temporary file first and then
+    moved into place, so that processes reading the table at the same time never
+    see part of it. When it cannot be read or written the CSV file is read instead.
+
+    :param path: The path of the Pangeo table CSV file.
+    :param source: The modification time and size of the CSV file, so that the catalog
+                   is read again when the file changes.
+    :param cache_dir: Optional existing directory to keep the binary copy in. Defaults
+                      to None, always reading the CSV file.
+    :return: The PangeoCatalog.
+    """
+    if cache_dir is None:
+        out = PangeoCatalog(pd.read_csv(path))
+        out.source = source
+        return out
+
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    cache_path = os.path.join(cache_dir, CATALOG_FILE_PREFIX + digest + ".pkl")
+    try:
+        out = PangeoCatalog.load(cache_path)
+        if out.source == digest:
+            return out
+    except (OSError, TypeError, pickle.UnpicklingError, EOFError, AttributeError):
+        pass
+
+    out = PangeoCatalog(pd.read_csv(path))
+    out.source = digest
+
+    # The binary copy is only an optimization, the CSV file is read when it fails.
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(
+            dir=cache_dir, prefix=CATALOG_FILE_PREFIX, suffix=".tmp"
+        )
+        os.close(fd)
+        out.save(tmp)
+        os.replace(tmp, cache_path)
+    except (OSError, pickle.PicklingError):
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+    return out
+
+
+def pangeo_catalog(path: str = None, cache_dir: str = None):
+    """
+    Return the process wide catalog of the Pangeo table.
+
+    The table is read on first use and shared by all later calls until the file changes.
+    With a cache_dir, the catalog is also kept there as a binary copy of the table that
+    later processes load faster than the CSV file; see read_catalog.
+
+    :param path: The path of the Pangeo table CSV file; defaults to None, the
+                 pangeo_table.csv of the package data.
+    :type path: str
+    :param cache_dir: Optional existing directory, such as a user cache directory, to keep
+                      the binary copy of the catalog in. Nothing is written by default.
+    :type cache_dir: str
+    :return: The PangeoCatalog.
+    """
+    if path is None:
+        path = resources.files("stitches") / "data" / "pangeo_table.csv"
+    path = os.fspath(path)
+    if cache_dir is not None:
+        if not os.path.isdir(cache_dir):
+            raise TypeError("cache_dir: the cache directory does not exist.")
+        cache_dir = os.fspath(cache_dir)
+    stat = os.stat(path)
+    return read_catalog(path, (stat.st_mtime_ns, stat.st_size), cache_dir)
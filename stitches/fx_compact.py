@@ -0,0 +1,169 @@
+"""
+The `fx_compact` module holds the `Recipe`, a compact columnar copy of a formatted recipe.
+
+A formatted recipe repeats the same strings (the zstore files, the archive model, experiment and
+ensemble and the stitching_id) on every row. The `Recipe` keeps every string once in a dictionary
+and stores the string columns as small integer codes into it and the year columns as the smallest
+integer type that holds them. `Recipe.to_frame` expands it back into the data frame, and the
+stitching functions accept a `Recipe` directly. A recipe can be saved to and loaded from a binary
+file, which is much faster to read than the CSV file of the recipe.
+"""
+
+import pickle
+
+import numpy as np
+import pandas as pd
+
+
+class Recipe:
+    """
+    A compact copy of a recipe data frame.
+
+    :param recipe: A recipe data frame, such as the formatted recipe returned by `make_recipe`.
+    :type recipe: pd.DataFrame
+    """
+
+    # Increment when the attributes of the recipe change so that stale files are not loaded.
+    FORMAT_VERSION = 1
+
+    def __init__(self, recipe):
+        """
+        Encode the recipe data frame.
+
+        :param recipe: A recipe data frame.
+        :type recipe: pd.DataFrame
+        """
+        if not isinstance(recipe, pd.DataFrame):
+            raise TypeError("recipe: must be a pandas DataFrame")
+
+        self.format_version = Recipe.FORMAT_VERSION
+        self.columns = list(recipe.columns)
+        self.dtypes = recipe.dtypes.to_dict()
+        self.n_rows = len(recipe)
+        self.ints = {}
+        self.codes = {}
+        self.other = {}
+
+        # Integer code all of the string columns into a single dictionary of strings.
+        text = [
+            col
+            for col in self.columns
+            if pd.api.types.is_string_dtype(recipe[col])
+            and not pd.api.types.is_numeric_dtype(recipe[col])
+        ]
+        if len(text) > 0:
+            codes, strings = pd.factorize(
+                pd.concat(
+                    [recipe[col].astype(object) for col in text], ignore_index=True
+                )
+            )
+            codes = codes.astype(np.min_scalar_type(-len(strings)))
+            for i, col in enumerate(text):
+                self.codes[col] = codes[i * self.n_rows : (i + 1) * self.n_rows]
+            self.strings = np.asarray(strings, dtype=object)
+        else:
+            self.strings = np.array([], dtype=object)
+
+        # Store the integer columns with the smallest type holding their values.
+        for col in self.columns:
+            if col in self.codes:
+                continue
+            values = recipe[col].to_numpy()
+            if values.dtype.kind in "iu" and len(values) > 0:
+                dtype = np.result_type(
+                    np.min_scalar_type(values.min()), np.min_scalar_type(values.max())
+                )
+                self.ints[col] = values.astype(dtype)
+            else:
+                self.other[col] = values.copy()
+
+    def __len__(self):
+        """Return the number of rows of the recipe."""
+        return self.n_rows
+
+    @property
+    def nbytes(self):
+        """The number of bytes used by the arrays of the recipe."""
+        out = sum(values.nbytes for values in self.ints.values())
+        out += sum(values.nbytes for values in self.codes.values())
+        out += sum(values.nbytes for values in self.other.values())
+        out += sum(len(value) for value in self.strings if isinstance(value, str))
+        return out
+
+    def stitching_ids(self):
+        """
+        Return the stitching ids of the recipe.
+
+        :return: An array of the unique stitching_id values, in order of appearance.
+        """
+        if "stitching_id" not in self.codes:
+            raise TypeError(
+                "The recipe does not have a stitching_id column of strings."
+            )
+        codes = pd.unique(self.codes["stitching_id"])
+        return self.strings[codes[codes >= 0]]
+
+    def to_frame(self):
+        """
+        Expand the recipe into its data frame.
+
+        :return: The recipe data frame, with the columns, dtypes and row order of the
+                 data frame the recipe was made from and a default row index.
+        """
+        data = {}
+        for col in self.columns:
+            if col in self.codes:
+                codes = self.codes[col]
+                values = self.strings[np.maximum(codes, 0)]
+                values[codes < 0] = None
+            elif col in self.ints:
+                values = self.ints[col]
+            else:
+                values = self.other[col]
+            data[col] = values
+
+        out = pd.DataFrame(data, columns=self.columns).astype(self.dtypes)
+        return out
+
+    def save(self, path: str):
+        """
+        Save the recipe to disk so it can be reused by `Recipe.load`.
+
+        :param path: The file path to write the recipe to.
+        :type path: str
+        """
+        with open(path, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Load a recipe previously written by `Recipe.save`.
+
+        :param path: The file path of the saved recipe.
+        :type path: str
+        :return: The Recipe.
+        """
+        with open(path, "rb") as f:
+            out = pickle.load(f)
+
+        if not isinstance(out, Recipe):
+            raise TypeError(f"{path} does not contain a Recipe.")
+        if out.format_version != Recipe.FORMAT_VERSION:
+            raise TypeError(
+                f"{path} was written by an incompatible version of Recipe, rebuild it."
+            )
+
+        return out
+
+
+def as_recipe_frame(recipe):
+    """
+    Return `recipe` as a data frame, expanding a Recipe if one is given.
+
+    :param recipe: A recipe data frame or a Recipe.
+    :return: A recipe data frame.
+    """
+    if isinstance(recipe, Recipe):
+        return recipe.to_frame()
+    return recipe
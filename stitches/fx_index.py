@@ -0,0 +1,476 @@
+"""
+The `fx_index` module holds the `ArchiveIndex`, a reusable search structure over a matching archive.
+
+Building the index does all of the archive preprocessing that matching needs (checking columns,
+resetting the row index, computing the window size, scaling dx, integer coding the metadata and
+building a KD-tree) once, so that repeated calls to `match_neighborhood`, `remove_duplicates` or
+`make_recipe` against the same archive can skip it. The index can be saved to and loaded from disk.
+"""
+
+import hashlib
+import pickle
+
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import KDTree
+
+import stitches.fx_util as util
+
+
+class ArchiveIndex:
+    """
+    A prebuilt, reusable nearest neighbor index of a matching archive.
+
+    :param archive_data: A data frame of the archive fx and dx values, such as the
+                         matching archive returned by `make_matching_archive`.
+    :type archive_data: pd.DataFrame
+    """
+
+    # Increment when the attributes of the index change so that stale files are not loaded.
+    FORMAT_VERSION = 5
+
+    # The archive columns used to describe an archive window.
+    META_COLUMNS = ["model", "experiment", "variable", "ensemble"]
+
+    # The archive columns that identify an archive window.
+    WINDOW_COLUMNS = [
+        "model",
+        "experiment",
+        "variable",
+        "ensemble",
+        "start_yr",
+        "end_yr",
+        "year",
+        "fx",
+        "dx",
+    ]
+
+    def __init__(self, archive_data):
+        """
+        Build the index from an archive data frame.
+
+        :param archive_data: A data frame of the archive fx and dx values.
+        :type archive_data: pd.DataFrame
+        """
+        if util.nrow(archive_data) <= 0:
+            raise TypeError("archive_data is an empty data frame")
+        util.check_columns(archive_data, set(ArchiveIndex.WINDOW_COLUMNS))
+
+        self.format_version = ArchiveIndex.FORMAT_VERSION
+        self.data = archive_data.reset_index(drop=True).copy()
+
+        # Compute the window size of the archive data to use to update
+        # dx values to be windowsize*dx so that it has units of degC
+        self.windowsize = max(self.data["end_yr"] - self.data["start_yr"])
+        self.fx = self.data["fx"].to_numpy(dtype=float)
+        self.dx = self.data["dx"].to_numpy(dtype=float)
+        self.coords = np.column_stack([self.fx, self.windowsize * self.dx])
+
+        # Flag the archive windows identical to an earlier one, matching skips them.
+        self.duplicated = self.data.duplicated(
+            subset=ArchiveIndex.WINDOW_COLUMNS
+        ).to_numpy()
+
+        # Integer code the archive metadata, the categories map the codes back to
+        # the original values.
+        self.codes = {}
+        self.categories = {}
+        for col in ArchiveIndex.META_COLUMNS:
+            codes, categories = pd.factorize(self.data[col])
+            self.codes[col] = codes
+            self.categories[col] = categories
+
+        # The KD-trees and the window lookup are built the first time they are needed.
+        self._tree = None
+        self._metric_trees = {}
+        self._window_keys = None
+        self._fingerprint = None
+
+    @classmethod
+    def from_arrays(cls, fx, dx, windowsize):
+        """
+        Build a coordinates only index from the archive fx and dx arrays.
+
+        The index can be queried but has no archive data or metadata, it is used to
+        share the archive coordinates with the matching worker processes.
+
+        :param fx: Array of the archive fx values.
+        :param dx: Array of the archive dx values.
+        :param windowsize: The archive window size used to scale dx.
+        :return: An ArchiveIndex without archive data.
+        """
+        out = cls.__new__(cls)
+        out.format_version = ArchiveIndex.FORMAT_VERSION
+        out.data = None
+        out.windowsize = windowsize
+        out.fx = fx
+        out.dx = dx
+        out.coords = np.column_stack([fx, windowsize * dx])
+        out.duplicated = np.zeros(len(fx), dtype=bool)
+        out.codes = {}
+        out.categories = {}
+        out._tree = None
+        out._metric_trees = {}
+        out._window_keys = None
+        out._fingerprint = None
+        return out
+
+    def __len__(self):
+        """Return the number of archive windows in the index."""
+        return len(self.fx)
+
+    @property
+    def tree(self):
+        """The KD-tree over the scaled archive coordinates."""
+        if self._tree is None:
+            self._tree = KDTree(self.coords)
+        return self._tree
+
+    @property
+    def fingerprint(self):
+        """
+        A hash of the content of the archive windows, see `fx_util.hash_frame`.
+
+        It is the hash of the WINDOW_COLUMNS of the archive data, so an index and its
+        archive data frame have the same fingerprint.
+        """
+        if self._fingerprint is None:
+            if self.data is None:
+                digest = hashlib.sha256(self.coords.tobytes())
+                self._fingerprint = digest.hexdigest()
+            else:
+                self._fingerprint = util.hash_frame(
+                    self.data, ArchiveIndex.WINDOW_COLUMNS
+                )
+        return self._fingerprint
+
+    def metric_tree(self, metric):
+        """
+        Return the KD-tree of the archive coordinates rescaled by a metric.
+
+        :param metric: A 2x2 scaling matrix from `metric_matrix`, or None for the
+                       default Euclidean metric.
+        :return: The KD-tree, trees are cached for every metric used.
+        """
+        if metric is None:
+            return self.tree
+        key = metric.tobytes()
+        if key not in self._metric_trees:
+            self._metric_trees[key] = KDTree(self.coords @ metric.T)
+        return self._metric_trees[key]
+
+    def query(self, target_fx, target_dx, tol=0, metric=None, used=None):
+        """
+        Find the neighborhood of archive windows for each target window.
+
+        The KD-tree is queried for every target window at once, first for the nearest
+        neighbor and then for all of the archive points within the nearest neighbor
+        distance plus `tol`. The KD-tree is only used to find the candidates, the
+        distances of the candidates are recalculated the same way `internal_dist`
+        calculates them so that the nearest neighbor ties and the tol neighborhood are
+        identical to a linear scan of the archive.
+
+        Archive windows can be excluded from matching with the `used` mask, the result
+        is the same as querying an index built without them but the KD-tree does not
+        have to be rebuilt.
+
+        :param target_fx: Array of the target fx values.
+        :param target_dx: Array of the target dx values.
+        :param tol: A tolerance for the neighborhood of matching; defaults to 0 degC,
+                    returning only the nearest neighbor.
+        :param metric: A 2x2 scaling matrix from `metric_matrix`; defaults to None,
+                       the Euclidean distance in (fx, windowsize*dx) space.
+        :param used: Boolean array, True for the archive rows that can not be matched;
+                     defaults to None, matching against every archive window.
+        :return: A list of arrays, the target row positions, the archive row positions,
+                 dist_dx, dist_fx and dist_l2 for every matched pair. The pairs are
+                 ordered by target row and then by archive row.
+        """
+        target_fx = np.asarray(target_fx, dtype=float)
+        target_dx = np.asarray(target_dx, dtype=float)
+        target_coords = np.column_stack([target_fx, self.windowsize * target_dx])
+        tree = self.metric_tree(metric)
+        if metric is not None:
+            target_coords = target_coords @ metric.T
+
+        # Find the nearest neighbor distance for every target window and then every
+        # archive point within the nearest neighbor distance + tol. The radius is padded
+        # slightly so that floating point differences between the KD-tree distance and
+        # the internal_dist distance can not drop a candidate.
+        if used is None:
+            nn_dist, _ = tree.query(target_coords, k=1)
+            nn_dist = nn_dist[:, 0]
+        else:
+            used = np.asarray(used, dtype=bool)
+            if used.all():
+                raise TypeError("There are no unused archive windows left to match.")
+            # The used windows are tombstoned, the nearest number of used + 1 windows
+            # contain at least one unused window.
+            dist, idx = tree.query(target_coords, k=min(len(self), used.sum() + 1))
+            first = np.argmax(~used[idx], axis=1)
+            nn_dist = dist[np.arange(len(dist)), first]
+        radius = (nn_dist + tol) * (1 + 1e-9) + 1e-12
+        candidates = tree.query_radius(target_coords, r=radius)
+        if used is not None:
+            candidates = [idx[~used[idx]] for idx in candidates]
+
+        lengths = np.array([len(idx) for idx in candidates])
+        target_idx = np.repeat(np.arange(len(target_fx)), lengths)
+        archive_idx = np.concatenate(candidates).astype(int)
+        order = np.lexsort((archive_idx, target_idx))
+        target_idx = target_idx[order]
+        archive_idx = archive_idx[order]
+
+        dist_dx, dist_fx, dist_l2 = pair_distances(
+            self.fx[archive_idx],
+            self.dx[archive_idx],
+            target_fx[target_idx],
+            target_dx[target_idx],
+            self.windowsize,
+            metric,
+        )
+
+        # Keep the nearest neighbor and everything within tol of it.
+        starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        min_dist = np.minimum.reduceat(dist_l2, starts)
+        keep = dist_l2 <= (min_dist + tol)[target_idx]
+
+        return [
+            target_idx[keep],
+            archive_idx[keep],
+            dist_dx[keep],
+            dist_fx[keep],
+            dist_l2[keep],
+        ]
+
+    def query_topk(self, target_fx, target_dx, k: int, metric=None):
+        """
+        Find the k nearest archive windows for each target window.
+
+        :param target_fx: Array of the target fx values.
+        :param target_dx: Array of the target dx values.
+        :param k: The number of nearest archive windows to return per target window,
+                  at most the number of archive windows.
+        :type k: int
+        :param metric: A 2x2 scaling matrix from `metric_matrix`; defaults to None,
+                       the Euclidean distance in (fx, windowsize*dx) space.
+        :return: A list of target windows by k arrays, the archive row positions,
+                 dist_dx, dist_fx and dist_l2 of the matches. Each row is ordered by
+                 dist_l2 and then by archive row.
+        """
+        target_fx = np.asarray(target_fx, dtype=float)
+        target_dx = np.asarray(target_dx, dtype=float)
+        target_coords = np.column_stack([target_fx, self.windowsize * target_dx])
+        if metric is not None:
+            target_coords = target_coords @ metric.T
+
+        _, archive_idx = self.metric_tree(metric).query(
+            target_coords, k=min(k, len(self))
+        )
+        dist_dx, dist_fx, dist_l2 = pair_distances(
+            self.fx[archive_idx],
+            self.dx[archive_idx],
+            target_fx[:, np.newaxis],
+            target_dx[:, np.newaxis],
+            self.windowsize,
+            metric,
+        )
+
+        order = np.lexsort((archive_idx, dist_l2))
+        return [
+            np.take_along_axis(x, order, axis=1)
+            for x in [archive_idx, dist_dx, dist_fx, dist_l2]
+        ]
+
+    def query_batch(
+        self, target_fx, target_dx, tol=0, max_memory: int = 2**27, metric=None
+    ):
+        """
+        Find the neighborhood of archive windows for each target window by brute force.
+
+        The target by archive distances are calculated with NumPy broadcasting in tiles
+        of target windows, each tile is sized so that its distance arrays fit within
+        `max_memory` bytes. The distances are calculated the same way `internal_dist`
+        calculates them and the result is identical to `ArchiveIndex.query`.
+
+        :param target_fx: Array of the target fx values.
+        :param target_dx: Array of the target dx values.
+        :param tol: A tolerance for the neighborhood of matching; defaults to 0 degC,
+                    returning only the nearest neighbor.
+        :param max_memory: The approximate memory ceiling in bytes for a single tile; a
+                           tile always holds at least one target window.
+        :type max_memory: int
+        :param metric: A 2x2 scaling matrix from `metric_matrix`; defaults to None,
+                       the Euclidean distance in (fx, windowsize*dx) space.
+        :return: A list of arrays, the target row positions, the archive row positions,
+                 dist_dx, dist_fx and dist_l2 for every matched pair. The pairs are
+                 ordered by target row and then by archive row.
+        """
+        target_fx = np.asarray(target_fx, dtype=float)
+        target_dx = np.asarray(target_dx, dtype=float)
+
+        # A tile holds the dist_dx, dist_fx, dist_l2 and neighborhood mask arrays, and
+        # the signed differences when a metric is used.
+        n_arrays = 4 if metric is None else 6
+        tile_rows = max(1, int(max_memory // (n_arrays * 8 * len(self))))
+
+        out = [[], [], [], [], []]
+        for start in range(0, len(target_fx), tile_rows):
+            tile_fx = target_fx[start : start + tile_rows, np.newaxis]
+            tile_dx = target_dx[start : start + tile_rows, np.newaxis]
+
+            dist_dx, dist_fx, dist_l2 = pair_distances(
+                self.fx, self.dx, tile_fx, tile_dx, self.windowsize, metric
+            )
+
+            # Keep the nearest neighbor and everything within tol of it.
+            min_dist = dist_l2.min(axis=1)
+            target_idx, archive_idx = np.nonzero(
+                dist_l2 <= (min_dist + tol)[:, np.newaxis]
+            )
+
+            out[0].append(target_idx + start)
+            out[1].append(archive_idx)
+            out[2].append(dist_dx[target_idx, archive_idx])
+            out[3].append(dist_fx[target_idx, archive_idx])
+            out[4].append(dist_l2[target_idx, archive_idx])
+
+        return [np.concatenate(x) for x in out]
+
+    def locate(self, windows):
+        """
+        Find the archive rows of a set of archive windows.
+
+        :param windows: Data frame with the model, experiment, variable, ensemble,
+                        start_yr, end_yr, year, fx and dx of the archive windows.
+        :return: Array of the archive row positions holding the windows. Identical
+                 archive rows are all returned, windows not in the archive are skipped.
+        """
+        if self._window_keys is None:
+            self._window_keys = pd.MultiIndex.from_frame(
+                self.data[ArchiveIndex.WINDOW_COLUMNS]
+            )
+        rows, _ = self._window_keys.get_indexer_non_unique(
+            pd.MultiIndex.from_frame(windows[ArchiveIndex.WINDOW_COLUMNS])
+        )
+        return np.unique(rows[rows >= 0])
+
+    def subset(self, keep):
+        """
+        Return a new index containing only some of the archive windows.
+
+        :param keep: Boolean array, True for the archive rows to keep.
+        :return: An ArchiveIndex of the selected archive windows.
+        """
+        return ArchiveIndex(self.data.loc[np.asarray(keep, dtype=bool)])
+
+    def save(self, path: str):
+        """
+        Save the index to disk so it can be reused by `ArchiveIndex.load`.
+
+        :param path: The file path to write the index to.
+        :type path: str
+        """
+        with open(path, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Load an index previously written by `ArchiveIndex.save`.
+
+        :param path: The file path of the saved index.
+        :type path: str
+        :return: The ArchiveIndex.
+        """
+        with open(path, "rb") as f:
+            out = pickle.load(f)
+
+        if not isinstance(out, ArchiveIndex):
+            raise TypeError(f"{path} does not contain an ArchiveIndex.")
+        if out.format_version != ArchiveIndex.FORMAT_VERSION:
+            raise TypeError(
+                f"{path} was written by an incompatible version of ArchiveIndex, rebuild it."
+            )
+
+        return out
+
+
+def metric_matrix(metric):
+    """
+    Convert a matching metric into the 2x2 matrix used to rescale the matching coordinates.
+
+    The distance between a target and archive window is the length of the scaling matrix
+    times (fx difference, windowsize*dx difference), so the matrix S gives the
+    Mahalanobis-style distance with matrix S'S. Two weights w give the diagonal matrix
+    of w, weighting the fx and windowsize*dx differences.
+
+    :param metric: None for the default Euclidean distance, a pair of (fx, dx) weights
+                   or a 2x2 scaling matrix.
+    :return: The 2x2 scaling matrix as a NumPy array, or None for the default metric.
+    """
+    if metric is None:
+        return None
+
+    out = np.asarray(metric, dtype=float)
+    if out.shape == (2,):
+        out = np.diag(out)
+    if out.shape != (2, 2) or not np.isfinite(out).all():
+        raise TypeError("metric: must be None, two weights or a 2x2 scaling matrix")
+
+    return out
+
+
+def pair_distances(archive_fx, archive_dx, target_fx, target_dx, windowsize, metric):
+    """
+    Calculate the distances between archive and target windows.
+
+    With the default metric the distances are calculated exactly like `internal_dist`
+    does. dist_fx and dist_dx are always the unweighted fx and windowsize*dx
+    differences, dist_l2 is the distance under the metric. The arrays broadcast.
+
+    :param archive_fx: Array of the archive fx values.
+    :param archive_dx: Array of the archive dx values.
+    :param target_fx: Array of the target fx values.
+    :param target_dx: Array of the target dx values.
+    :param windowsize: The archive window size used to scale dx.
+    :param metric: A 2x2 scaling matrix from `metric_matrix`, or None.
+    :return: A list of the dist_dx, dist_fx and dist_l2 arrays.
+    """
+    dist_dx = windowsize * abs(archive_dx - target_dx)
+    dist_fx = abs(archive_fx - target_fx)
+    if metric is None:
+        dist_l2 = (dist_fx**2 + dist_dx**2) ** 0.5
+    else:
+        diff_fx = archive_fx - target_fx
+        diff_dx = windowsize * (archive_dx - target_dx)
+        dist_l2 = (
+            (metric[0, 0] * diff_fx + metric[0, 1] * diff_dx) ** 2
+            + (metric[1, 0] * diff_fx + metric[1, 1] * diff_dx) ** 2
+        ) ** 0.5
+
+    return [dist_dx, dist_fx, dist_l2]
+
+
+def as_archive_index(archive_data):
+    """
+    Return `archive_data` as an ArchiveIndex, building one if a data frame is given.
+
+    :param archive_data: A data frame of the archive fx and dx values or an ArchiveIndex.
+    :return: An ArchiveIndex.
+    """
+    if isinstance(archive_data, ArchiveIndex):
+        return archive_data
+    return ArchiveIndex(archive_data)
+
+
+def as_archive_frame(archive_data):
+    """
+    Return `archive_data` as a data frame, unwrapping an ArchiveIndex if one is given.
+
+    :param archive_data: A data frame of the archive fx and dx values or an ArchiveIndex.
+    :return: A data frame of the archive.
+    """
+    if isinstance(archive_data, ArchiveIndex):
+        return archive_data.data
+    return archive_data
@@ -5,10 +5,46 @@ It includes functions to calculate distances between target and archive data poi
 select the best matches based on those distances.
 """
 
+import logging
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import pandas as pd
 
 import stitches.fx_util as util
+from stitches.fx_index import ArchiveIndex, as_archive_index, metric_matrix
+
+logger = logging.getLogger(__name__)
+
+
+# The target and archive columns, in the order they appear in the matched data frame.
+TARGET_COLUMNS = [
+    "variable",
+    "experiment",
+    "ensemble",
+    "model",
+    "start_yr",
+    "end_yr",
+    "year",
+    "fx",
+    "dx",
+]
+ARCHIVE_COLUMNS = [
+    "experiment",
+    "variable",
+    "model",
+    "ensemble",
+    "start_yr",
+    "end_yr",
+    "year",
+    "fx",
+    "dx",
+]
+
+# The nearest neighbor distance in degC above which match_neighborhood warns about a match.
+FAR_NEIGHBOR_THRESHOLD = 0.25
 
 
 # Internal fx
@@ -136,13 +172,17 @@ def drop_hist_false_duplicates(matched_data):
 
     # Only operate if there are any historic years to deal with:
     if util.nrow(subset_df) > 0:
-        # parse out information about the ssp experiment id
-        subset_df["idvalue"] = list(
-            map(
-                lambda x: int(x.split("p")[1].replace("-over", "")),
-                subset_df["archive_experiment"],
+        # parse out information about the ssp experiment id, only once for each
+        # of the experiments
+        experiments = subset_df["archive_experiment"].unique()
+        idvalues = dict(
+            zip(
+                experiments,
+                map(lambda x: int(x.split("p")[1].replace("-over", "")), experiments),
             )
         )
+        subset_df["idvalue"] = subset_df["archive_experiment"].map(idvalues)
+
         # group the data frame by the target information, recall that for each target match
         # there might be more matches with the archive. Here we want to make sure that we do
         # not want to have multiple matches with experiments from the historical period
@@ -162,11 +202,14 @@ def drop_hist_false_duplicates(matched_data):
                 "archive_year",
             ]
         )
-        dat = []
-        for name, group in grouped_dat:
-            min_id_value = min(group["idvalue"])
-            dat.append(group.loc[group["idvalue"] == min_id_value])
-        historical = pd.concat(dat)
+        # Keep the matches with the smallest id value in each group, ordered by group.
+        group_id = grouped_dat.ngroup().to_numpy()
+        min_id_value = grouped_dat["idvalue"].transform("min").to_numpy()
+        keep = np.flatnonzero(
+            (subset_df["idvalue"].to_numpy() == min_id_value) & (group_id >= 0)
+        )
+        keep = keep[np.argsort(group_id[keep], kind="stable")]
+        historical = subset_df.iloc[keep]
         cols_to_keep = [
             "target_variable",
             "target_experiment",
@@ -232,8 +275,368 @@ def drop_hist_false_duplicates(matched_data):
         return matched_data
 
 
+def far_neighbors(matched_data, threshold: float = FAR_NEIGHBOR_THRESHOLD):
+    """
+    Find the target windows whose nearest neighbor match is far away.
+
+    Target windows with a nearest neighbor more than `threshold` away in T, dT space
+    may or may not result in poor matches and we recommend validating them.
+    `match_neighborhood` logs a warning with the far neighbors it finds.
+
+    :param matched_data: Data frame returned from match_neighborhood.
+    :param threshold: The nearest neighbor distance in degC above which a target window
+        is reported. Defaults to 0.25 degC.
+    :type threshold: float
+    :return: Data frame of the nearest neighbor matches, in the format of the matched data,
+        of the target windows whose nearest neighbor is more than `threshold` away.
+    """
+    # get the nearest neighbor match only for each target window
+    grouped = matched_data.groupby(
+        [
+            "target_variable",
+            "target_experiment",
+            "target_ensemble",
+            "target_model",
+            "target_start_yr",
+            "target_end_yr",
+            "target_year",
+            "target_fx",
+            "target_dx",
+        ]
+    )
+    group_id = grouped.ngroup().to_numpy()
+    dist_l2 = matched_data["dist_l2"].to_numpy()
+    min_dist = grouped["dist_l2"].transform("min").to_numpy()
+
+    # subset to just the far away nearest neighbors, ordered by target window
+    far = np.flatnonzero(
+        (dist_l2 == min_dist) & (dist_l2 > threshold) & (group_id >= 0)
+    )
+    far = far[np.argsort(group_id[far], kind="stable")]
+
+    return matched_data.iloc[far].reset_index(drop=True)
+
+
+# The archive index of a matching worker process, set by init_match_worker.
+worker_index = None
+
+
+# Internal fx
+def init_match_worker(path, windowsize):
+    """
+    Attach a matching worker process to the shared, memory-mapped archive coordinates.
+
+    :param path: Path of the .npy file holding the archive fx and dx arrays.
+    :param windowsize: The archive window size used to scale dx.
+    """
+    global worker_index
+    coords = np.load(path, mmap_mode="r")
+    worker_index = ArchiveIndex.from_arrays(coords[0], coords[1], windowsize)
+
+
+# Internal fx
+def match_partition(target_fx, target_dx, tol, method, max_memory, metric=None):
+    """
+    Match one partition of the target windows in a matching worker process.
+
+    :param target_fx: Array of the target fx values.
+    :param target_dx: Array of the target dx values.
+    :param tol: A tolerance for the neighborhood of matching.
+    :param method: The matching engine, 'kdtree' or 'batch'.
+    :param max_memory: The memory ceiling of a tile for the 'batch' engine.
+    :param metric: A 2x2 scaling matrix from `metric_matrix`, or None.
+    :return: The matched pairs, see `ArchiveIndex.query`.
+    """
+    if method == "batch":
+        return worker_index.query_batch(
+            target_fx, target_dx, tol=tol, max_memory=max_memory, metric=metric
+        )
+    return worker_index.query(target_fx, target_dx, tol=tol, metric=metric)
+
+
+# Internal fx
+def experiment_metric(metric, experiment):
+    """
+    Return the scaling matrix of the metric used for a target experiment.
+
+    :param metric: None, a pair of weights, a 2x2 scaling matrix or a dictionary
+                   mapping target experiments to one of those.
+    :param experiment: The target experiment.
+    :return: The 2x2 scaling matrix, or None for the default metric.
+    """
+    if isinstance(metric, dict):
+        return metric_matrix(metric.get(experiment))
+    return metric_matrix(metric)
+
+
+# Internal fx
+def combine_partitions(partitions, rslt):
+    """
+    Combine the matched pairs of partitions of the target windows in target row order.
+
+    :param partitions: List of arrays of the target row positions in each partition.
+    :param rslt: List of the matched pairs of each partition.
+    :return: The matched pairs, see `ArchiveIndex.query`.
+    """
+    out = [np.concatenate(x) for x in zip(*rslt)]
+    out[0] = np.concatenate([rows[x[0]] for rows, x in zip(partitions, rslt)])
+    order = np.argsort(out[0], kind="stable")
+    return [x[order] for x in out]
+
+
+# Internal fx
+def parallel_query(target_data, index, tol, method, max_memory, n_workers, metric=None):
+    """
+    Match the target windows in a process pool, partitioned by target trajectory.
+
+    The archive coordinates are written once to a memory-mapped file that all of the
+    workers read, so the archive is not pickled for every task. The results are put
+    back in target row order, so they are identical to matching in a single process.
+
+    :param target_data: Data frame of the target fx and dx values.
+    :param index: The ArchiveIndex of the archive.
+    :param tol: A tolerance for the neighborhood of matching.
+    :param method: The matching engine, 'kdtree' or 'batch'.
+    :param max_memory: The memory ceiling of a tile for the 'batch' engine.
+    :param n_workers: The number of worker processes.
+    :param metric: The metric argument of match_neighborhood.
+    :return: The matched pairs, see `ArchiveIndex.query`.
+    """
+    partitions = list(
+        target_data.groupby(
+            ["variable", "experiment", "ensemble", "model"], sort=False
+        ).indices.values()
+    )
+    target_fx = target_data["fx"].to_numpy(dtype=float)
+    target_dx = target_data["dx"].to_numpy(dtype=float)
+    experiments = target_data["experiment"].to_numpy()
+
+    with tempfile.TemporaryDirectory() as tdir:
+        path = os.path.join(tdir, "archive_coords.npy")
+        np.save(path, np.vstack([index.fx, index.dx]))
+
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            initializer=init_match_worker,
+            initargs=(path, index.windowsize),
+        ) as executor:
+            rslt = list(
+                executor.map(
+                    match_partition,
+                    [target_fx[rows] for rows in partitions],
+                    [target_dx[rows] for rows in partitions],
+                    [tol] * len(partitions),
+                    [method] * len(partitions),
+                    [max_memory] * len(partitions),
+                    [
+                        experiment_metric(metric, experiments[rows[0]])
+                        for rows in partitions
+                    ],
+                )
+            )
+
+    return combine_partitions(partitions, rslt)
+
+
+# Internal fx
+def query_pairs(
+    target_data, index, tol, method, max_memory, n_workers=None, metric=None, used=None
+):
+    """
+    Find the matched pairs of the target windows with the 'kdtree' or 'batch' engine.
+
+    :param target_data: Data frame of the target fx and dx values.
+    :param index: The ArchiveIndex of the archive.
+    :param tol: A tolerance for the neighborhood of matching.
+    :param method: The matching engine, 'kdtree' or 'batch'.
+    :param max_memory: The memory ceiling of a tile for the 'batch' engine.
+    :param n_workers: The number of worker processes, None to match in this process.
+    :param metric: The metric argument of match_neighborhood.
+    :param used: Boolean array of the archive rows that can not be matched, only
+                 with the 'kdtree' engine in this process. Defaults to None.
+    :return: The matched pairs, see `ArchiveIndex.query`.
+    """
+    if n_workers is not None and n_workers > 1:
+        return parallel_query(
+            target_data, index, tol, method, max_memory, n_workers, metric=metric
+        )
+
+    # Match the target windows of each experiment with the metric of the experiment.
+    if isinstance(metric, dict):
+        partitions = list(
+            target_data.groupby("experiment", sort=False).indices.values()
+        )
+    else:
+        partitions = [np.arange(util.nrow(target_data))]
+
+    rslt = []
+    for rows in partitions:
+        target_fx = target_data["fx"].to_numpy(dtype=float)[rows]
+        target_dx = target_data["dx"].to_numpy(dtype=float)[rows]
+        scaling = experiment_metric(metric, target_data["experiment"].iloc[rows[0]])
+        if method == "batch":
+            rslt.append(
+                index.query_batch(
+                    target_fx, target_dx, tol=tol, max_memory=max_memory, metric=scaling
+                )
+            )
+        else:
+            rslt.append(
+                index.query(target_fx, target_dx, tol=tol, metric=scaling, used=used)
+            )
+
+    if len(partitions) == 1:
+        return rslt[0]
+    return combine_partitions(partitions, rslt)
+
+
+# Internal fx
+def gather_matches(
+    target_data, archive_data, target_idx, archive_idx, dist_dx, dist_fx, dist_l2
+):
+    """
+    Build the matched data frame from the row positions of the matched pairs.
+
+    :param target_data: Data frame of the target fx and dx values.
+    :param archive_data: Data frame of the archive fx and dx values.
+    :param target_idx: Array of the target row positions of the matched pairs.
+    :param archive_idx: Array of the archive row positions of the matched pairs.
+    :param dist_dx: Array of the dx distance of the matched pairs.
+    :param dist_fx: Array of the fx distance of the matched pairs.
+    :param dist_l2: Array of the Euclidean distance of the matched pairs.
+    :return: Data frame with the target data and the corresponding matched archive data,
+             in the format returned by match_neighborhood.
+    """
+    target = target_data[TARGET_COLUMNS].take(target_idx).reset_index(drop=True)
+    target.columns = "target_" + target.columns
+    archive = archive_data[ARCHIVE_COLUMNS].take(archive_idx).reset_index(drop=True)
+    archive.columns = "archive_" + archive.columns
+    dist = pd.DataFrame({"dist_dx": dist_dx, "dist_fx": dist_fx, "dist_l2": dist_l2})
+
+    return pd.concat([target, archive, dist], axis=1)
+
+
+class TopKMatch:
+    """
+    The k nearest archive windows of every target window, stored as dense arrays.
+
+    Row i of each array describes target window i (the ith row of `target_data`) and
+    its columns are the matches ordered from nearest to farthest. Slots without a
+    match, because the archive has fewer than k windows or the match is outside of
+    the tolerance, have an archive id of -1 and infinite distances.
+
+    :param target_data: Data frame of the target fx and dx values.
+    :param archive_index: The ArchiveIndex the archive ids refer to.
+    :param archive_ids: Target windows by k array of archive row positions.
+    :param dist_dx: Target windows by k array of the dx distances.
+    :param dist_fx: Target windows by k array of the fx distances.
+    :param dist_l2: Target windows by k array of the Euclidean distances.
+    """
+
+    def __init__(
+        self, target_data, archive_index, archive_ids, dist_dx, dist_fx, dist_l2
+    ):
+        """Store the target data, archive index and match arrays."""
+        self.target_data = target_data
+        self.archive_index = archive_index
+        self.archive_ids = archive_ids
+        self.dist_dx = dist_dx
+        self.dist_fx = dist_fx
+        self.dist_l2 = dist_l2
+
+    @property
+    def distances(self):
+        """Target windows by k array of the Euclidean distances of the matches."""
+        return self.dist_l2
+
+    @property
+    def counts(self):
+        """The number of matches of each target window."""
+        return (self.archive_ids >= 0).sum(axis=1)
+
+    def to_frame(self, drop_hist_duplicates: bool = False):
+        """
+        Expand the matches into the long data frame format of match_neighborhood.
+
+        :param drop_hist_duplicates: Whether to drop the false duplicate matches in the
+            historical period with drop_hist_false_duplicates. Defaults to False.
+        :type drop_hist_duplicates: bool
+        :return: Data frame with the target data and the corresponding matched archive data.
+        """
+        valid = self.archive_ids >= 0
+        out = gather_matches(
+            self.target_data,
+            self.archive_index.data,
+            np.nonzero(valid)[0],
+            self.archive_ids[valid],
+            self.dist_dx[valid],
+            self.dist_fx[valid],
+            self.dist_l2[valid],
+        )
+        if drop_hist_duplicates:
+            out = drop_hist_false_duplicates(out)
+        return out
+
+
+def match_topk(target_data, archive_data, k: int, tol: float = None, metric=None):
+    """
+    Find the k nearest archive windows of every target window.
+
+    A compact alternative to match_neighborhood that returns the archive row ids and
+    distances of the matches as target windows by k arrays, which can be expanded into
+    the match_neighborhood data frame with `TopKMatch.to_frame`.
+
+    :param target_data: Data frame of the target fx and dx values.
+    :param archive_data: Data frame of the archive fx and dx values, or a prebuilt
+        ArchiveIndex of the archive.
+    :param k: The number of nearest archive windows to keep for each target window.
+    :type k: int
+    :param tol: Optional tolerance, when given only the matches within tol of the
+        nearest neighbor distance are kept. Defaults to None, keeping all k matches.
+    :type tol: float
+    :param metric: The distance metric, None (default), a pair of (fx, dx) weights or a
+        2x2 scaling matrix, see match_neighborhood.
+    :return: A TopKMatch of the matches, its archive ids refer to the rows of its
+        archive index.
+    """
+    if util.nrow(target_data) <= 0:
+        raise TypeError("target_data is an empty data frame")
+    util.check_columns(target_data, set(TARGET_COLUMNS))
+    if not (type(k) is int and k >= 1):
+        raise TypeError("k: must be a positive integer")
+
+    index = as_archive_index(archive_data)
+    target_data = target_data.reset_index(drop=True)
+    archive_ids, dist_dx, dist_fx, dist_l2 = index.query_topk(
+        target_data["fx"], target_data["dx"], k=k, metric=metric_matrix(metric)
+    )
+
+    # Pad to k matches and drop the matches outside of the tolerance.
+    pad = k - archive_ids.shape[1]
+    if pad > 0:
+        archive_ids = np.pad(archive_ids, ((0, 0), (0, pad)), constant_values=-1)
+        dist_dx, dist_fx, dist_l2 = [
+            np.pad(x, ((0, 0), (0, pad)), constant_values=np.inf)
+            for x in [dist_dx, dist_fx, dist_l2]
+        ]
+    if tol is not None:
+        outside = dist_l2 > dist_l2[:, [0]] + tol
+        archive_ids[outside] = -1
+        for x in [dist_dx, dist_fx, dist_l2]:
+            x[outside] = np.inf
+
+    return TopKMatch(target_data, index, archive_ids, dist_dx, dist_fx, dist_l2)
+
+
 def match_neighborhood(
-    target_data, archive_data, tol: float = 0, drop_hist_duplicates: bool = True
+    target_data,
+    archive_data,
+    tol: float = 0,
+    drop_hist_duplicates: bool = True,
+    method: str = "kdtree",
+    max_memory: int = 2**27,
+    n_workers: int = None,
+    metric=None,
 ):
     """
     Calculate the Euclidean distance between target and archive data.
@@ -242,113 +645,246 @@ def match_neighborhood(
     Euclidean distance between the target values (fx and dx) and the archive values.
 
     :param target_data: Data frame of the target fx and dx values.
-    :param archive_data: Data frame of the archive fx and dx values.
+    :param archive_data: Data frame of the archive fx and dx values, or a prebuilt
+        ArchiveIndex of the archive to skip the archive preprocessing.
     :param tol: Tolerance for the neighborhood of matching. Defaults to 0 degC,
         meaning only the nearest-neighbor is returned. Must be a float.
     :param drop_hist_duplicates: Determines whether to consider historical values
         across SSP scenarios as duplicates (True) and drop all but one from matching,
         or to consider them as distinct points for matching (False). Defaults to True.
     :type drop_hist_duplicates: bool
+    :param method: The matching engine to use, 'kdtree' (default) to find the
+        neighborhoods with a KD-tree, 'batch' to calculate all of the target by archive
+        distances with array operations in memory bounded tiles, or 'scan' to compare
+        every target window against the entire archive with `internal_dist`. All of them
+        return the same matches.
+    :type method: str
+    :param max_memory: The approximate memory ceiling in bytes of a single tile of
+        distances when method='batch'. Defaults to 128 MiB.
+    :type max_memory: int
+    :param n_workers: The number of processes to match with. When greater than 1 the
+        target windows are partitioned by target trajectory (variable, experiment,
+        ensemble, model) and matched in a process pool against a shared memory-mapped
+        copy of the archive, with the 'kdtree' or 'batch' method. Defaults to None,
+        matching in the current process.
+    :type n_workers: int
+    :param metric: The distance metric in (fx, windowsize*dx) space. Defaults to None,
+        the Euclidean distance. Can be a pair of (fx, dx) weights, a 2x2 scaling matrix
+        S giving the Mahalanobis-style distance with matrix S'S, or a dictionary mapping
+        target experiments to either (experiments not in it use the Euclidean distance).
+        The metric rescales the matching coordinates, dist_l2 is the distance under the
+        metric while dist_fx and dist_dx stay unweighted. Not available with method='scan'.
     :return: Data frame with the target data and the corresponding matched archive data.
     """
     # Check the inputs of the functions
     if util.nrow(target_data) <= 0:
         raise TypeError("target_data is an empty data frame")
-    if util.nrow(archive_data) <= 0:
-        raise TypeError("archive_data is an empty data frame")
-    util.check_columns(
-        archive_data,
-        {"experiment", "variable", "ensemble", "start_yr", "end_yr", "fx", "dx"},
+    # An ArchiveIndex has already been checked when it was built.
+    if not isinstance(archive_data, ArchiveIndex):
+        if util.nrow(archive_data) <= 0:
+            raise TypeError("archive_data is an empty data frame")
+        util.check_columns(
+            archive_data,
+            {"experiment", "variable", "ensemble", "start_yr", "end_yr", "fx", "dx"},
+        )
+    util.check_columns(target_data, set(TARGET_COLUMNS))
+    if method not in ["kdtree", "batch", "scan"]:
+        raise TypeError("match_neighborhood: does not recognize the method input.")
+    if n_workers is not None and not (type(n_workers) is int and n_workers >= 1):
+        raise TypeError("n_workers: must be a positive integer")
+    if method == "scan" and n_workers is not None and n_workers > 1:
+        raise TypeError("n_workers: the scan method can only be run in one process")
+    if metric is not None:
+        if method == "scan":
+            raise TypeError("metric: is not available with the scan method")
+        for value in metric.values() if isinstance(metric, dict) else [metric]:
+            metric_matrix(value)
+
+    # Identical target windows would only produce identical matches.
+    target_data = target_data.drop_duplicates(subset=TARGET_COLUMNS).reset_index(
+        drop=True
     )
-    util.check_columns(target_data, {"start_yr", "end_yr", "fx", "dx"})
-
-    archive_data = archive_data.reset_index(drop=True).copy()
 
     # For every entry in the target data frame find its nearest neighbor from the archive data.
-    # concatenate the results into a single data frame.
-    rslt = map(
-        lambda fx, dx: internal_dist(fx, dx, archivedata=archive_data, tol=tol),
-        target_data["fx"],
-        target_data["dx"],
+    # Every engine returns the target row, archive row and distances of the matched pairs.
+    if method == "scan":
+        if isinstance(archive_data, ArchiveIndex):
+            archive_frame = archive_data.data
+        else:
+            archive_data = archive_data.reset_index(drop=True).copy()
+            archive_frame = archive_data
+        rslt = list(
+            map(
+                lambda fx, dx: internal_dist(
+                    fx, dx, archivedata=archive_frame, tol=tol
+                ),
+                target_data["fx"],
+                target_data["dx"],
+            )
+        )
+        matched = pd.concat(rslt)
+        target_idx = np.repeat(np.arange(len(rslt)), [util.nrow(x) for x in rslt])
+        archive_idx = matched.index.to_numpy()
+        dist_dx = matched["dist_dx"].to_numpy()
+        dist_fx = matched["dist_fx"].to_numpy()
+        dist_l2 = matched["dist_l2"].to_numpy()
+    else:
+        index = as_archive_index(archive_data)
+        archive_data = index
+        target_idx, archive_idx, dist_dx, dist_fx, dist_l2 = query_pairs(
+            target_data,
+            index,
+            tol=tol,
+            method=method,
+            max_memory=max_memory,
+            n_workers=n_workers,
+            metric=metric,
+        )
+
+    return finish_matches(
+        target_data,
+        archive_data,
+        [target_idx, archive_idx, dist_dx, dist_fx, dist_l2],
+        drop_hist_duplicates,
     )
-    matched = pd.concat(list(rslt))
-
-    # Now add the information about the matches to the target data
-    # Make sure it is clear which columns contain  data that comes from the target compared
-    # to which ones correspond to the archive information.
-    #
-    # Make a copy of the target data to work with and use in creating the output matched data frame,
-    # so that this function doesn't change the column names of one of its arguments.
-    target_data_copied = target_data.copy()
-    target_data_copied.columns = "target_" + target_data_copied.columns
-
-    out = matched.merge(target_data_copied, how="left", on=["target_fx", "target_dx"])
-    cols_to_keep = [
-        "target_variable",
-        "target_experiment",
-        "target_ensemble",
-        "target_model",
-        "target_start_yr",
-        "target_end_yr",
-        "target_year",
-        "target_fx",
-        "target_dx",
-        "archive_experiment",
-        "archive_variable",
-        "archive_model",
-        "archive_ensemble",
-        "archive_start_yr",
-        "archive_end_yr",
-        "archive_year",
-        "archive_fx",
-        "archive_dx",
-        "dist_dx",
-        "dist_fx",
-        "dist_l2",
-    ]
-    out = out[cols_to_keep].drop_duplicates()
+
+
+# Internal fx
+def finish_matches(target_data, archive_data, pairs, drop_hist_duplicates: bool = True):
+    """
+    Build the results of match_neighborhood from the matched pairs.
+
+    :param target_data: Data frame of the target fx and dx values, without duplicates.
+    :param archive_data: Data frame of the archive fx and dx values, or its ArchiveIndex.
+    :param pairs: The matched pairs, see `ArchiveIndex.query`.
+    :param drop_hist_duplicates: Whether to drop the false historical duplicates.
+    :type drop_hist_duplicates: bool
+    :return: Data frame with the target data and the corresponding matched archive data.
+    """
+    # Identical archive windows would only produce identical matches, keep the first.
+    # An ArchiveIndex flagged them when it was built.
+    if isinstance(archive_data, ArchiveIndex):
+        duplicated = archive_data.duplicated
+        archive_data = archive_data.data
+    else:
+        duplicated = archive_data.duplicated(subset=ARCHIVE_COLUMNS).to_numpy()
+    if duplicated.any():
+        keep = ~duplicated[pairs[1]]
+        pairs = [np.asarray(values)[keep] for values in pairs]
+
+    # Now add the information about the matches to the target data by their row
+    # positions. Make sure it is clear which columns contain data that comes from the
+    # target compared to which ones correspond to the archive information.
+    out = gather_matches(target_data, archive_data, *pairs)
 
     if drop_hist_duplicates:
         out = drop_hist_false_duplicates(out)
 
     # if there are any nearest neighbor matches that are maybe still large,
     # warn the user that they will want to validate the outcome.
-
-    # get the nearest neighbor match only for each target window
-    grouped = out.groupby(
-        [
-            "target_variable",
-            "target_experiment",
-            "target_ensemble",
-            "target_model",
-            "target_start_yr",
-            "target_end_yr",
-            "target_year",
-            "target_fx",
-            "target_dx",
-        ]
-    )
-    formatted_nn = pd.DataFrame()
-    for name, group in grouped:
-        df = group.copy()
-        df = df[df["dist_l2"] == np.min(df["dist_l2"])].copy()
-        formatted_nn = pd.concat([formatted_nn, df]).reset_index(drop=True)
-        del df
-
-    # subset to just the far away nearest neighbors
-    formatted_nn = (
-        formatted_nn[formatted_nn["dist_l2"] > 0.25].reset_index(drop=True).copy()
-    )
-
+    formatted_nn = far_neighbors(out, threshold=FAR_NEIGHBOR_THRESHOLD)
     if not formatted_nn.empty:
-        print("The following target windows have a nearest neighbor in T, dT space")
-        print("that is more than 0.25degC away. This may or may not result in poor")
-        print("matches and we recommend validation.")
-        print(formatted_nn)
-        print(
-            "-----------------------------------------------------------------------------------------"
+        logger.warning(
+            "The following target windows have a nearest neighbor in T, dT space\n"
+            "that is more than %sdegC away. This may or may not result in poor\n"
+            "matches and we recommend validation.\n%s",
+            FAR_NEIGHBOR_THRESHOLD,
+            formatted_nn,
         )
-    del formatted_nn
-    del grouped
 
     return out
+
+
+def update_matches(
+    matched_data,
+    archive_data,
+    added=None,
+    removed=None,
+    tol: float = 0,
+    drop_hist_duplicates: bool = True,
+    method: str = "kdtree",
+    n_workers: int = None,
+    metric=None,
+):
+    """
+    Update the results of match_neighborhood for a set of changed target windows.
+
+    Every target window is matched independently of the others, so when a target is
+    extended or revised only the added or changed windows have to be matched against
+    the archive again. A target window is identified by its variable, experiment,
+    ensemble, model, start_yr, end_yr and year; the matches of an added window that
+    is already in matched_data replace its previous matches.
+
+    :param matched_data: Data frame returned from match_neighborhood.
+    :param archive_data: Data frame of the archive fx and dx values or an ArchiveIndex,
+        the archive matched_data was matched against.
+    :param added: Data frame of the new or changed target windows, with the target_data
+        columns of match_neighborhood. Defaults to None.
+    :param removed: Data frame with the variable, experiment, ensemble, model,
+        start_yr, end_yr and year of the target windows to remove. Defaults to None.
+    :param tol: Tolerance for the neighborhood of matching, as in match_neighborhood.
+        It should be the tol matched_data was created with.
+    :param drop_hist_duplicates: Passed on to match_neighborhood. Defaults to True.
+    :type drop_hist_duplicates: bool
+    :param method: Passed on to match_neighborhood. Defaults to 'kdtree'.
+    :type method: str
+    :param n_workers: Passed on to match_neighborhood. Defaults to None.
+    :type n_workers: int
+    :param metric: Passed on to match_neighborhood. Defaults to None.
+    :return: A list with two entries: the updated matched data, which has the same rows
+             as rerunning match_neighborhood on the updated target, sorted by
+             target_year, and a data frame of the matches that were removed or added,
+             with a change column of 'removed' or 'added'.
+    """
+    window_cols = [
+        "variable",
+        "experiment",
+        "ensemble",
+        "model",
+        "start_yr",
+        "end_yr",
+        "year",
+    ]
+    target_window_cols = ["target_" + c for c in window_cols]
+    util.check_columns(matched_data, set(target_window_cols))
+
+    # Collect the windows whose previous matches no longer hold.
+    changed = []
+    if added is not None and util.nrow(added) > 0:
+        util.check_columns(added, set(TARGET_COLUMNS))
+        changed.append(added[window_cols])
+    if removed is not None and util.nrow(removed) > 0:
+        util.check_columns(removed, set(window_cols))
+        changed.append(removed[window_cols])
+    if len(changed) > 0:
+        changed = pd.MultiIndex.from_frame(pd.concat(changed))
+        drop = pd.MultiIndex.from_frame(matched_data[target_window_cols]).isin(changed)
+    else:
+        drop = np.zeros(util.nrow(matched_data), dtype=bool)
+
+    dropped = matched_data.loc[drop]
+    if added is not None and util.nrow(added) > 0:
+        new = match_neighborhood(
+            added,
+            archive_data,
+            tol=tol,
+            drop_hist_duplicates=drop_hist_duplicates,
+            method=method,
+            n_workers=n_workers,
+            metric=metric,
+        )
+    else:
+        new = matched_data.iloc[0:0]
+
+    out = pd.concat([matched_data.loc[~drop], new])
+    out = out.sort_values("target_year", kind="stable").reset_index(drop=True)
+
+    # Matches of a changed window that were found again are not part of the diff.
+    diff = pd.concat(
+        [dropped.assign(change="removed"), new.assign(change="added")]
+    ).reset_index(drop=True)
+    diff = diff.loc[
+        ~diff.duplicated(subset=list(matched_data.columns), keep=False)
+    ].reset_index(drop=True)
+
+    return [out, diff]
@@ -1,13 +1,64 @@
 """Collection of helper functions for generating permutations of recipes and reformatting for stitching."""
 
-import os
-from importlib import resources
+import functools
+import logging
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import maximum_flow
 
 import stitches.fx_match as match
 import stitches.fx_util as util
+from stitches.fx_catalog import pangeo_catalog
+from stitches.fx_index import ArchiveIndex, as_archive_index
+
+logger = logging.getLogger(__name__)
+
+# The columns compared to decide whether a recipe was already drawn.
+FINGERPRINT_COLUMNS = [
+    "target_variable",
+    "target_experiment",
+    "target_model",
+    "target_start_yr",
+    "target_end_yr",
+    "archive_experiment",
+    "archive_variable",
+    "archive_model",
+    "archive_ensemble",
+    "archive_start_yr",
+    "archive_end_yr",
+]
+
+# The columns of a recipe after its transition and final periods are handled.
+GRIDDED_RECIPE_COLUMNS = [
+    "target_start_yr",
+    "target_end_yr",
+    "archive_experiment",
+    "archive_variable",
+    "archive_model",
+    "archive_ensemble",
+    "stitching_id",
+    "archive_start_yr",
+    "archive_end_yr",
+]
+
+# The make_recipe arguments a job of make_recipes_batch can set and their defaults.
+BATCH_JOB_DEFAULTS = {
+    "target_data": None,
+    "N_matches": None,
+    "res": "mon",
+    "tol": 0.1,
+    "non_tas_variables": None,
+    "reproducible": False,
+    "seed": None,
+    "recipe_method": "sample",
+}
+
+# The recipe drawing arguments shared by the recipe worker processes.
+worker_recipe_args = None
 
 
 def get_num_perms(matched_data):
@@ -20,8 +71,9 @@ def get_num_perms(matched_data):
     of how many matches are in each period of the target data.
 
     :param matched_data: The data output from match_neighborhood.
-    :return: A list with two entries: the total number of potential permutations, and
-             a dataframe with the breakdown of matches per period.
+    :return: A list with two entries: the total number of potential permutations (as
+             totalNumPerms and its base 10 logarithm, log10TotalNumPerms, which does not
+             overflow), and a dataframe with the breakdown of matches per period.
     """
     # Check inputs
     util.check_columns(
@@ -73,13 +125,122 @@ def get_num_perms(matched_data):
         .prod()
         .reset_index(name="totalNumPerms")
     )
-    dat_count_merge = dat_min.merge(dat_prod)
+    # The product overflows int64 for long trajectories with many matches, so it is
+    # also reported in log space.
+    dat_log = (
+        dat_count.assign(log10TotalNumPerms=np.log10(dat_count["n_matches"]))
+        .groupby(
+            ["target_variable", "target_experiment", "target_ensemble", "target_model"]
+        )["log10TotalNumPerms"]
+        .sum()
+        .reset_index()
+    )
+    dat_count_merge = dat_min.merge(dat_prod).merge(dat_log)
 
     out = [dat_count_merge, dat_count]
     return out
 
 
-def remove_duplicates(md, archive):
+def tolerance_sweep(
+    target_data,
+    archive_data,
+    tols,
+    drop_hist_duplicates: bool = True,
+    metric=None,
+):
+    """
+    Summarize the matches of the target data for a range of matching tolerances at once.
+
+    The target data is matched to the archive only once, with the largest tolerance, and
+    the number of matches of every target window for each of the smaller tolerances is
+    counted from the distances to the nearest neighbor. This gives the same counts as
+    running `get_num_perms(match_neighborhood(target_data, archive_data, tol))` for every
+    tolerance, so it can be used to choose tol before calling make_recipe.
+
+    :param target_data: A data frame of the target fx and dx values.
+    :param archive_data: A data frame of the archive fx and dx values or an ArchiveIndex.
+    :param tols: List of the tolerances to summarize.
+    :param drop_hist_duplicates: Passed on to match_neighborhood. Defaults to True.
+    :type drop_hist_duplicates: bool
+    :param metric: The distance metric, passed on to match_neighborhood. Defaults to None.
+    :return: A list with two entries, like get_num_perms: a data frame with the
+             minNumMatches, totalNumPerms, log10TotalNumPerms and maxNumRecipes (the
+             number of collapse free recipes the target trajectory can support, see
+             max_disjoint_recipes) of every target trajectory for each tol, and
+             a data frame with the number of matches of every target window for each tol.
+    """
+    tols = sorted(set(tols))
+    if len(tols) == 0:
+        raise TypeError("tols: must contain at least one tolerance")
+    if min(tols) < 0:
+        raise TypeError("tols: must be non-negative")
+
+    matched = match.match_neighborhood(
+        target_data,
+        archive_data,
+        tol=max(tols),
+        drop_hist_duplicates=drop_hist_duplicates,
+        metric=metric,
+    ).drop_duplicates()
+
+    window_cols = [
+        "target_variable",
+        "target_experiment",
+        "target_ensemble",
+        "target_model",
+        "target_start_yr",
+        "target_end_yr",
+        "target_year",
+        "target_fx",
+        "target_dx",
+    ]
+    grouped = matched.groupby(window_cols)
+    windows = grouped.size().reset_index()[window_cols]
+    group_id = grouped.ngroup().to_numpy()
+    dist_l2 = matched["dist_l2"].to_numpy()
+    min_dist = grouped["dist_l2"].transform("min").to_numpy()
+
+    # Count the matches within tol of the nearest neighbor of every window, and the
+    # disjoint recipes they can make.
+    dat_count = []
+    dat_max = []
+    for tol in tols:
+        within = dist_l2 <= min_dist + tol
+        dat_max.append(max_disjoint_recipes(matched.loc[within]).assign(tol=tol))
+        counts = windows.copy()
+        counts.insert(0, "tol", tol)
+        counts["n_matches"] = np.bincount(
+            group_id, weights=within, minlength=util.nrow(windows)
+        ).astype(int)
+        dat_count.append(counts)
+    dat_count = pd.concat(dat_count).sort_values(["tol", "target_year"], kind="stable")
+    dat_count = dat_count.reset_index(drop=True)
+
+    dat_summary = (
+        dat_count.assign(log10_matches=np.log10(dat_count["n_matches"]))
+        .groupby(
+            [
+                "tol",
+                "target_variable",
+                "target_experiment",
+                "target_ensemble",
+                "target_model",
+            ]
+        )
+        .agg(
+            minNumMatches=("n_matches", "min"),
+            totalNumPerms=("n_matches", "prod"),
+            log10TotalNumPerms=("log10_matches", "sum"),
+        )
+        .reset_index()
+        .merge(pd.concat(dat_max), how="left")
+    )
+
+    out = [dat_summary, dat_count]
+    return out
+
+
+def remove_duplicates(md, archive, metric=None):
     """
     Ensure each archive point in a matched recipe is unique.
 
@@ -92,7 +253,10 @@ def remove_duplicates(md, archive):
                This can be from match_neighborhood specifically returning NN, or from
                multiple matches permuted into new recipes and then split, with this
                function applied to each recipe.
-    :param archive: A data frame consisting of the tas archive for re-matching.
+    :param archive: A data frame consisting of the tas archive for re-matching, or a
+                    prebuilt ArchiveIndex of the archive.
+    :param metric: The distance metric used to re-match, see match_neighborhood. Defaults
+                   to None, the Euclidean distance.
     :return: A data frame with the same structure as the raw matched data, but with
              duplicate matches replaced.
     """
@@ -125,35 +289,23 @@ def remove_duplicates(md, archive):
 
     # As long as duplicates exist, rematch the target windows with the larger
     # dist l2 to each archive chunk, add back in, iterate to be safe.
-    # By matching on new_archive = archive - matches that were used in md,
-    # we don't introduce new duplicates when we rematch. So the while loop is
-    # probably over cautious but it does only execute one iteration.
+    # The archive windows already used in matched_data are tombstoned in the archive
+    # index, so the rematched targets can not introduce new duplicates and the index
+    # does not have to be rebuilt. So the while loop is probably over cautious but it
+    # does only execute one iteration.
+    archive_index = None
+    archive_cols = ["archive_" + col for col in ArchiveIndex.WINDOW_COLUMNS]
     while util.nrow(duplicates) > 0:
+        if archive_index is None:
+            archive_index = as_archive_index(archive)
+
         # within each iteration of checking duplicates,
         # pull out the one with smallest dist_l2 -
         # this is the one that gets to keep the archive match, and we use
         # as an index to work on the complement of (in case the same
         # archive point gets matched for more than 2 target years)
-        grouped = duplicates.groupby(
-            [
-                "archive_experiment",
-                "archive_variable",
-                "archive_model",
-                "archive_ensemble",
-                "archive_start_yr",
-                "archive_end_yr",
-                "archive_year",
-                "archive_fx",
-                "archive_dx",
-            ]
-        )
-        # Pick which of the target points will continue to be matched with the archive
-        # pair.
-        dat = []
-        for name, group in grouped:
-            min_value = min(group["dist_l2"])
-            dat.append(group.loc[group["dist_l2"] == min_value])
-        duplicates_min = pd.concat(dat)
+        min_value = duplicates.groupby(archive_cols)["dist_l2"].transform("min")
+        duplicates_min = duplicates.loc[duplicates["dist_l2"] == min_value]
 
         # target points contained in duplicates-duplicates_min
         # are the  ones that need a new archive match.
@@ -161,44 +313,36 @@ def remove_duplicates(md, archive):
         points_to_rematch = duplicates[filter_col].loc[
             (~duplicates["target_year"].isin(duplicates_min["target_year"]))
         ]
-        new_names = list(
-            map(lambda x: x.replace("target_", ""), points_to_rematch.columns)
-        )
-        points_to_rematch.columns = new_names
+        if util.nrow(points_to_rematch) <= 0:
+            raise TypeError(
+                "Target windows with the same distance to an archive window can not be de-duplicated."
+            )
+        points_to_rematch.columns = [
+            col.replace("target_", "") for col in points_to_rematch.columns
+        ]
+        points_to_rematch = points_to_rematch.drop_duplicates(
+            subset=match.TARGET_COLUMNS
+        ).reset_index(drop=True)
 
         # Because we know that none of the archive values can be reused in the match,
-        # discard the ones already used (eg in matched_data)
-        # from the updated archive that will be used in the rematching.
-        cols = [col for col in matched_data if col.startswith("archive_")]
-        rm_from_archive = matched_data[cols]
-        new_names = list(
-            map(lambda x: x.replace("archive_", ""), rm_from_archive.columns)
-        )
-        rm_from_archive.columns = new_names
-
-        # Use our anti_join utility function to return the rows of archive that are
-        # not in rm_from_archive
-        new_archive = util.anti_join(
-            archive,
-            rm_from_archive,
-            bycols=[
-                "model",
-                "experiment",
-                "variable",
-                "ensemble",
-                "start_yr",
-                "end_yr",
-                "year",
-                "fx",
-                "dx",
-            ],
-        )
+        # mark the ones already used (eg in matched_data) as used in the archive index.
+        used_windows = matched_data[archive_cols]
+        used_windows.columns = ArchiveIndex.WINDOW_COLUMNS
+        used = np.zeros(len(archive_index), dtype=bool)
+        used[archive_index.locate(used_windows)] = True
 
         # Find new matches for the data the target data that is missing the archive pair. Because we
         # are only interested in completing our singular recipe the tol must be 0.
-        rematched = match.match_neighborhood(
-            target_data=points_to_rematch, archive_data=new_archive, tol=0
+        pairs = match.query_pairs(
+            points_to_rematch,
+            archive_index,
+            tol=0,
+            method="kdtree",
+            max_memory=None,
+            metric=metric,
+            used=used,
         )
+        rematched = match.finish_matches(points_to_rematch, archive_index, pairs)
 
         # Now, we update our key data frames for the next iteration of the while loop:
         # 1. matched_data gets updated to be rematched + (previous matched_data minus the targets
@@ -218,19 +362,7 @@ def remove_duplicates(md, archive):
         )
 
         # Identify duplicates in the updated matched_data for the next iteration of the while loop
-        md_archive = matched_data[
-            [
-                "archive_experiment",
-                "archive_variable",
-                "archive_model",
-                "archive_ensemble",
-                "archive_start_yr",
-                "archive_end_yr",
-                "archive_year",
-                "archive_fx",
-                "archive_dx",
-            ]
-        ]
+        md_archive = matched_data[archive_cols]
         duplicates = matched_data.merge(
             md_archive[md_archive.duplicated()], how="inner"
         )
@@ -239,7 +371,6 @@ def remove_duplicates(md, archive):
         del (
             duplicates_min,
             points_to_rematch,
-            rm_from_archive,
             rematched,
             matched_data_minus_rematched_targ_years,
         )
@@ -247,8 +378,796 @@ def remove_duplicates(md, archive):
     return matched_data
 
 
+@functools.lru_cache(maxsize=None)
+def testing_draw(n: int):
+    """
+    Return the position drawn from n candidates in testing mode.
+
+    This is the position `DataFrame.sample(1, random_state=1)` draws from n rows.
+
+    :param n: The number of candidates.
+    :type n: int
+    :return: The position of the drawn candidate.
+    """
+    return np.random.RandomState(1).choice(n, 1, replace=False)[0]
+
+
+# Internal fx
+def target_generators(seed, n: int):
+    """
+    Derive independent random number generators for the target ensemble members.
+
+    The generators are spawned from a single SeedSequence, so the draws for a target
+    do not depend on which of the other targets are drawn or in what order.
+
+    :param seed: None, an int, a np.random.SeedSequence or a np.random.Generator, which
+                 seeds the SeedSequence with numbers drawn from it.
+    :param n: The number of target ensemble members.
+    :type n: int
+    :return: A list of n np.random.Generator, or of n None when seed is None.
+    """
+    if seed is None:
+        return [None] * n
+    if isinstance(seed, np.random.Generator):
+        seed = np.random.SeedSequence(seed.integers(2**32, size=4))
+    elif isinstance(seed, (int, np.integer)) and not isinstance(seed, bool):
+        seed = np.random.SeedSequence(int(seed))
+    elif not isinstance(seed, np.random.SeedSequence):
+        raise TypeError(
+            "seed: must be None, an int, a np.random.SeedSequence or a np.random.Generator"
+        )
+
+    return [np.random.default_rng(child) for child in seed.spawn(n)]
+
+
+class RecipeSampler:
+    """
+    Array backed sampler of candidate recipes from matched data.
+
+    The matches are sorted by target window so that the candidates of every window are
+    a contiguous range of a candidate array, given by CSR style offsets. The candidates
+    left in a window are kept at the front of its range in their original order and
+    counted, so drawing one candidate for every window of a target is a single random
+    number call and the bookkeeping of a used recipe only touches the windows it used.
+
+    :param matched_data: Data output from `match_neighborhood`, without duplicate rows
+                         and with a default integer index.
+    """
+
+    # A target window, the candidates of a window are drawn from together.
+    WINDOW_COLUMNS = [
+        "target_variable",
+        "target_experiment",
+        "target_ensemble",
+        "target_model",
+        "target_start_yr",
+        "target_end_yr",
+    ]
+
+    # The (target window, archive window) pair of a candidate, a pair that was used in
+    # a recipe can not be used again by any target.
+    PAIR_COLUMNS = [
+        "target_year",
+        "target_start_yr",
+        "target_end_yr",
+        "archive_experiment",
+        "archive_variable",
+        "archive_model",
+        "archive_ensemble",
+        "archive_start_yr",
+        "archive_end_yr",
+        "archive_year",
+    ]
+
+    def __init__(self, matched_data):
+        """
+        Build the candidate arrays from the matched data.
+
+        :param matched_data: Data output from `match_neighborhood`.
+        """
+        # The windows are numbered in sorted order and the candidates of a window keep
+        # their matched data row order.
+        window_id = matched_data.groupby(RecipeSampler.WINDOW_COLUMNS).ngroup()
+        window_id = window_id.to_numpy()
+        self.rows = np.argsort(window_id, kind="stable")
+        self.window_id = window_id[self.rows]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(window_id))])
+        self.windows = matched_data[RecipeSampler.WINDOW_COLUMNS].take(
+            self.rows[self.offsets[:-1]]
+        )
+
+        # The candidates left in each window and their number.
+        self.left = np.arange(len(self.rows))
+        self.n_left = np.diff(self.offsets)
+        self.alive = np.ones(len(self.rows), dtype=bool)
+
+        # The candidates of every (target window, archive window) pair, also in CSR form.
+        pairs = matched_data.groupby(RecipeSampler.PAIR_COLUMNS)
+        pair_id = pairs.ngroup().to_numpy()[self.rows]
+        self.pair_keys = pairs.size().index
+        self.pair_candidates = np.argsort(pair_id, kind="stable")
+        self.pair_offsets = np.concatenate([[0], np.cumsum(np.bincount(pair_id))])
+
+    def target_windows(self, variable, experiment, model, ensemble):
+        """
+        Return the windows of a target trajectory.
+
+        :param variable: The target variable.
+        :param experiment: The target experiment.
+        :param model: The target model.
+        :param ensemble: The target ensemble member.
+        :return: Array of the window numbers.
+        """
+        return np.flatnonzero(
+            (self.windows["target_variable"] == variable).to_numpy()
+            & (self.windows["target_experiment"] == experiment).to_numpy()
+            & (self.windows["target_model"] == model).to_numpy()
+            & (self.windows["target_ensemble"] == ensemble).to_numpy()
+        )
+
+    def counts(self, windows):
+        """
+        Return the number of candidates left in windows.
+
+        :param windows: Array of window numbers.
+        :return: Array of the number of candidates that have not been used.
+        """
+        return self.n_left[windows]
+
+    def draw(self, windows, testing: bool = False, rng=None):
+        """
+        Draw one of the candidates left in every window.
+
+        :param windows: Array of window numbers, every window must have candidates left.
+        :param testing: When True, draw like `DataFrame.sample(1, random_state=1)` would
+                        from the candidates of each window. Defaults to False.
+        :type testing: bool
+        :param rng: The np.random.Generator to draw with; defaults to None, drawing from
+                    the global NumPy random state.
+        :return: Array of the matched data rows drawn, in window order.
+        """
+        counts = self.n_left[windows]
+        if testing:
+            draw = np.array([testing_draw(n) for n in counts], dtype=int)
+        elif rng is not None:
+            draw = (rng.random(len(windows)) * counts).astype(int)
+        else:
+            draw = (np.random.random_sample(len(windows)) * counts).astype(int)
+
+        return self.rows[self.left[self.offsets[windows] + draw]]
+
+    def remove(self, recipe):
+        """
+        Mark the (target window, archive window) pairs of a recipe as used.
+
+        :param recipe: Data frame of a recipe.
+        """
+        pair = self.pair_keys.get_indexer(
+            pd.MultiIndex.from_frame(recipe[RecipeSampler.PAIR_COLUMNS])
+        )
+        for p in pair[pair >= 0]:
+            for candidate in self.pair_candidates[
+                self.pair_offsets[p] : self.pair_offsets[p + 1]
+            ]:
+                if not self.alive[candidate]:
+                    continue
+                self.alive[candidate] = False
+
+                # Close the gap the candidate leaves among the candidates left in its
+                # window, keeping their order.
+                window = self.window_id[candidate]
+                start = self.offsets[window]
+                end = start + self.n_left[window]
+                pos = start + np.searchsorted(self.left[start:end], candidate)
+                self.left[pos : end - 1] = self.left[pos + 1 : end]
+                self.n_left[window] -= 1
+
+
+# Internal fx
+def recipe_fingerprint(recipe):
+    """
+    Return the fingerprint of a recipe, the rows of its compared columns in order.
+
+    :param recipe: Data frame of a single recipe.
+    :return: A tuple of row tuples that can be stored in a set.
+    """
+    return tuple(recipe[FINGERPRINT_COLUMNS].itertuples(index=False, name=None))
+
+
+# Internal fx
+def draw_recipes(
+    sampler,
+    matched_data,
+    windows,
+    N_matches: int,
+    archive,
+    exp,
+    ens,
+    num_target_windows: int,
+    target_start_yrs,
+    recipe_fingerprints,
+    testing: bool = False,
+    metric=None,
+    rng=None,
+):
+    """
+    Draw the stitching recipes of a single target ensemble member.
+
+    :param sampler: The RecipeSampler of the matched data, the candidates used by the
+                    drawn recipes are removed from it.
+    :param matched_data: The matched data the sampler was built from.
+    :param windows: Array of the sampler window numbers of the target.
+    :param N_matches: The maximum number of recipes to draw.
+    :type N_matches: int
+    :param archive: The archive data to use for re-matching duplicate points.
+    :param exp: The target experiment.
+    :param ens: The target ensemble member.
+    :param num_target_windows: The number of windows of a complete recipe.
+    :type num_target_windows: int
+    :param target_start_yrs: Set of the target window start years.
+    :param recipe_fingerprints: Set of the fingerprints of the recipes drawn before, the
+                                fingerprints of the drawn recipes are added to it.
+    :param testing: Draw like `DataFrame.sample(1, random_state=1)`, see RecipeSampler.draw.
+    :type testing: bool
+    :param metric: The distance metric used to re-match duplicate points.
+    :param rng: The np.random.Generator to draw with, or None.
+    :return: A list with four entries: a data frame of the recipes, the number of
+             draws rejected because they were drawn before, whether the candidates of a
+             target window ran out, and a data frame of the candidates drawn for the
+             recipes before their duplicates were re-matched.
+    """
+    # While the following conditions are met continue to generate new recipes.
+    # 1. While we have fewer matches than requested for the target ensemble_member,
+    #    keep going.
+    # 2. Make sure there are at least num_target_windows of time windows with
+    #    candidates left for the target ensemble member in this loop: basically
+    #    make sure there is at least one remaining archive match to draw from for
+    #    each target window in this target ensemble.
+    #
+    # Initialize these conditions, so we enter the while loop, then update again at the
+    # end of each iteration:
+    recipes_col_by_target = pd.DataFrame()
+    drawn = []
+    if util.nrow(recipes_col_by_target) == 0:
+        condition1 = True
+    elif util.nrow(recipes_col_by_target["stitching_id"].unique()) < N_matches:
+        condition1 = True
+    else:
+        condition1 = False
+
+    perm_rows = np.count_nonzero(sampler.counts(windows))
+
+    if perm_rows == num_target_windows:
+        condition2 = True
+    else:
+        condition2 = False
+
+    # And an integer index to initialize the count of stitched
+    # trajectories for each target
+    stitch_ind = 1
+
+    # The number of drawn recipes rejected because they were drawn before.
+    n_rejected = 0
+
+    # Run the while loop!
+    while all([condition1, condition2]):
+        # Right now a single target chunk may have multiple matches with archive points. The
+        # next several steps of the while loop will create a one to one paring between the
+        # target and archive data, then check to make sure that the pairing meets the requirements
+        # for what we call a recipe.
+
+        # For each target window,
+        # Randomly select one of the archive matches left to use.
+        # This creates one_one_match, a candidate recipe.
+        one_one_match = matched_data.take(
+            sampler.draw(windows, testing=testing, rng=rng)
+        )
+        one_one_match = one_one_match.reset_index(drop=True).copy()
+
+        # Before we can accept our candidate recipe, one_one_match,
+        # we run it through a lot of tests.
+
+        # Force one_one_match to meet our first condition,
+        # that each archive data point in the recipe must be unique.
+        # Then give it a stitching id
+        new_recipe = []
+        new_recipe = remove_duplicates(one_one_match, archive, metric=metric)
+        stitching_id = exp + "~" + ens + "~" + str(stitch_ind)
+        new_recipe["stitching_id"] = stitching_id
+        new_recipe = new_recipe.reset_index(drop=True).copy()
+
+        # Make sure the new recipe isn't missing any years:
+        if ~new_recipe.shape[0] == num_target_windows:
+            raise TypeError("problem: the new single recipe is missing years of data!")
+        #  Make sure that no changes were made to the target years.
+        if sum(~new_recipe["target_start_yr"].isin(target_start_yrs)) > 0:
+            raise TypeError("problem the new single recipe target years!")
+
+        # Compare the new_recipe to the previously drawn recipes across all target
+        # ensembles.
+        # There is no collapse within each target ensemble because  we remove the constructed
+        # new_recipe from the matched_data at the end of each iteration of the while loop -
+        # The sampled points CAN'T be used again for the current target ensemble member
+        # for loop iteration, or for any other target ensemble members. Meaning we
+        # avoid envelope collapse when targeting multiple realizations (you don't have
+        # realization 1 and realization 4 2070 getting matched to the same archive point.
+        # The code below is checking to make sure that our new_recipe doesn't exist
+        # in the saved recipe_collection. This shouldn't be possible with how we update
+        # our sampler on every loop, but just to be cautious, we check.
+        # Again, the challenge is seeing if our entire sample has
+        # been included in recipes before, not just a row or two.
+
+        # Every accepted recipe is recorded by its fingerprint, the rows of the
+        # compared columns in target year order, so a new recipe is checked against
+        # all of the existing recipes with a single set lookup.
+        fingerprint = recipe_fingerprint(new_recipe)
+
+        # If the new_recipe is not unique (aka, its fingerprint was seen before), then
+        # we don't want it and we don't want to do anything else in this iteration of
+        # the while loop. We DON'T update the sampler or conditions, so the
+        # while loop is forced to re-run so that another random draw is done to create
+        # a new candidate new_recipe.
+        # Otherwise we are safe to keep new_recipe and update all the data frames
+        # for the next iteration of the while loop.
+        if fingerprint in recipe_fingerprints:
+            n_rejected += 1
+        else:
+            recipe_fingerprints.add(fingerprint)
+
+            # add new_recipe to the list of recipes for this target ensemble
+            recipes_col_by_target = pd.concat([recipes_col_by_target, new_recipe])
+            drawn.append(one_one_match.assign(stitching_id=stitching_id))
+
+            # And we mark it as used in the sampler so the archive
+            # values used in this new_recipe can't be used to construct
+            # subsequent realizations for this target ensemble member.
+            # Since we are removing the constructed new_recipe from the
+            # candidates at the end of each iteration of the while loop,
+            # the sample points can't be randomly drawn again for the next
+            # generated trajectory of the current target ensemble member
+            # for loop iteration.
+
+            # Now each (target_window, archive_window) combination must
+            # be removed from matched data for all target ensemble members,
+            # not just the one we are currently operating on.
+            # This ensures that we don't get collapse in the generated
+            # envelope across target ensemble members (e.g you don't
+            # have realization 1 and realization 4 2070 getting matched
+            # to the same archive point).
+            sampler.remove(new_recipe)
+
+            # Use the updated candidate counts to update
+            # the while loop conditions:
+
+            # Condition 1:
+            # If we haven't reached the N_matches goal for this target ensemble
+            if util.nrow(recipes_col_by_target) == 0:
+                condition1 = True
+            elif util.nrow(recipes_col_by_target["stitching_id"].unique()) < N_matches:
+                condition1 = True
+            else:
+                condition1 = False
+            # end updating Condition 1
+
+            # Condition 2:
+            # make sure each target window has at least one archive match available
+            # to draw on the next iteration. That way, we don't try to construct a
+            # trajectory with fewer years than the targets.
+            perm_rows = np.count_nonzero(sampler.counts(windows))
+
+            if perm_rows == num_target_windows:
+                condition2 = True
+            else:
+                condition2 = False
+            # end updating condition 2
+
+            # Add to the stitch_ind, to update the count of stitched
+            # trajectories for each target ensemble member.
+            stitch_ind += 1
+
+        # end if statement
+    # end the while loop for this target ensemble member
+
+    drawn = pd.concat(drawn) if len(drawn) > 0 else pd.DataFrame()
+    out = [recipes_col_by_target, n_rejected, not condition2, drawn]
+    return out
+
+
+# Internal fx
+def recipe_draw_args(archive, metric, testing, num_target_windows, target_start_yrs):
+    """
+    Return the arguments of draw_target_recipes shared by all of the targets.
+
+    :param archive: The archive data to use for re-matching duplicate points.
+    :param metric: The distance metric used to re-match duplicate points.
+    :param testing: Whether to draw in testing mode.
+    :param num_target_windows: The number of windows of a complete recipe.
+    :param target_start_yrs: Set of the target window start years.
+    :return: A dictionary of the arguments.
+    """
+    out = {
+        "archive": as_archive_index(archive),
+        "metric": metric,
+        "testing": testing,
+        "num_target_windows": num_target_windows,
+        "target_start_yrs": target_start_yrs,
+    }
+    return out
+
+
+def init_recipe_worker(archive, metric, testing, num_target_windows, target_start_yrs):
+    """
+    Set up a recipe worker process with the arguments shared by all of the targets.
+
+    :param archive: The archive data to use for re-matching duplicate points.
+    :param metric: The distance metric used to re-match duplicate points.
+    :param testing: Whether to draw in testing mode.
+    :param num_target_windows: The number of windows of a complete recipe.
+    :param target_start_yrs: Set of the target window start years.
+    """
+    global worker_recipe_args
+    worker_recipe_args = recipe_draw_args(
+        archive, metric, testing, num_target_windows, target_start_yrs
+    )
+
+
+# Internal fx
+def draw_target_recipes(
+    matched_data, claimed, N_matches, exp, ens, rng, draw_args=None
+):
+    """
+    Draw the recipes of a single target ensemble member.
+
+    :param matched_data: The matched data of the target, with a default integer index.
+    :param claimed: Data frame of the (target window, archive window) pairs used by
+                    recipes that were already accepted, or None.
+    :param N_matches: The maximum number of recipes to draw.
+    :param exp: The target experiment.
+    :param ens: The target ensemble member.
+    :param rng: The np.random.Generator of the target, or None.
+    :param draw_args: The shared arguments, see recipe_draw_args. Defaults to None, the
+                      arguments the recipe worker process was set up with.
+    :return: The output of `draw_recipes` and the generator after drawing.
+    """
+    if draw_args is None:
+        draw_args = worker_recipe_args
+
+    sampler = RecipeSampler(matched_data)
+    if claimed is not None:
+        sampler.remove(claimed)
+
+    out = draw_recipes(
+        sampler,
+        matched_data,
+        np.arange(util.nrow(sampler.windows)),
+        N_matches,
+        draw_args["archive"],
+        exp,
+        ens,
+        draw_args["num_target_windows"],
+        draw_args["target_start_yrs"],
+        set(),
+        testing=draw_args["testing"],
+        metric=draw_args["metric"],
+        rng=rng,
+    )
+    return out + [rng]
+
+
+# Internal fx
+def reconcile_recipes(
+    matched_data, targets, generators, N_matches: int, draw_args, executor=None
+):
+    """
+    Draw the recipes of the target ensemble members in rounds, reconciled in target order.
+
+    In every round, each target draws its recipes from its own candidates, either in this
+    process or in the worker processes of an executor. The drawn recipes are then
+    reconciled in the order of the targets: a recipe drawn with a (target window, archive
+    window) pair already used by an accepted recipe of another target, or that repeats
+    one, is rejected, just like the pairs would have been removed from the candidates when
+    drawing the targets one after another. The targets missing recipes draw again from the
+    candidates that are left in another round, until a round does not add any recipe.
+
+    The recipes only depend on the random streams of the targets, not on where the
+    targets are drawn, so drawing them in a process pool gives the same recipes as
+    drawing them in this process.
+
+    :param matched_data: The matched data, without duplicates and with a default index.
+    :param targets: Data frame of the targets in the order they are reconciled in, with
+                    the index of their generator, see plan_recipes.
+    :param generators: List of the np.random.Generator of every target, or of None.
+    :param N_matches: The maximum number of recipes per target.
+    :type N_matches: int
+    :param draw_args: The arguments shared by the targets, see recipe_draw_args.
+    :param executor: Optional concurrent.futures executor whose workers were set up by
+                     init_recipe_worker with the same arguments. Defaults to None, drawing
+                     the targets in this process.
+    :return: A generator of the recipes, a data frame per recipe, in target order. The
+             recipes of a target are generated as soon as it stops drawing, so the
+             recipes of the first target are available after the first round.
+    """
+    n_targets = util.nrow(targets)
+    target_data = []
+    for _, target in targets.iterrows():
+        target_data.append(
+            matched_data.loc[
+                (matched_data["target_variable"] == target["target_variable"])
+                & (matched_data["target_experiment"] == target["target_experiment"])
+                & (matched_data["target_model"] == target["target_model"])
+                & (matched_data["target_ensemble"] == target["target_ensemble"])
+            ].reset_index(drop=True)
+        )
+    exps = list(targets["target_experiment"])
+    enss = list(targets["target_ensemble"])
+    rngs = [generators[i] for i in targets["index"]]
+
+    if executor is None:
+        draw = functools.partial(draw_target_recipes, draw_args=draw_args)
+        draw_map = map
+    else:
+        draw = draw_target_recipes
+        draw_map = executor.map
+
+    accepted = [[] for _ in range(n_targets)]
+    n_rejected = [0] * n_targets
+    claimed = {}
+    claimed_pairs = None
+    recipe_fingerprints = set()
+
+    # The targets still drawing and the next target to generate the recipes of.
+    active = list(range(n_targets))
+    n_done = 0
+    while len(active) > 0:
+        rslt = list(
+            draw_map(
+                draw,
+                [target_data[i] for i in active],
+                [claimed_pairs] * len(active),
+                [N_matches - len(accepted[i]) for i in active],
+                [exps[i] for i in active],
+                [enss[i] for i in active],
+                [rngs[i] for i in active],
+            )
+        )
+
+        # Reconcile the drawn recipes in target order.
+        n_accepted = 0
+        next_active = []
+        for i, (recipes, rejected, exhausted, drawn, rng) in zip(active, rslt):
+            rngs[i] = rng
+            n_conflicts = 0
+            if util.nrow(recipes) == 0:
+                continue
+            drawn = dict(list(drawn.groupby("stitching_id", sort=False)))
+            for stitching_id, recipe in recipes.groupby("stitching_id", sort=False):
+                # Like drawing the targets one after another, the candidates drawn
+                # for a recipe can not use a pair of another target's recipe.
+                fingerprint = recipe_fingerprint(recipe)
+                if fingerprint in recipe_fingerprints or any(
+                    claimed.get(pair, i) != i
+                    for pair in drawn[stitching_id][
+                        RecipeSampler.PAIR_COLUMNS
+                    ].itertuples(index=False, name=None)
+                ):
+                    n_conflicts += 1
+                    continue
+
+                recipe_fingerprints.add(fingerprint)
+                pairs = recipe[RecipeSampler.PAIR_COLUMNS].itertuples(
+                    index=False, name=None
+                )
+                for pair in pairs:
+                    claimed.setdefault(pair, i)
+                recipe = recipe.reset_index(drop=True)
+                recipe["stitching_id"] = (
+                    exps[i] + "~" + enss[i] + "~" + str(len(accepted[i]) + 1)
+                )
+                accepted[i].append(recipe)
+                n_accepted += 1
+            n_rejected[i] += rejected + n_conflicts
+
+            # The candidates of the rejected recipes can be drawn again.
+            if len(accepted[i]) < N_matches and (not exhausted or n_conflicts > 0):
+                next_active.append(i)
+
+        active = next_active if n_accepted > 0 else []
+        claimed_pairs = pd.DataFrame(list(claimed), columns=RecipeSampler.PAIR_COLUMNS)
+
+        # Generate the recipes of the targets that stopped drawing, in target order.
+        n_next = min(active) if len(active) > 0 else n_targets
+        for i in range(n_done, n_next):
+            logger.info(
+                "%s~%s: drew %d recipes, rejected %d draws of existing recipes",
+                exps[i],
+                enss[i],
+                len(accepted[i]),
+                n_rejected[i],
+            )
+            yield from accepted[i]
+            accepted[i] = None
+        n_done = max(n_done, n_next)
+
+
+# Internal fx
+def parallel_recipes(
+    matched_data,
+    targets,
+    generators,
+    N_matches: int,
+    archive,
+    num_target_windows: int,
+    target_start_yrs,
+    testing: bool,
+    metric,
+    n_workers: int,
+):
+    """
+    Draw the recipes of the target ensemble members concurrently in a process pool.
+
+    The targets of every round of reconcile_recipes draw their recipes in the worker
+    processes, so the recipes are the same as the ones of serial_recipes.
+
+    :param matched_data: The matched data, without duplicates and with a default index.
+    :param targets: Data frame of the targets in the order they are reconciled in, see
+                    plan_recipes.
+    :param generators: List of the np.random.Generator of every target, or of None.
+    :param N_matches: The maximum number of recipes per target.
+    :type N_matches: int
+    :param archive: The archive data to use for re-matching duplicate points.
+    :param num_target_windows: The number of windows of a complete recipe.
+    :type num_target_windows: int
+    :param target_start_yrs: Set of the target window start years.
+    :param testing: Whether to draw in testing mode.
+    :type testing: bool
+    :param metric: The distance metric used to re-match duplicate points.
+    :param n_workers: The number of worker processes.
+    :type n_workers: int
+    :return: A list of the recipes, a data frame per recipe, in target order.
+    """
+    draw_args = (archive, metric, testing, num_target_windows, target_start_yrs)
+    with ProcessPoolExecutor(
+        max_workers=n_workers, initializer=init_recipe_worker, initargs=draw_args
+    ) as executor:
+        out = list(
+            reconcile_recipes(
+                matched_data,
+                targets,
+                generators,
+                N_matches,
+                recipe_draw_args(*draw_args),
+                executor=executor,
+            )
+        )
+    return out
+
+
+# Internal fx
+def plan_recipes(N_matches: int, matched_data, testing: bool = False, seed=None):
+    """
+    Prepare drawing the stitching recipes of the target ensemble members.
+
+    :param N_matches: The maximum number of matches per target data.
+    :type N_matches: int
+    :param matched_data: Data output from `match_neighborhood`.
+    :param testing: Whether the recipes are drawn in testing mode.
+    :type testing: bool
+    :param seed: Seed of the random draws, see target_generators.
+    :return: A list with five entries: the matched data without duplicates, a data frame
+             of the target ensemble members in the order they draw their recipes, the
+             random generators of the targets (indexed by its index column), the number
+             of windows of a complete recipe and the set of the target window start years.
+    """
+    if testing and seed is not None:
+        raise TypeError("seed: can not be used with testing=True")
+
+    # Initialize the candidates for iteration through the while loop:
+    # make a copy of the data to work with to be sure we don't touch original argument,
+    # the samplers keep track of which matches have already been used in a recipe.
+    matched_data_int = matched_data.drop_duplicates().reset_index(drop=True).copy()
+
+    # identifying how many target windows are in a trajectory we want to
+    # create so that we know we have created a full trajectory with no
+    # missing windows; basically a reference for us to us in checks.
+    num_target_windows = util.nrow(matched_data_int["target_year"].unique())
+
+    num_perms = get_num_perms(matched_data_int)
+    target_start_yrs = set(matched_data_int["target_start_yr"])
+
+    # how many target trajectories are we matching to,
+    # how many collapse-free ensemble members can each
+    # target support, and order them according to that
+    # for construction.
+    targets = num_perms[0].sort_values(["minNumMatches"]).reset_index()
+
+    # The random streams of the target ensemble members, in the order of num_perms so
+    # that they do not depend on the order the targets are drawn in.
+    generators = target_generators(seed, util.nrow(num_perms[0]))
+    # Add a column of a target  id name, differentiate between the different input
+    # streams we are emulating.
+    # We specifically emulate starting with the realization that can support
+    # the fewest collapse-free generated realizations and work in increasing
+    # order from there. We iterate over the different realizations to facilitate
+    # checking for duplicates across generated realizations across target
+    # realizations.
+    targets["target_ordered_id"] = ["A" + str(x) for x in targets.index]
+
+    if util.nrow(num_perms[0]["target_experiment"].unique()) > 1:
+        raise TypeError(
+            "Function permute_stitching_recipes should be applied to separate data frames "
+            "for each target experiment of interest (multiple target ensemble members for "
+            "a single target experiment is fine)."
+        )
+
+    # max number of permutations per target without repeating across generated
+    # ensemble members.
+    N_data_max = min(num_perms[0]["minNumMatches"])
+
+    if N_matches > N_data_max:
+        print(
+            "More recipes requested than possible for at least one target trajectories, returning what can"
+        )
+
+    out = [
+        matched_data_int,
+        targets,
+        generators,
+        num_target_windows,
+        target_start_yrs,
+    ]
+    return out
+
+
+# Internal fx
+def serial_recipes(
+    matched_data,
+    targets,
+    generators,
+    N_matches: int,
+    archive,
+    num_target_windows: int,
+    target_start_yrs,
+    testing: bool = False,
+    metric=None,
+):
+    """
+    Draw the recipes of the target ensemble members in this process.
+
+    The recipes are drawn lazily, nothing is drawn before the first recipe is taken, and
+    they are the same as the ones of parallel_recipes, see reconcile_recipes.
+
+    :param matched_data: The matched data, without duplicates and with a default index.
+    :param targets: Data frame of the target ensemble members in the order they draw
+                    their recipes, see plan_recipes.
+    :param generators: The np.random.Generator of every target, or None.
+    :param N_matches: The maximum number of recipes per target.
+    :type N_matches: int
+    :param archive: The archive data to use for re-matching duplicate points.
+    :param num_target_windows: The number of windows of a complete recipe.
+    :type num_target_windows: int
+    :param target_start_yrs: Set of the target window start years.
+    :param testing: Draw in testing mode, see RecipeSampler.draw.
+    :type testing: bool
+    :param metric: The distance metric used to re-match duplicate points.
+    :return: A generator of the recipes, a data frame per recipe.
+    """
+    draw_args = recipe_draw_args(
+        archive, metric, testing, num_target_windows, target_start_yrs
+    )
+    yield from reconcile_recipes(
+        matched_data, targets, generators, N_matches, draw_args
+    )
+
+
 def permute_stitching_recipes(
-    N_matches: int, matched_data, archive, optional=None, testing: bool = False
+    N_matches: int,
+    matched_data,
+    archive,
+    optional=None,
+    testing: bool = False,
+    metric=None,
+    seed=None,
+    n_workers: int = None,
 ):
     """
     Sample from `matched_data` to produce permutations of stitching recipes.
@@ -261,15 +1180,34 @@ def permute_stitching_recipes(
 
     :param matched_data: Data output from `match_neighborhood`.
 
-    :param archive: The archive data to use for re-matching duplicate points.
+    :param archive: The archive data to use for re-matching duplicate points, a data frame
+                    or a prebuilt ArchiveIndex.
 
     :param optional: A previous output of this function that contains a list of already created recipes
                      to avoid re-making (this is not implemented).
 
-    :param testing: When True, the behavior can be reliably replicated without setting global seeds.
-                    Defaults to False.
+    :param testing: When True, the behavior can be reliably replicated without setting global seeds,
+                    by always drawing the same relative candidate of every window. Defaults to False.
     :type testing: bool
 
+    :param metric: The distance metric used to re-match duplicate points, it should be the
+                   metric `matched_data` was matched with, see match_neighborhood. Defaults to
+                   None, the Euclidean distance.
+
+    :param seed: Seed of the random draws, an int, a np.random.SeedSequence or a
+                 np.random.Generator. Every target ensemble member draws from its own child
+                 stream spawned from the seed, so the recipes are reproducible. Defaults to
+                 None, drawing from the global NumPy random state. Can not be combined with
+                 testing=True.
+
+    :param n_workers: The number of processes to draw the recipes of the target ensemble members
+                      with. The targets draw their recipes in rounds and the archive points shared
+                      across targets are reconciled in target order after each round, see
+                      `reconcile_recipes`. When greater than 1 the targets of a round draw concurrently.
+                      With a seed the recipes do not depend on the number of workers. Defaults to None,
+                      drawing the targets in this process.
+    :type n_workers: int
+
     :return: A data frame with the same structure as the raw matched data, with duplicate matches replaced.
     """
     # Check inputs
@@ -300,353 +1238,550 @@ def permute_stitching_recipes(
         },
     )
 
-    # Initialize quantities updated on every iteration of the while loop:
-    # 1. A copy of the matched data
-    # 2. perm_guide
+    if n_workers is not None and not (type(n_workers) is int and n_workers >= 1):
+        raise TypeError("n_workers: must be a positive integer")
 
-    # Initialize matched_data_int for iteration through the while loop:
-    # make a copy of the data to work with to be sure we don't touch original argument
-    matched_data_int = matched_data.drop_duplicates().copy()
+    # Build the archive index once, every recipe with duplicates rematches against it.
+    archive = as_archive_index(archive)
 
-    # identifying how many target windows are in a trajectory we want to
-    # create so that we know we have created a full trajectory with no
-    # missing windows; basically a reference for us to us in checks.
-    num_target_windows = util.nrow(matched_data_int["target_year"].unique())
+    (
+        matched_data_int,
+        targets,
+        generators,
+        num_target_windows,
+        target_start_yrs,
+    ) = plan_recipes(N_matches, matched_data, testing=testing, seed=seed)
 
-    # Initialize perm_guide for iteration through the while loop.
-    # the permutation guide is one of the factors that the while loop
-    # will run checks on, must be initialized.
-    # Perm_guide is basically a dataframe where each target window
-    # lists the number of archive matches it has.
-    num_perms = get_num_perms(matched_data_int)
-    perm_guide = num_perms[1]
+    # Initialize the number of matches to either 0 or the input read from optional:
+    if type(optional) is str:
+        print("initialize to the read-in: has not been translated")
+    else:
+        recipe_collection = pd.DataFrame()
 
-    # how many target trajectories are we matching to,
-    # how many collapse-free ensemble members can each
-    # target support, and order them according to that
-    # for construction.
-    targets = num_perms[0].sort_values(["minNumMatches"]).reset_index()
-    # Add a column of a target  id name, differentiate between the different input
-    # streams we are emulating.
-    # We specifically emulate starting with the realization that can support
-    # the fewest collapse-free generated realizations and work in increasing
-    # order from there. We iterate over the different realizations to facilitate
-    # checking for duplicates across generated realizations across target
-    # realizations.
-    targets["target_ordered_id"] = ["A" + str(x) for x in targets.index]
+    if N_matches <= 0:
+        # There are no recipes to draw.
+        recipes = [matched_data_int.iloc[:0].assign(stitching_id="")]
+    elif n_workers is not None and n_workers > 1:
+        # The worker processes do not share the global random state, so without a seed
+        # every target gets a stream seeded from it instead.
+        if seed is None and not testing:
+            generators = target_generators(
+                np.random.SeedSequence(np.random.randint(2**32, size=4)),
+                util.nrow(targets),
+            )
+        recipes = parallel_recipes(
+            matched_data_int,
+            targets,
+            generators,
+            N_matches,
+            archive,
+            num_target_windows,
+            target_start_yrs,
+            testing,
+            metric,
+            n_workers,
+        )
+    else:
+        recipes = list(
+            serial_recipes(
+                matched_data_int,
+                targets,
+                generators,
+                N_matches,
+                archive,
+                num_target_windows,
+                target_start_yrs,
+                testing=testing,
+                metric=metric,
+            )
+        )
 
-    if util.nrow(num_perms[0]["target_experiment"].unique()) > 1:
-        raise TypeError(
-            "Function permute_stitching_recipes should be applied to separate data frames "
-            "for each target experiment of interest (multiple target ensemble members for "
-            "a single target experiment is fine)."
+    # Add the collection of the recipes for each of the targets into single df.
+    recipe_collection = pd.concat([recipe_collection] + recipes).reset_index(drop=True)
+
+    # do outputs
+    out = recipe_collection.reset_index(drop=True).copy()
+    return out[
+        [
+            "target_variable",
+            "target_experiment",
+            "target_ensemble",
+            "target_model",
+            "target_start_yr",
+            "target_end_yr",
+            "target_year",
+            "target_fx",
+            "target_dx",
+            "archive_experiment",
+            "archive_variable",
+            "archive_model",
+            "archive_ensemble",
+            "archive_start_yr",
+            "archive_end_yr",
+            "archive_year",
+            "archive_fx",
+            "archive_dx",
+            "dist_dx",
+            "dist_fx",
+            "dist_l2",
+            "stitching_id",
+        ]
+    ]
+
+
+# Internal fx
+def candidate_windows(matched_data):
+    """
+    Return the window numbers of the target and archive windows of the candidates.
+
+    :param matched_data: Data output from `match_neighborhood`.
+    :return: A list with two entries: arrays of the target window number and the archive
+             window number of every row.
+    """
+    out = [
+        matched_data.groupby("target_year").ngroup().to_numpy(),
+        matched_data.groupby(
+            [col for col in RecipeSampler.PAIR_COLUMNS if col.startswith("archive_")]
         )
+        .ngroup()
+        .to_numpy(),
+    ]
+    return out
 
-    # max number of permutations per target without repeating across generated
-    # ensemble members.
-    N_data_max = min(num_perms[0]["minNumMatches"])
 
-    if N_matches > N_data_max:
-        print(
-            "More recipes requested than possible for at least one target trajectories, returning what can"
+# Internal fx
+def recipe_graph(target_window, archive_window):
+    """
+    Build the candidate graph of a single target ensemble member.
+
+    The target windows and the archive windows of the candidates are the two sides of a
+    bipartite graph with an edge for every candidate, a collapse free recipe is an
+    assignment of every target window to a different archive window.
+
+    :param target_window: Array of the target window numbers of the candidates of the
+                          target, see candidate_windows.
+    :param archive_window: Array of the archive window numbers of the candidates, without
+                           duplicate (target window, archive window) pairs.
+    :return: A list with three entries: the number of target windows, the number of
+             archive windows and an array of the (target window, archive window) number
+             of every candidate, counting only the windows of the target.
+    """
+    targets, target_id = np.unique(target_window, return_inverse=True)
+    archives, archive_id = np.unique(archive_window, return_inverse=True)
+    out = [len(targets), len(archives), np.column_stack([target_id, archive_id])]
+    return out
+
+
+# Internal fx
+def flow_network(n_targets: int, n_archives: int, edges):
+    """
+    Build the flow network of a candidate graph.
+
+    The source is node 0, followed by the target windows, the archive windows and the
+    sink. The source connects to every target window, the target windows to the archive
+    windows of their candidates and the archive windows to the sink.
+
+    :param n_targets: The number of target windows.
+    :param n_archives: The number of archive windows.
+    :param edges: Array of the (target window, archive window) number of the candidates.
+    :return: A list with two entries: the network as a CSR matrix and a boolean array of
+             its entries that connect to the source or the sink.
+    """
+    sink = n_targets + n_archives + 1
+    rows = np.concatenate(
+        [
+            np.zeros(n_targets, dtype=int),
+            1 + edges[:, 0],
+            1 + n_targets + np.arange(n_archives),
+        ]
+    )
+    cols = np.concatenate(
+        [
+            1 + np.arange(n_targets),
+            1 + n_targets + edges[:, 1],
+            np.full(n_archives, sink),
+        ]
+    )
+
+    # Number the entries so they can be told apart after the conversion to CSR.
+    entry = np.arange(1, len(rows) + 1, dtype=np.int32)
+    graph = csr_matrix((entry, (rows, cols)), shape=(sink + 1, sink + 1))
+    outer = (graph.data <= n_targets) | (graph.data > n_targets + len(edges))
+    out = [graph, outer]
+    return out
+
+
+# Internal fx
+def route_flow(network, k: int):
+    """
+    Route k units of flow per target window through a flow network.
+
+    Every candidate carries at most one unit of flow and every archive window at most
+    k, so a flow of k units per target window is a union of k recipes that do not share
+    a candidate, see peel_recipe.
+
+    :param network: The flow network, see flow_network.
+    :param k: The number of recipes.
+    :return: The maximum flow result of scipy.
+    """
+    graph, outer = network
+    graph = graph.copy()
+    graph.data = np.where(outer, k, 1).astype(np.int32)
+    return maximum_flow(graph, 0, graph.shape[0] - 1)
+
+
+# Internal fx
+def recipe_flow(n_targets: int, n_archives: int, edges, k: int):
+    """
+    Route k disjoint recipes through a candidate graph.
+
+    :param n_targets: The number of target windows.
+    :param n_archives: The number of archive windows.
+    :param edges: Array of the (target window, archive window) number of the candidates.
+    :param k: The number of recipes.
+    :return: Boolean array of the candidates carrying flow, or None when the graph can
+             not hold k disjoint recipes.
+    """
+    if k == 0:
+        return np.zeros(len(edges), dtype=bool)
+
+    result = route_flow(flow_network(n_targets, n_archives, edges), k)
+    if result.flow_value < k * n_targets:
+        return None
+    flow = result.flow[1 + edges[:, 0], 1 + n_targets + edges[:, 1]]
+    return np.asarray(flow).ravel() > 0
+
+
+# Internal fx
+def recipe_count_bound(n_targets: int, n_archives: int, edges):
+    """
+    Bound the number of disjoint recipes of a candidate graph from above.
+
+    Every target window needs a different candidate for each recipe, and an archive
+    window can be used by at most one target window per recipe, so k recipes need at
+    least k candidates for every target window and the archive windows must be able to
+    take k * n_targets uses, each at most min(its number of candidates, k).
+
+    :param n_targets: The number of target windows.
+    :param n_archives: The number of archive windows.
+    :param edges: Array of the (target window, archive window) number of the candidates.
+    :return: The bound.
+    """
+    if n_targets == 0:
+        return 0
+
+    ks = np.arange(np.bincount(edges[:, 0], minlength=n_targets).min() + 1)
+    degree = np.sort(np.bincount(edges[:, 1], minlength=n_archives))
+    below = np.searchsorted(degree, ks)
+    uses = np.concatenate([[0], np.cumsum(degree)])[below] + ks * (n_archives - below)
+    return int(ks[uses >= ks * n_targets].max())
+
+
+# Internal fx
+def max_recipe_count(n_targets: int, n_archives: int, edges):
+    """
+    Find the maximum number of disjoint recipes of a candidate graph.
+
+    :param n_targets: The number of target windows.
+    :param n_archives: The number of archive windows.
+    :param edges: Array of the (target window, archive window) number of the candidates.
+    :return: The largest k for which recipe_flow finds k disjoint recipes.
+    """
+    high = recipe_count_bound(n_targets, n_archives, edges)
+    if high == 0:
+        return 0
+
+    # The bound is usually reached, otherwise search below it.
+    network = flow_network(n_targets, n_archives, edges)
+    if route_flow(network, high).flow_value == high * n_targets:
+        return high
+    low = 0
+    high -= 1
+    while low < high:
+        k = (low + high + 1) // 2
+        if route_flow(network, k).flow_value < k * n_targets:
+            high = k - 1
+        else:
+            low = k
+    return low
+
+
+# Internal fx
+def min_cost_recipe(n_targets: int, n_archives: int, edges, cost):
+    """
+    Assign every target window to a different archive window at minimum total cost.
+
+    :param n_targets: The number of target windows.
+    :param n_archives: The number of archive windows.
+    :param edges: Array of the (target window, archive window) number of the candidates.
+    :param cost: Array of the cost of the candidates.
+    :return: Array of the candidates of the assignment in target window order.
+    """
+    matrix = np.full((n_targets, n_archives), np.inf)
+    matrix[edges[:, 0], edges[:, 1]] = cost
+    candidate = np.full((n_targets, n_archives), -1)
+    candidate[edges[:, 0], edges[:, 1]] = np.arange(len(edges))
+
+    rows, cols = linear_sum_assignment(matrix)
+    return candidate[rows, cols]
+
+
+# Internal fx
+def peel_recipe(n_targets: int, n_archives: int, edges, cost, flow, k: int):
+    """
+    Take one recipe out of a flow of k disjoint recipes, leaving k - 1 of them.
+
+    In the flow every target window has k candidates and every archive window at most
+    k, so there is an assignment using every archive window with k candidates and the
+    rest of the flow still holds k - 1 disjoint recipes. Among those assignments the one
+    with the smallest total cost is returned.
+
+    :param n_targets: The number of target windows.
+    :param n_archives: The number of archive windows.
+    :param edges: Array of the (target window, archive window) number of the candidates.
+    :param cost: Array of the cost of the candidates.
+    :param flow: Boolean array of the candidates in the flow, see recipe_flow.
+    :param k: The number of recipes in the flow.
+    :return: Array of the candidates of the recipe in target window order.
+    """
+    in_flow = np.flatnonzero(flow)
+    degree = np.bincount(edges[in_flow, 1], minlength=n_archives)
+
+    # Using an archive window with k candidates is worth more than any saving in cost.
+    bonus = 1 + n_targets * (cost[in_flow].max() if len(in_flow) > 0 else 0)
+    flow_cost = cost[in_flow] - bonus * (degree[edges[in_flow, 1]] == k)
+    return in_flow[min_cost_recipe(n_targets, n_archives, edges[in_flow], flow_cost)]
+
+
+# Internal fx
+def assign_recipes(n_targets: int, n_archives: int, edges, cost, N_matches: int):
+    """
+    Build the disjoint recipes of a candidate graph by min-cost assignment.
+
+    Every recipe is the min-cost assignment of the candidates left, unless taking it
+    would leave fewer disjoint recipes than still wanted; then the recipe is peeled
+    from a flow of the recipes still wanted instead. Either way the number of steps is
+    bounded by the number of recipes.
+
+    :param n_targets: The number of target windows.
+    :param n_archives: The number of archive windows.
+    :param edges: Array of the (target window, archive window) number of the candidates.
+    :param cost: Array of the cost of the candidates.
+    :param N_matches: The maximum number of recipes, or None for all of them.
+    :type N_matches: int
+    :return: A list with two entries: a list of the candidate arrays of the recipes and
+             the maximum number of disjoint recipes of the graph.
+    """
+    max_recipes = max_recipe_count(n_targets, n_archives, edges)
+    n_recipes = max_recipes if N_matches is None else min(N_matches, max_recipes)
+
+    recipes = []
+    left = np.ones(len(edges), dtype=bool)
+    for i in range(n_recipes):
+        n_wanted = n_recipes - i
+        idx = np.flatnonzero(left)
+        recipe = idx[min_cost_recipe(n_targets, n_archives, edges[idx], cost[idx])]
+
+        remaining = left.copy()
+        remaining[recipe] = False
+        idx_remaining = np.flatnonzero(remaining)
+        if (
+            recipe_flow(n_targets, n_archives, edges[idx_remaining], n_wanted - 1)
+            is None
+        ):
+            flow = recipe_flow(n_targets, n_archives, edges[idx], n_wanted)
+            recipe = idx[
+                peel_recipe(
+                    n_targets, n_archives, edges[idx], cost[idx], flow, n_wanted
+                )
+            ]
+
+        left[recipe] = False
+        recipes.append(recipe)
+
+    out = [recipes, max_recipes]
+    return out
+
+
+def max_disjoint_recipes(matched_data):
+    """
+    Calculate the maximum number of disjoint recipes of every target ensemble member.
+
+    Two recipes are disjoint when they do not use the same archive window for the same
+    target window, and every recipe uses an archive window at most once. Unlike
+    minNumMatches of `get_num_perms` this accounts for the archive windows that are
+    candidates of several target windows, so it is the number of recipes
+    `assign_stitching_recipes` can build for a target on its own. It is found with a
+    few max-flow computations on the candidate graph, starting from an upper bound from
+    the numbers of candidates, and takes milliseconds for a typical match table.
+
+    The targets are counted independently, targets that share candidates for the same
+    target window can not all reach their maximum at the same time.
+
+    :param matched_data: Data output from `match_neighborhood`.
+    :return: A data frame of the target ensemble members with the maximum number of
+             disjoint recipes, maxNumRecipes.
+    """
+    # Check inputs
+    util.check_columns(
+        matched_data,
+        {
+            "target_variable",
+            "target_experiment",
+            "target_ensemble",
+            "target_model",
+            "target_start_yr",
+            "target_end_yr",
+            "target_year",
+            "archive_experiment",
+            "archive_variable",
+            "archive_model",
+            "archive_ensemble",
+            "archive_start_yr",
+            "archive_end_yr",
+            "archive_year",
+            "dist_l2",
+        },
+    )
+
+    target_cols = [
+        "target_variable",
+        "target_experiment",
+        "target_ensemble",
+        "target_model",
+    ]
+    data = matched_data.drop_duplicates(subset=target_cols + RecipeSampler.PAIR_COLUMNS)
+    target_window, archive_window = candidate_windows(data)
+    rows = []
+    for key, idx in data.groupby(target_cols).indices.items():
+        n_targets, n_archives, edges = recipe_graph(
+            target_window[idx], archive_window[idx]
         )
+        rows.append(key + (max_recipe_count(n_targets, n_archives, edges),))
+
+    out = pd.DataFrame(rows, columns=target_cols + ["maxNumRecipes"])
+    return out
+
+
+def assign_stitching_recipes(N_matches: int, matched_data):
+    """
+    Build stitching recipes from `matched_data` by min-cost assignment.
+
+    An alternative to `permute_stitching_recipes` that does not draw at random. For
+    every target ensemble member the recipes are assignments of every target window to
+    a different archive window among its candidates, so they are collapse free by
+    construction and do not need re-matching. Every recipe has the smallest total
+    dist_l2 of the candidates left, as long as that leaves enough candidates for the
+    remaining recipes, and a (target window, archive window) pair used by a recipe is
+    not used again by any target. This takes a bounded number of steps and returns the
+    maximum number of disjoint recipes when fewer than N_matches exist.
+
+    :param N_matches: The maximum number of matches per target data, or None for the
+                      maximum number of disjoint recipes of every target.
+    :type N_matches: int
+
+    :param matched_data: Data output from `match_neighborhood`.
+
+    :return: A data frame with the same structure as the output of `permute_stitching_recipes`.
+    """
+    # Check inputs
+    util.check_columns(
+        matched_data,
+        {
+            "target_variable",
+            "target_experiment",
+            "target_ensemble",
+            "target_model",
+            "target_start_yr",
+            "target_end_yr",
+            "target_year",
+            "target_fx",
+            "target_dx",
+            "archive_experiment",
+            "archive_variable",
+            "archive_model",
+            "archive_ensemble",
+            "archive_start_yr",
+            "archive_end_yr",
+            "archive_year",
+            "archive_fx",
+            "archive_dx",
+            "dist_dx",
+            "dist_fx",
+            "dist_l2",
+        },
+    )
+    if N_matches is not None and not type(N_matches) is int:
+        raise TypeError("N_matches: must be an integer or None")
 
-    # Initialize the number of matches to either 0 or the input read from optional:
-    if type(optional) is str:
-        print("initialize to the read-in: has not been translated")
-    else:
-        recipe_collection = pd.DataFrame()
+    matched_data_int = matched_data.drop_duplicates().reset_index(drop=True).copy()
+    num_target_windows = util.nrow(matched_data_int["target_year"].unique())
+    num_perms = get_num_perms(matched_data_int)
 
-    # Loop over each target ensemble member, creating N_matches generated
-    # realizations via a while loop before moving to the next target.
-    for target_id in targets["target_ordered_id"].unique():
-        # subset the target info, the target df contains meta information about the run we
-        # and the number of permutations and such.
-        target = targets.loc[targets["target_ordered_id"] == target_id].copy()
-
-        # initialize a recipes data frame holder for each target, for
-        # the while loop to iterate on
-        recipes_col_by_target = pd.DataFrame()
-        var_name = target["target_variable"].unique()[0]
-        exp = target["target_experiment"].unique()[0]
-        mod = target["target_model"].unique()[0]
-        ens = target["target_ensemble"].unique()[0]
-
-        # While the following conditions are met continue to generate new recipes.
-        # 1. While we have fewer matches than requested for the target ensemble_member,
-        #    keep going.
-        # 2. Filter the perm_guide to just the target ensemble member in this loop and
-        #    make sure there are at least num_target_windows of time windows: basically
-        #    make sure there is at least one remaining archive match to draw from for
-        #    each target window in this target ensemble. Note this means the perm_guide
-        #    must be updated at the end of every while loop iteration.
-        #
-        # Initialize these conditions, so we enter the while loop, then update again at the
-        # end of each iteration:
-        if util.nrow(recipes_col_by_target) == 0:
-            condition1 = True
-        elif util.nrow(recipes_col_by_target["stitching_id"].unique()) < N_matches:
-            condition1 = True
-        else:
-            condition1 = False
-
-        perm_rows = util.nrow(
-            perm_guide.loc[
-                (perm_guide["target_variable"] == var_name)
-                & (perm_guide["target_experiment"] == exp)
-                & (perm_guide["target_model"] == mod)
-                & (perm_guide["target_ensemble"] == ens)
-            ]
-            .copy()
-            .drop_duplicates()
+    if util.nrow(num_perms[0]["target_experiment"].unique()) > 1:
+        raise TypeError(
+            "Function assign_stitching_recipes should be applied to separate data frames "
+            "for each target experiment of interest (multiple target ensemble members for "
+            "a single target experiment is fine)."
         )
 
-        if perm_rows == num_target_windows:
-            condition2 = True
+    # Work through the targets in the same order as permute_stitching_recipes, starting
+    # with the one that can support the fewest recipes. A pair used by a recipe can not
+    # be used by the targets that come after it.
+    targets = num_perms[0].sort_values(["minNumMatches"]).reset_index()
+    pair_id = matched_data_int.groupby(RecipeSampler.PAIR_COLUMNS).ngroup().to_numpy()
+    used = np.zeros(pair_id.max() + 1 if len(pair_id) > 0 else 0, dtype=bool)
+    target_window, archive_window = candidate_windows(matched_data_int)
+
+    recipes = []
+    for _, target in targets.iterrows():
+        exp = target["target_experiment"]
+        ens = target["target_ensemble"]
+        is_target = (
+            (matched_data_int["target_variable"] == target["target_variable"])
+            & (matched_data_int["target_experiment"] == exp)
+            & (matched_data_int["target_model"] == target["target_model"])
+            & (matched_data_int["target_ensemble"] == ens)
+        ).to_numpy()
+        rows = np.flatnonzero(is_target & ~used[pair_id])
+        rows = rows[~pd.Series(pair_id[rows]).duplicated().to_numpy()]
+        target_matches = matched_data_int.take(rows)
+
+        n_targets, n_archives, edges = recipe_graph(
+            target_window[rows], archive_window[rows]
+        )
+        cost = target_matches["dist_l2"].to_numpy(dtype=float)
+        if n_targets < num_target_windows:
+            target_recipes, max_recipes = [], 0
         else:
-            condition2 = False
-
-        # And an integer index to initialize the count of stitched
-        # trajectories for each target
-        stitch_ind = 1
-
-        # Run the while loop!
-        while all([condition1, condition2]):
-            # Group matched data for a single target by the chunks of the target information.
-            # Right now a single target chunk may have multiple matches with archive points. The
-            # next several steps of the while loop will create a one to one paring between the
-            # target and archive data, then check to make sure that the pairing meets the requirements
-            # for what we call a recipe.
-            grouped_targets = []
-            grouped_targets = (
-                matched_data_int.loc[
-                    (matched_data_int["target_variable"] == var_name)
-                    & (matched_data_int["target_experiment"] == exp)
-                    & (matched_data_int["target_model"] == mod)
-                    & (matched_data_int["target_ensemble"] == ens)
-                ]
-                .copy()
-                .groupby(
-                    [
-                        "target_variable",
-                        "target_experiment",
-                        "target_ensemble",
-                        "target_model",
-                        "target_start_yr",
-                        "target_end_yr",
-                    ]
-                )
+            target_recipes, max_recipes = assign_recipes(
+                n_targets, n_archives, edges, cost, N_matches
             )
 
-            # For each target window group,
-            # Randomly select one of the archive matches to use.
-            # This creates one_one_match, a candidate recipe.
-            one_one_match = []
-            for name, group in grouped_targets:
-                if testing:
-                    one_one_match.append(group.sample(1, replace=False, random_state=1))
-                else:
-                    one_one_match.append(group.sample(1, replace=False))
-            one_one_match = pd.concat(one_one_match)
-            one_one_match = one_one_match.reset_index(drop=True).copy()
-
-            # Before we can accept our candidate recipe, one_one_match,
-            # we run it through a lot of tests.
-
-            # Force one_one_match to meet our first condition,
-            # that each archive data point in the recipe must be unique.
-            # Then give it a stitching id
-            new_recipe = []
-            new_recipe = remove_duplicates(one_one_match, archive)
-            stitching_id = exp + "~" + ens + "~" + str(stitch_ind)
-            new_recipe["stitching_id"] = stitching_id
-            new_recipe = new_recipe.reset_index(drop=True).copy()
-
-            # Make sure the new recipe isn't missing any years:
-            if ~new_recipe.shape[0] == num_target_windows:
-                raise TypeError(
-                    "problem: the new single recipe is missing years of data!"
-                )
-            #  Make sure that no changes were made to the target years.
-            if (
-                sum(
-                    ~new_recipe["target_start_yr"].isin(
-                        set(matched_data_int["target_start_yr"])
-                    )
-                )
-                > 0
-            ):
-                raise TypeError("problem the new single recipe target years!")
-
-            # Compare the new_recipe to the previously drawn recipes across all target
-            # ensembles.
-            # There is no collapse within each target ensemble because  we remove the constructed
-            # new_recipe from the matched_data at the end of each iteration of the while loop -
-            # The sampled points CAN'T be used again for the current target ensemble member
-            # for loop iteration, or for any other target ensemble members. Meaning we
-            # avoid envelope collapse when targeting multiple realizations (you don't have
-            # realization 1 and realization 4 2070 getting matched to the same archive point.
-            # The code below is checking to make sure that our new_recipe doesn't exist
-            # in the saved recipe_collection. This shouldn't be possible with how we update
-            # our matched_data_int on every loop, but just to be cautious, we check.
-            # Again, the challenge is seeing if our entire sample has
-            # been included in recipes before, not just a row or two.
-
-            if util.nrow(recipe_collection) != 0:
-                # If previous recipes exist, we must create a comparison
-                # data frame that checks each existing recipe in recipe_collection
-                # against new_recipe and record True/False
-                #
-                # Compare the new recipe with the existing collection of all recipes.
-                cols_to_use = [
-                    "target_variable",
-                    "target_experiment",
-                    "target_model",
-                    "target_start_yr",
-                    "target_end_yr",
-                    "archive_experiment",
-                    "archive_variable",
-                    "archive_model",
-                    "archive_ensemble",
-                    "archive_start_yr",
-                    "archive_end_yr",
-                ]
-                grouped_collection = recipe_collection.groupby(["stitching_id"])
-                comparison = []
-                for name, group in grouped_collection:
-                    df1 = (
-                        group[cols_to_use]
-                        .copy()
-                        .reset_index(drop=True)
-                        .sort_index(axis=1)
-                    )
-                    df2 = (
-                        new_recipe[cols_to_use]
-                        .copy()
-                        .reset_index(drop=True)
-                        .sort_index(axis=1)
-                    )
-                    comparison.append(df1.equals(df2))
-
-                # end for loop
-            # end if statement
-            else:
-                # Otherwise, this is the first recipe we've done at all, so we set comparison manually
-                # so that the next if statement triggers just like it was appending a new recipe to an
-                # existing list.
-                comparison = [False]
-            # end else
-
-            # If the new_recipe is not unique (aka, any(comparison) == True), then
-            # we don't want it and we don't want to do anything else in this iteration of
-            # the while loop. We DON'T update the matched_points or conditions, so the
-            # while loop is forced to re-run so that another random draw is done to create
-            # a new candidate new_recipe.
-            # We check for what we want: the new recipe is the first or all(comparison)==False.
-            # In either case, we are safe to keep new_recipe and update all the data frames
-            # for the next iteration of the while loop.
-            if not all(comparison):
-                # add new_recipe to the list of recipes for this target ensemble
-                recipes_col_by_target = pd.concat([recipes_col_by_target, new_recipe])
-
-                # And we remove it from the matched_points_int so the archive
-                # values used in this new_recipe can't be used to construct
-                # subsequent realizations for this target ensemble member.
-                # This updated matched_data_int is used in each iteration
-                # of the while loop. Since we are removing the constructed
-                # new_recipe from the matched_data_int at the end of each
-                # iteration of the while loop, the sample points can't be
-                # randomly drawn again for the next generated trajectory
-                # of the current target ensemble member for loop iteration.
-
-                # Now each (target_window, archive_window) combination must
-                # be removed from matched data for all target ensemble members,
-                # not just the one we are currently operating on.
-                # This ensures that we don't get collapse in the generated
-                # envelope across target ensemble members (e.g you don't
-                # have realization 1 and realization 4 2070 getting matched
-                # to the same archive point).
-                # Use an anti-join
-                matched_data_int = util.anti_join(
-                    matched_data_int,
-                    new_recipe.drop(["stitching_id"], axis=1).copy(),
-                    bycols=[
-                        "target_year",
-                        "target_start_yr",
-                        "target_end_yr",
-                        "archive_experiment",
-                        "archive_variable",
-                        "archive_model",
-                        "archive_ensemble",
-                        "archive_start_yr",
-                        "archive_end_yr",
-                        "archive_year",
-                    ],
-                ).copy()
-
-                # update permutation count info with the revised matched data so
-                # the while loop behaves - this makes sure that every target window
-                # in the perm_guide actually has at least one matched archive point
-                # available for draws .
-                # That way, we don't try to construct a trajectory with fewer years
-                # than the targets.
-                num_perms = get_num_perms(matched_data_int)
-                perm_guide = num_perms[1]
-
-                # Use the updated perm_guide to update
-                # the while loop conditions:
-
-                # Condition 1:
-                # If we haven't reached the N_matches goal for this target ensemble
-                if util.nrow(recipes_col_by_target) == 0:
-                    condition1 = True
-                elif (
-                    util.nrow(recipes_col_by_target["stitching_id"].unique())
-                    < N_matches
-                ):
-                    condition1 = True
-                else:
-                    condition1 = False
-                # end updating Condition 1
-
-                # Condition 2:
-                # make sure each target window in the updated perm guide has at least one archive match available
-                # to draw on the next iteration.
-                perm_rows = util.nrow(
-                    perm_guide.loc[
-                        (perm_guide["target_variable"] == var_name)
-                        & (perm_guide["target_experiment"] == exp)
-                        & (perm_guide["target_model"] == mod)
-                        & (perm_guide["target_ensemble"] == ens)
-                    ]
-                    .copy()
-                    .drop_duplicates()
-                )
-
-                if perm_rows == num_target_windows:
-                    condition2 = True
-                else:
-                    condition2 = False
-                # end updating condition 2
-
-                # Add to the stitch_ind, to update the count of stitched
-                # trajectories for each target ensemble member.
-                stitch_ind += 1
-
-            # end if statement
-        # end the while loop for this target ensemble member
-
-        # Add the collection of the recipes for each of the targets into single df.
-        recipe_collection = (
-            pd.concat([recipe_collection, recipes_col_by_target])
-            .reset_index(drop=True)
-            .copy()
+        if N_matches is not None and N_matches > max_recipes:
+            print(
+                "More recipes requested than possible for at least one target trajectories, returning what can"
+            )
+        logger.info(
+            "%s~%s: assigned %d recipes, at most %d disjoint recipes are possible",
+            exp,
+            ens,
+            len(target_recipes),
+            max_recipes,
         )
 
-    # end the for loop over target ensemble members
+        for i, recipe in enumerate(target_recipes):
+            used[pair_id[rows[recipe]]] = True
+            recipes.append(
+                target_matches.take(recipe)
+                .sort_values("target_year")
+                .assign(stitching_id=exp + "~" + ens + "~" + str(i + 1))
+            )
 
-    # do outputs
-    out = recipe_collection.reset_index(drop=True).copy()
+    if len(recipes) > 0:
+        out = pd.concat(recipes).reset_index(drop=True)
+    else:
+        out = matched_data_int.head(0).assign(stitching_id=pd.Series(dtype=str))
     return out[
         [
             "target_variable",
@@ -715,126 +1850,46 @@ def handle_transition_periods(rp):
         },
     )
 
-    def internal_func(x):
-        # First check to see the archive period spans the historical to future scenario
-        transition_period = (
-            2014 in range(x["archive_start_yr"], x["archive_end_yr"] + 1)
-        ) & (2015 in range(x["archive_start_yr"], x["archive_end_yr"] + 1))
-
-        if transition_period:
-            target_yrs = list(range(x["target_start_yr"], x["target_end_yr"] + 1))
-            archive_yrs = list(range(x["archive_start_yr"], x["archive_end_yr"] + 1))
-            hist_cut_off = 2014  # the final complete year of the historical experiment
-
-            historical_yrs = list(filter(lambda x: x <= hist_cut_off, archive_yrs))
-            future_yrs = list(set(archive_yrs).difference(set(historical_yrs)))
-
-            # This is the information that is constant between the historical and future periods.
-            constant_info = x.loc[
-                x.index.isin(
-                    {
-                        "archive_variable",
-                        "archive_model",
-                        "archive_ensemble",
-                        "stitching_id",
-                    }
-                )
-            ]
-
-            # Construct the historical period information
-            d = {
-                "target_start_yr": min(target_yrs),
-                "target_end_yr": target_yrs[len(historical_yrs) - 1],
-                "archive_experiment": "historical",
-                "archive_start_yr": min(historical_yrs),
-                "archive_end_yr": max(historical_yrs),
-            }
-            ser = pd.Series(
-                data=d,
-                index=[
-                    "target_start_yr",
-                    "target_end_yr",
-                    "archive_experiment",
-                    "archive_start_yr",
-                    "archive_end_yr",
-                ],
-            )
-            historical_period = pd.concat([ser, constant_info]).to_frame().transpose()
-
-            # Check to make sure the lengths of time are correct
-            targ_len = (
-                historical_period["target_end_yr"].values
-                - historical_period["target_start_yr"].values
-            )
-            arch_len = (
-                historical_period["archive_end_yr"].values
-                - historical_period["archive_start_yr"].values
-            )
-            if targ_len != arch_len:
-                raise TypeError(
-                    "Problem with the length of the historical archive & target years."
-                )
-
-            # Now construct the future period information
-            d = {
-                "target_start_yr": target_yrs[len(historical_yrs)],
-                "target_end_yr": target_yrs[len(target_yrs) - 1],
-                "archive_experiment": x["archive_experiment"],
-                "archive_start_yr": min(future_yrs),
-                "archive_end_yr": max(future_yrs),
-            }
-            ser = pd.Series(
-                data=d,
-                index=[
-                    "target_start_yr",
-                    "target_end_yr",
-                    "archive_experiment",
-                    "archive_start_yr",
-                    "archive_end_yr",
-                ],
-            )
-            # future_period = ser.append(constant_info).to_frame().transpose()
-            future_period = pd.concat([ser, constant_info]).to_frame().transpose()
-
-            # Check to make sure the lengths of time are correct
-            targ_len = (
-                future_period["target_end_yr"].values
-                - future_period["target_start_yr"].values
-            )
-            arch_len = (
-                future_period["archive_end_yr"].values
-                - future_period["archive_start_yr"].values
-            )
-            if not targ_len == arch_len:
-                raise TypeError(
-                    "Problem with the length of the historical archive & target years."
-                )
-
-            # Combine the period information
-            out = pd.concat([historical_period, future_period]).reset_index(drop=True)
-        else:
-            out = x.to_frame().transpose().reset_index(drop=True)
-            out = out[
-                [
-                    "target_start_yr",
-                    "target_end_yr",
-                    "archive_experiment",
-                    "archive_variable",
-                    "archive_model",
-                    "archive_ensemble",
-                    "stitching_id",
-                    "archive_start_yr",
-                    "archive_end_yr",
-                ]
-            ]
-
-        return out
+    # The final complete year of the historical experiment.
+    hist_cut_off = 2014
+
+    # First check to see the archive period spans the historical to future scenario,
+    # those rows are repeated to make a historical and a future period.
+    archive_start = rp["archive_start_yr"].to_numpy(dtype=int)
+    archive_end = rp["archive_end_yr"].to_numpy(dtype=int)
+    transition_period = (archive_start <= hist_cut_off) & (archive_end > hist_cut_off)
+    rows = np.repeat(np.arange(util.nrow(rp)), np.where(transition_period, 2, 1))
+    historical = transition_period[rows] & np.r_[True, rows[1:] != rows[:-1]]
+    future = transition_period[rows] & ~historical
+
+    out = rp[GRIDDED_RECIPE_COLUMNS].take(rows).reset_index(drop=True)
+    target_start = out["target_start_yr"].to_numpy(dtype=int)
+    target_end = out["target_end_yr"].to_numpy(dtype=int)
+    archive_start = archive_start[rows]
+    archive_end = archive_end[rows]
+
+    # The historical period keeps the archive years up to the cut off and the same
+    # number of target years, the future period the rest of them.
+    n_historical = hist_cut_off - archive_start + 1
+    out["target_end_yr"] = np.where(
+        historical, target_start + n_historical - 1, target_end
+    )
+    out["target_start_yr"] = np.where(future, target_start + n_historical, target_start)
+    out["archive_start_yr"] = np.where(future, hist_cut_off + 1, archive_start)
+    out["archive_end_yr"] = np.where(historical, hist_cut_off, archive_end)
+    out.loc[historical, "archive_experiment"] = "historical"
+
+    # Check to make sure the lengths of time are correct
+    targ_len = out["target_end_yr"] - out["target_start_yr"]
+    arch_len = out["archive_end_yr"] - out["archive_start_yr"]
+    if (targ_len != arch_len)[historical | future].any():
+        raise TypeError(
+            "Problem with the length of the historical archive & target years."
+        )
 
     # Note that data frame returned might not be identical in shape to the
     # recipe read in because any periods that cover the historical period
     # will be split into two rows.
-    ser = rp.apply(internal_func, axis=1)
-    out = pd.concat(ser.values.tolist()).reset_index(drop=True)
     return out
 
 
@@ -851,90 +1906,32 @@ def handle_final_period(rp):
     :param rp: A data frame of the recipe.
     :return: A recipe data frame with target and archive periods of equal length.
     """
-
-    def internal_func(x):
-        """
-        Process a single row of the recipe dataframe.
-
-        This function is applied to each row of the recipe dataframe. It ensures that
-        the target and archive periods have the same length by adjusting the archive
-        end year if necessary. It also formats the row into a dataframe with a specific
-        column order.
-
-        :param x: A pandas Series representing a row of the recipe dataframe.
-        :return: A pandas DataFrame representing the processed row, with target and
-                 archive periods of equal length and columns in a specified order.
-        """
-        len_target = x["target_end_yr"] - x["target_start_yr"]
-        len_archive = x["archive_end_yr"] - x["archive_start_yr"]
-
-        if len_target == len_archive:
-            # No problem return the the row as is
-            out = x.to_frame().transpose().reset_index(drop=True)
-            out = out[
-                [
-                    "target_start_yr",
-                    "target_end_yr",
-                    "archive_experiment",
-                    "archive_variable",
-                    "archive_model",
-                    "archive_ensemble",
-                    "stitching_id",
-                    "archive_start_yr",
-                    "archive_end_yr",
-                ]
-            ]
-
-        elif len_target < len_archive:
-            # Figure out how much shorter the target period is than the archive period.
-            out = x.to_frame().transpose().reset_index(drop=True)
-            out = out[
-                [
-                    "target_start_yr",
-                    "target_end_yr",
-                    "archive_experiment",
-                    "archive_variable",
-                    "archive_model",
-                    "archive_ensemble",
-                    "stitching_id",
-                    "archive_start_yr",
-                    "archive_end_yr",
-                ]
-            ]
-            out["archive_end_yr"] = out["archive_end_yr"] - 1
-        else:
-            # Figure out how much shorter the target period is than the archive period.
-            out = x.to_frame().transpose().reset_index(drop=True)
-            out = out[
-                [
-                    "target_start_yr",
-                    "target_end_yr",
-                    "archive_experiment",
-                    "archive_variable",
-                    "archive_model",
-                    "archive_ensemble",
-                    "stitching_id",
-                    "archive_start_yr",
-                    "archive_end_yr",
-                ]
-            ]
-            out["archive_start_yr"] = out["archive_start_yr"] - 1
-
-        return out
-
-    ser = rp.apply(internal_func, axis=1)
-    out = pd.concat(ser.values.tolist()).reset_index(drop=True)
+    out = rp[GRIDDED_RECIPE_COLUMNS].reset_index(drop=True)
+    len_target = (out["target_end_yr"] - out["target_start_yr"]).to_numpy(dtype=int)
+    len_archive = (out["archive_end_yr"] - out["archive_start_yr"]).to_numpy(dtype=int)
+
+    # When the target period is shorter than the archive period drop the final archive
+    # year, when it is longer start the archive period a year earlier.
+    out["archive_end_yr"] = out["archive_end_yr"].to_numpy(dtype=int) - (
+        len_target < len_archive
+    )
+    out["archive_start_yr"] = out["archive_start_yr"].to_numpy(dtype=int) - (
+        len_target > len_archive
+    )
 
     return out
 
 
-def generate_gridded_recipe(messy_recipe, res: str = "mon"):
+def generate_gridded_recipe(messy_recipe, res: str = "mon", catalog=None):
     """
     Create a recipe for the stitching process using a messy recipe.
 
     :param messy_recipe: A data frame generated by the permute_recipes function.
     :param res: The resolution of the recipe, either 'mon' for monthly or 'day' for daily.
     :type res: str
+    :param catalog: Optional PangeoCatalog to look up the files in. Defaults to None,
+                    the catalog of the package Pangeo table returned by `pangeo_catalog()`.
+    :type catalog: PangeoCatalog
     :return: A data frame formatted as a recipe for stitching.
     """
     # Check inputs
@@ -977,16 +1974,13 @@ def generate_gridded_recipe(messy_recipe, res: str = "mon"):
     dat.loc[dat["archive_end_yr"] <= 2014, "archive_experiment"] = "historical"
 
     # Now that we have the formatted recipe add the pangeo tas information!!
-    ptable_path = resources.files("stitches") / "data" / "pangeo_table.csv"
-    pangeo_table = pd.read_csv(ptable_path)
-
     if res == "mon":
         table = "Amon"
     else:
         table = "day"
-    tas_meta_info = pangeo_table.loc[
-        (pangeo_table["variable"] == "tas") & (pangeo_table["domain"] == table)
-    ]
+    if catalog is None:
+        catalog = pangeo_catalog()
+    tas_meta_info = catalog.lookup(variable="tas", domain=table)
     tas_meta_info = tas_meta_info[
         ["model", "experiment", "ensemble", "variable", "zstore"]
     ]
@@ -1020,36 +2014,43 @@ def generate_gridded_recipe(messy_recipe, res: str = "mon"):
     return out
 
 
-def make_recipe(
+# Internal fx
+def prepare_recipe_inputs(
     target_data,
     archive_data,
-    N_matches: int,
-    res: str = "mon",
-    tol: float = 0.1,
-    non_tas_variables: [str] = None,
-    reproducible: bool = False,
+    N_matches,
+    res,
+    tol,
+    non_tas_variables,
+    subsets=None,
+    catalog=None,
 ):
     """
-    Generate a stitching recipe from target and archive data.
+    Check and subset the target and archive data of make_recipe.
 
     :param target_data: A pandas DataFrame of climate information to emulate.
-    :param archive_data: A pandas DataFrame of temperature data to use as the archive to match on.
-    :param N_matches: The maximum number of matches per target data.
+    :param archive_data: A pandas DataFrame of the archive or an ArchiveIndex.
+    :param N_matches: The maximum number of matches per target data, or None.
     :param res: Resolution of the stitched data, either 'mon' or 'day'.
-    :param tol: Tolerance used in the matching process, default is 0.1.
-    :param non_tas_variables: List of variables other than tas to stitch together; defaults to None,
-        which stitches tas only.
-    :param reproducible: If True, ensures reproducible behavior by using the testing=True argument
-        in permute_stitching_recipes(); defaults to False.
+    :param tol: Tolerance used in the matching process.
+    :param non_tas_variables: List of variables other than tas to stitch together, or None.
+    :param subsets: Optional dictionary of the ArchiveIndex subsets already made by
+                    (res, variables), new subsets are added to it so that several calls
+                    with the same ArchiveIndex share them.
+    :param catalog: The PangeoCatalog of the variables, or None for the package catalog.
+    :return: A list with three entries: the target data, the archive data (or its
+             ArchiveIndex) limited to the entries covering the non tas variables, and a
+             data frame of the files of those entries, or None without non tas variables.
+    """
+    wide_df = None
 
-    :type N_matches: int
-    :type res: str
-    :type tol: float
-    :type non_tas_variables: list[str]
-    :type reproducible: bool
+    # When given an ArchiveIndex check and subset its data but keep using the index
+    # for matching.
+    archive_index = None
+    if isinstance(archive_data, ArchiveIndex):
+        archive_index = archive_data
+        archive_data = archive_index.data
 
-    :return: A pandas DataFrame of a formatted recipe.
-    """
     # Check the inputs
     util.check_columns(
         target_data,
@@ -1079,8 +2080,8 @@ def make_recipe(
             "dx",
         },
     )
-    if not type(N_matches) is int:
-        raise TypeError("N_matches: must be an integer")
+    if N_matches is not None and not type(N_matches) is int:
+        raise TypeError("N_matches: must be an integer or None")
     if not type(tol) is float:
         raise TypeError("tol: must be a float")
 
@@ -1101,19 +2102,20 @@ def make_recipe(
             "dx",
         ]
     ].copy()
-    archive_data = archive_data[
-        [
-            "experiment",
-            "variable",
-            "ensemble",
-            "model",
-            "start_yr",
-            "end_yr",
-            "year",
-            "fx",
-            "dx",
-        ]
-    ].copy()
+    if archive_index is None:
+        archive_data = archive_data[
+            [
+                "experiment",
+                "variable",
+                "ensemble",
+                "model",
+                "start_yr",
+                "end_yr",
+                "year",
+                "fx",
+                "dx",
+            ]
+        ].copy()
 
     # If there are non tas variables to be stitched, subset the archive to limit
     # the coverage to only the entries with the complete coverage.
@@ -1123,55 +2125,126 @@ def make_recipe(
         if "tas" in non_tas_variables:
             raise TypeError("non_tas_variables: cannot contain tas.")
 
-        data_directory = resources.files("stitches") / "data"
-        pt_path = os.path.join(data_directory, "pangeo_table.csv")
-        pangeo_table = pd.read_csv(pt_path)
-
-        var_list = pangeo_table["variable"].unique()
-        if not set(non_tas_variables) <= set(var_list):
+        if catalog is None:
+            catalog = pangeo_catalog()
+        if not set(non_tas_variables) <= catalog.variables:
             raise TypeError(
                 "One or more of the variables are not found in Pangeo table."
             )
 
-        # Subset the pangeo table so that it contains the resolution & variables of data of interest.
+        # The files of the entries with the resolution & variables of data of interest.
         non_tas_variables.append("tas")
-        pt_subset = pangeo_table.loc[
-            (
-                pangeo_table["domain"].str.contains(res)
-                & pangeo_table["variable"].isin(non_tas_variables)
-                & ~pangeo_table["zstore"].str.contains("AerChemMIP")
-            )
-        ].copy()
-
-        # Format the variable column to the "file" so that we can
-        pt_subset["variable"] = pt_subset["variable"] + "_file"
-        wide_df = pt_subset.pivot(
-            index=["model", "ensemble", "experiment"],
-            columns="variable",
-            values="zstore",
-        )
-        wide_df.reset_index(inplace=True)
-        wide_df.columns.name = None
-        wide_df = wide_df.dropna()
+        wide_df = catalog.coverage(res, non_tas_variables)
 
         # Select the archive entries for the model, ensemble, experiment to keep, there are the entries
         # that also have complete coverage for the variables listed in the non tas variable list.
         to_keep = wide_df.loc[
             :, wide_df.columns.isin(["model", "ensemble", "experiment"])
         ].drop_duplicates()
-        archive_data = archive_data.merge(
-            to_keep, on=["model", "ensemble", "experiment"], how="inner"
-        ).copy()
+        if archive_index is None:
+            archive_data = archive_data.merge(
+                to_keep, on=["model", "ensemble", "experiment"], how="inner"
+            ).copy()
+        else:
+            subset_key = (res, tuple(sorted(set(non_tas_variables))))
+            if subsets is not None and subset_key in subsets:
+                archive_index = subsets[subset_key]
+            else:
+                keep = (
+                    archive_data[["model", "ensemble", "experiment"]]
+                    .merge(to_keep, how="left", indicator=True)["_merge"]
+                    .eq("both")
+                    .to_numpy()
+                )
+                if not keep.all():
+                    archive_index = archive_index.subset(keep)
+                if subsets is not None:
+                    subsets[subset_key] = archive_index
+
+    if archive_index is not None:
+        archive_data = archive_index
+
+    out = [target_data, archive_data, wide_df]
+    return out
 
-    # Match the archive & target data together.
-    match_df = match.match_neighborhood(target_data, archive_data, tol=tol)
 
-    if reproducible:
+# Internal fx
+def match_recipe_targets(target_data, archive_data, tol, metric=None, match_cache=None):
+    """
+    Match the target and archive data of make_recipe, through the match cache if there is one.
+
+    :param target_data: The checked target data, see prepare_recipe_inputs.
+    :param archive_data: The archive data or its ArchiveIndex.
+    :param tol: Tolerance used in the matching process.
+    :param metric: The distance metric used for matching.
+    :param match_cache: A MatchCache, or None to always match.
+    :return: Data frame with the target data and the corresponding matched archive data.
+    """
+    if match_cache is None:
+        return match.match_neighborhood(
+            target_data, archive_data, tol=tol, metric=metric
+        )
+    return match_cache.match(target_data, archive_data, tol=tol, metric=metric)
+
+
+# Internal fx
+def recipe_capacity(match_df):
+    """
+    Return the number of recipes all of the targets of the matches can support.
+
+    :param match_df: The matched target and archive data, see match_neighborhood.
+    :return: The smallest maxNumRecipes of the targets, see max_disjoint_recipes.
+    """
+    out = int(max_disjoint_recipes(match_df)["maxNumRecipes"].min())
+    if out == 0:
+        raise TypeError(
+            "No recipes can be made from the matches without reusing an archive window, "
+            "set N_matches or use a larger tol."
+        )
+    return out
+
+
+# Internal fx
+def build_recipes(
+    match_df,
+    archive_data,
+    N_matches,
+    reproducible=False,
+    metric=None,
+    seed=None,
+    n_workers=None,
+    recipe_method="sample",
+):
+    """
+    Build the unformatted recipes of the matches of make_recipe.
+
+    :param match_df: The matched target and archive data, see match_neighborhood.
+    :param archive_data: The archive data or its ArchiveIndex, used to rematch.
+    :param N_matches: The maximum number of matches per target data, or None.
+    :param reproducible: If True, draw the recipes with testing=True.
+    :param metric: The distance metric used for matching.
+    :param seed: Seed of the random draws of the recipes.
+    :param n_workers: The number of processes to draw the recipes with.
+    :param recipe_method: Either 'sample' or 'assignment', see make_recipe.
+    :return: A pandas DataFrame of the unformatted recipes.
+    """
+    # Size the number of recipes to what the matches can support.
+    if N_matches is None:
+        N_matches = recipe_capacity(match_df)
+
+    if recipe_method == "assignment":
+        unformatted_recipe = assign_stitching_recipes(
+            N_matches=N_matches, matched_data=match_df
+        )
+    elif reproducible:
         unformatted_recipe = permute_stitching_recipes(
             N_matches=N_matches,
             matched_data=match_df,
             archive=archive_data,
             testing=True,
+            metric=metric,
+            seed=seed,
+            n_workers=n_workers,
         )
     else:
         unformatted_recipe = permute_stitching_recipes(
@@ -1179,10 +2252,29 @@ def make_recipe(
             matched_data=match_df,
             archive=archive_data,
             testing=False,
+            metric=metric,
+            seed=seed,
+            n_workers=n_workers,
         )
 
+    return unformatted_recipe
+
+
+# Internal fx
+def format_recipe(unformatted_recipe, res, non_tas_variables, wide_df, catalog=None):
+    """
+    Format recipes into the data frame that can be used by the stitching functions.
+
+    :param unformatted_recipe: Data frame of recipes, see permute_stitching_recipes.
+    :param res: Resolution of the stitched data, either 'mon' or 'day'.
+    :param non_tas_variables: List of variables other than tas to stitch together, or None.
+    :param wide_df: The data frame of the files of the archive entries, see
+                    prepare_recipe_inputs.
+    :param catalog: The PangeoCatalog of the files, or None for the package catalog.
+    :return: A pandas DataFrame of a formatted recipe.
+    """
     # Format the recipe into the dataframe that can be used by the stitching functions.
-    recipe = generate_gridded_recipe(unformatted_recipe, res=res)
+    recipe = generate_gridded_recipe(unformatted_recipe, res=res, catalog=catalog)
     recipe.columns = [
         "target_start_yr",
         "target_end_yr",
@@ -1212,3 +2304,307 @@ def make_recipe(
         .copy()
     )
     return out
+
+
+def make_recipe(
+    target_data,
+    archive_data,
+    N_matches: int,
+    res: str = "mon",
+    tol: float = 0.1,
+    non_tas_variables: [str] = None,
+    reproducible: bool = False,
+    metric=None,
+    seed=None,
+    n_workers: int = None,
+    recipe_method: str = "sample",
+    match_cache=None,
+    catalog=None,
+):
+    """
+    Generate a stitching recipe from target and archive data.
+
+    :param target_data: A pandas DataFrame of climate information to emulate.
+    :param archive_data: A pandas DataFrame of temperature data to use as the archive to match on,
+        or a prebuilt ArchiveIndex of it so that repeated calls skip the archive preprocessing.
+    :param N_matches: The maximum number of matches per target data, or None to make as many
+        recipes as the target with the fewest disjoint recipes supports, see max_disjoint_recipes.
+    :param res: Resolution of the stitched data, either 'mon' or 'day'.
+    :param tol: Tolerance used in the matching process, default is 0.1.
+    :param non_tas_variables: List of variables other than tas to stitch together; defaults to None,
+        which stitches tas only.
+    :param reproducible: If True, ensures reproducible behavior by using the testing=True argument
+        in permute_stitching_recipes(); defaults to False.
+    :param metric: The distance metric in (fx, windowsize*dx) space used for matching, a pair of
+        (fx, dx) weights, a 2x2 scaling matrix or a dictionary of either by target experiment; see
+        match_neighborhood. Defaults to None, the Euclidean distance.
+    :param seed: Seed of the random draws of the recipes, an int, a np.random.SeedSequence or a
+        np.random.Generator, see permute_stitching_recipes. Defaults to None. Can not be combined
+        with reproducible=True.
+    :param n_workers: The number of processes to draw the recipes of the target ensemble members with,
+        see permute_stitching_recipes. Defaults to None, drawing them one after another.
+    :param recipe_method: How the recipes are built from the matches, 'sample' draws them at random
+        with permute_stitching_recipes and 'assignment' builds them by min-cost assignment with
+        assign_stitching_recipes, in which case reproducible, seed and n_workers are not used.
+        Defaults to 'sample'.
+    :param match_cache: A MatchCache to reuse the matches of earlier calls with the same target
+        data, archive data, tol and metric from. Defaults to None, matching every time.
+    :param catalog: The PangeoCatalog to look up the files of the recipe in. Defaults to None, the
+        catalog of the package Pangeo table, see pangeo_catalog.
+
+    :type N_matches: int
+    :type res: str
+    :type tol: float
+    :type non_tas_variables: list[str]
+    :type reproducible: bool
+    :type n_workers: int
+    :type recipe_method: str
+
+    :return: A pandas DataFrame of a formatted recipe.
+    """
+    if recipe_method not in ["sample", "assignment"]:
+        raise TypeError("recipe_method: must be 'sample' or 'assignment'")
+
+    # Build the archive index once, it is used to match and to rematch duplicates.
+    archive_data = as_archive_index(archive_data)
+
+    target_data, archive_data, wide_df = prepare_recipe_inputs(
+        target_data,
+        archive_data,
+        N_matches,
+        res,
+        tol,
+        non_tas_variables,
+        catalog=catalog,
+    )
+
+    # Match the archive & target data together.
+    match_df = match_recipe_targets(
+        target_data, archive_data, tol, metric=metric, match_cache=match_cache
+    )
+
+    unformatted_recipe = build_recipes(
+        match_df,
+        archive_data,
+        N_matches,
+        reproducible=reproducible,
+        metric=metric,
+        seed=seed,
+        n_workers=n_workers,
+        recipe_method=recipe_method,
+    )
+
+    out = format_recipe(
+        unformatted_recipe, res, non_tas_variables, wide_df, catalog=catalog
+    )
+    return out
+
+
+def iter_recipes(
+    target_data,
+    archive_data,
+    N_matches: int,
+    res: str = "mon",
+    tol: float = 0.1,
+    non_tas_variables: [str] = None,
+    reproducible: bool = False,
+    metric=None,
+    seed=None,
+    match_cache=None,
+    catalog=None,
+):
+    """
+    Generate the stitching recipes of make_recipe one at a time.
+
+    The target data is matched up front, but nothing is drawn before the first recipe is
+    taken. The recipes are drawn in the rounds of permute_stitching_recipes, the recipes of
+    a target are generated as soon as it stops drawing and every recipe is only formatted
+    when it is taken. So the stitching of a recipe can start while the next ones are still
+    being drawn. With reproducible=True or a seed, the recipes are the same as the ones
+    make_recipe returns for the same arguments.
+
+    :param target_data: A pandas DataFrame of climate information to emulate.
+    :param archive_data: A pandas DataFrame of temperature data to use as the archive to match on,
+        or a prebuilt ArchiveIndex of it.
+    :param N_matches: The maximum number of matches per target data, or None, see make_recipe.
+    :param res: Resolution of the stitched data, either 'mon' or 'day'.
+    :param tol: Tolerance used in the matching process, default is 0.1.
+    :param non_tas_variables: List of variables other than tas to stitch together; defaults to None,
+        which stitches tas only.
+    :param reproducible: If True, draw the recipes with testing=True, see
+        permute_stitching_recipes; defaults to False.
+    :param metric: The distance metric used for matching, see make_recipe. Defaults to None.
+    :param seed: Seed of the random draws of the recipes, see permute_stitching_recipes.
+        Defaults to None. Can not be combined with reproducible=True.
+    :param match_cache: A MatchCache to reuse the matches from, see make_recipe. Defaults to None.
+    :param catalog: The PangeoCatalog to look up the files of the recipes in, see make_recipe.
+        Defaults to None.
+
+    :type N_matches: int
+    :type res: str
+    :type tol: float
+    :type non_tas_variables: list[str]
+    :type reproducible: bool
+
+    :return: A generator of formatted recipes, a pandas DataFrame for every stitching_id.
+    """
+    # Build the archive index once, it is used to match and to rematch duplicates.
+    archive_data = as_archive_index(archive_data)
+
+    target_data, archive_data, wide_df = prepare_recipe_inputs(
+        target_data,
+        archive_data,
+        N_matches,
+        res,
+        tol,
+        non_tas_variables,
+        catalog=catalog,
+    )
+
+    # Match the archive & target data together.
+    match_df = match_recipe_targets(
+        target_data, archive_data, tol, metric=metric, match_cache=match_cache
+    )
+
+    # Size the number of recipes to what the matches can support.
+    if N_matches is None:
+        N_matches = recipe_capacity(match_df)
+
+    (
+        matched_data_int,
+        targets,
+        generators,
+        num_target_windows,
+        target_start_yrs,
+    ) = plan_recipes(N_matches, match_df, testing=reproducible, seed=seed)
+
+    recipes = serial_recipes(
+        matched_data_int,
+        targets,
+        generators,
+        N_matches,
+        archive_data,
+        num_target_windows,
+        target_start_yrs,
+        testing=reproducible,
+        metric=metric,
+    )
+    return (
+        format_recipe(recipe, res, non_tas_variables, wide_df, catalog=catalog)
+        for recipe in recipes
+    )
+
+
+def make_recipes_batch(
+    jobs,
+    archive_data,
+    metric=None,
+    n_workers: int = None,
+    match_cache=None,
+    catalog=None,
+):
+    """
+    Generate the stitching recipes of many make_recipe calls at once.
+
+    The archive index, the archive subsets covering the non tas variables and the Pangeo
+    catalog are shared by all of the jobs, and jobs with the same target data, res, tol
+    and non tas variables are matched once, so jobs that only differ by N_matches,
+    reproducible, seed or recipe_method reuse the same matches. Every recipe is the same as
+    the one make_recipe returns for the arguments of its job.
+
+    :param jobs: A dictionary of jobs by key, or a list of jobs keyed by their position. A
+        job is a dictionary of make_recipe arguments, the target_data and N_matches entries
+        are required and res, tol, non_tas_variables, reproducible, seed and recipe_method
+        default to the make_recipe defaults.
+    :param archive_data: A pandas DataFrame of temperature data to use as the archive to match on,
+        or a prebuilt ArchiveIndex of it.
+    :param metric: The distance metric used for matching by all of the jobs, see make_recipe.
+        Defaults to None.
+    :param n_workers: The number of processes to draw the recipes of the target ensemble members with,
+        see permute_stitching_recipes. Defaults to None, drawing them one after another.
+    :param match_cache: A MatchCache to reuse the matches of earlier batches or make_recipe calls
+        from, see make_recipe. Defaults to None.
+    :param catalog: The PangeoCatalog to look up the files of the recipes in, see make_recipe.
+        Defaults to None.
+
+    :type n_workers: int
+
+    :return: A dictionary of the formatted recipes, a pandas DataFrame for every job key.
+    """
+    if isinstance(jobs, list):
+        jobs = dict(enumerate(jobs))
+    if not isinstance(jobs, dict):
+        raise TypeError("jobs: must be a dictionary or a list of jobs")
+
+    # Check all of the jobs before starting the first one.
+    for key, job in jobs.items():
+        if not isinstance(job, dict):
+            raise TypeError(f"job {key}: must be a dictionary of make_recipe arguments")
+        unknown = set(job) - set(BATCH_JOB_DEFAULTS)
+        if len(unknown) > 0:
+            raise TypeError(f"job {key}: unknown arguments {sorted(unknown)}")
+        if "target_data" not in job or "N_matches" not in job:
+            raise TypeError(f"job {key}: target_data and N_matches are required")
+        if job.get("recipe_method", "sample") not in ["sample", "assignment"]:
+            raise TypeError(
+                f"job {key}: recipe_method must be 'sample' or 'assignment'"
+            )
+
+    archive_index = as_archive_index(archive_data)
+    if catalog is None and len(jobs) > 0:
+        catalog = pangeo_catalog()
+    subsets = {}
+    matches = {}
+
+    out = {}
+    for key, job in jobs.items():
+        job = {**BATCH_JOB_DEFAULTS, **job}
+        non_tas_variables = job["non_tas_variables"]
+        if type(non_tas_variables) == list:
+            # prepare_recipe_inputs adds tas to the list, keep the one of the job as is.
+            non_tas_variables = list(non_tas_variables)
+            variables = tuple(sorted(set(non_tas_variables)))
+        else:
+            variables = None
+
+        # Equal target data share their matches, even when they are different frames.
+        target_key = util.hash_frame(
+            job["target_data"], match.TARGET_COLUMNS + ["unit"]
+        )
+        match_key = (target_key, job["res"], job["tol"], variables)
+        if match_key in matches:
+            if job["N_matches"] is not None and not type(job["N_matches"]) is int:
+                raise TypeError("N_matches: must be an integer or None")
+            archive, wide_df, match_df = matches[match_key]
+        else:
+            target, archive, wide_df = prepare_recipe_inputs(
+                job["target_data"],
+                archive_index,
+                job["N_matches"],
+                job["res"],
+                job["tol"],
+                non_tas_variables,
+                subsets=subsets,
+                catalog=catalog,
+            )
+            match_df = match_recipe_targets(
+                target, archive, job["tol"], metric=metric, match_cache=match_cache
+            )
+            matches[match_key] = [archive, wide_df, match_df]
+
+        unformatted_recipe = build_recipes(
+            match_df,
+            archive,
+            job["N_matches"],
+            reproducible=job["reproducible"],
+            metric=metric,
+            seed=job["seed"],
+            n_workers=n_workers,
+            recipe_method=job["recipe_method"],
+        )
+        out[key] = format_recipe(
+            unformatted_recipe, job["res"], non_tas_variables, wide_df, catalog=catalog
+        )
+        logger.info("Made the recipe of job %s", key)
+
+    return out
@@ -15,6 +15,7 @@ import xarray as xr
 import stitches.fx_data as data
 import stitches.fx_pangeo as pangeo
 import stitches.fx_util as util
+from stitches.fx_compact import as_recipe_frame
 
 
 def find_zfiles(rp):
@@ -248,13 +249,15 @@ def gridded_stitching(out_dir: str, rp):
 
     :param out_dir: Directory location where to write the NetCDF files.
     :type out_dir: str
-    :param rp: DataFrame of the recipe including variables to stitch.
+    :param rp: DataFrame of the recipe including variables to stitch, or its Recipe.
     :return: List of the NetCDF file paths.
     """
     flag = os.path.isdir(out_dir)
     if not flag:
         raise TypeError("The output directory does not exist.")
 
+    rp = as_recipe_frame(rp)
+
     # Check inputs.
     util.check_columns(
         rp,
@@ -412,9 +415,11 @@ def gmat_stitching(rp):
     """
     Stitch together a time series of global tas data based on a recipe data frame.
 
-    :param rp: A fully formatted recipe data frame as a pandas DataFrame.
+    :param rp: A fully formatted recipe data frame as a pandas DataFrame, or its Recipe.
     :return: A pandas DataFrame of stitched together tas data.
     """
+    rp = as_recipe_frame(rp)
+
     # Check inputs.
     util.check_columns(
         rp,
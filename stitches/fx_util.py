@@ -1,5 +1,6 @@
 """This module contains helper functions used throughout the stitches package."""
 
+import hashlib
 import os
 from importlib import resources
 
@@ -87,6 +88,24 @@ def check_columns(data, names):
         raise TypeError(f'Missing columns from "{data}".')
 
 
+def hash_frame(df, columns):
+    """
+    Return a hash of the content of some columns of a data frame.
+
+    The hash depends on the column names, the values and the row order but not on
+    the row index, so copies and subsets with a reset index hash the same.
+
+    :param df: A pandas DataFrame.
+    :param columns: List of the columns to hash.
+    :return: The hexadecimal SHA-256 digest of the columns.
+    """
+    check_columns(df, set(columns))
+    digest = hashlib.sha256("|".join(columns).encode())
+    rows = pd.util.hash_pandas_object(df[columns], index=False)
+    digest.update(rows.to_numpy().tobytes())
+    return digest.hexdigest()
+
+
 def nrow(df):
     """
     Return the number of rows in the data frame.
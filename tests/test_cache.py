@@ -0,0 +1,101 @@
+import os
+import tempfile
+import unittest
+from importlib import resources
+
+import pandas as pd
+
+from stitches.fx_cache import MatchCache
+from stitches.fx_index import ArchiveIndex
+from stitches.fx_match import match_neighborhood
+
+
+class TestCache(unittest.TestCase):
+    """Unit tests for the MatchCache."""
+
+    path = resources.files("stitches") / "data" / "example" / "test-target_dat.csv"
+    TARGET_DATA = pd.read_csv(path)
+    path = resources.files("stitches") / "data" / "example" / "test-archive_dat.csv"
+    ARCHIVE_DATA = pd.read_csv(path)
+
+    def test_key(self):
+        """Test that the keys depend on the content of the data and the matching arguments."""
+        cache = MatchCache()
+        key = cache.key(self.TARGET_DATA, self.ARCHIVE_DATA, tol=0.1)
+
+        # Copies of the data and an ArchiveIndex of the archive have the same key.
+        index = ArchiveIndex(self.ARCHIVE_DATA)
+        self.assertEqual(index.fingerprint, ArchiveIndex(index.data).fingerprint)
+        self.assertEqual(cache.key(self.TARGET_DATA.copy(), index, tol=0.1), key)
+
+        target = self.TARGET_DATA.copy()
+        target.loc[0, "fx"] += 1
+        self.assertNotEqual(cache.key(target, self.ARCHIVE_DATA, tol=0.1), key)
+        self.assertNotEqual(cache.key(self.TARGET_DATA, self.ARCHIVE_DATA, 0.2), key)
+        self.assertNotEqual(
+            cache.key(self.TARGET_DATA, self.ARCHIVE_DATA, 0.1, False), key
+        )
+        self.assertNotEqual(
+            cache.key(self.TARGET_DATA, self.ARCHIVE_DATA, 0.1, metric=(1, 2)), key
+        )
+        self.assertNotEqual(
+            cache.key(self.TARGET_DATA, index.subset(index.fx > 1), tol=0.1), key
+        )
+
+    def test_match(self):
+        """Test that the cached matches are the matches, and the hit and miss counters."""
+        cache = MatchCache(max_entries=2)
+        expected = match_neighborhood(self.TARGET_DATA, self.ARCHIVE_DATA, tol=0.1)
+
+        out = cache.match(self.TARGET_DATA, self.ARCHIVE_DATA, tol=0.1)
+        pd.testing.assert_frame_equal(out, expected)
+
+        # Changing the returned matches does not change the cached ones.
+        out["dist_l2"] = 0
+        out = cache.match(self.TARGET_DATA, ArchiveIndex(self.ARCHIVE_DATA), tol=0.1)
+        pd.testing.assert_frame_equal(out, expected)
+        self.assertEqual(
+            cache.stats(), {"hits": 1, "misses": 1, "evictions": 0, "entries": 1}
+        )
+
+        # The least recently used matches are evicted.
+        cache.match(self.TARGET_DATA, self.ARCHIVE_DATA, tol=0.0)
+        cache.match(self.TARGET_DATA, self.ARCHIVE_DATA, tol=0.1)
+        cache.match(self.TARGET_DATA, self.ARCHIVE_DATA, tol=0.2)
+        self.assertEqual(
+            cache.stats(), {"hits": 2, "misses": 3, "evictions": 1, "entries": 2}
+        )
+        self.assertIsNone(cache.get(cache.key(self.TARGET_DATA, self.ARCHIVE_DATA)))
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        with self.assertRaises(TypeError):
+            MatchCache(max_entries=0)
+
+    def test_disk(self):
+        """Test that caches using the same directory share the matches."""
+        with tempfile.TemporaryDirectory() as tmp:
+            first = MatchCache(max_entries=1, path=tmp)
+            expected = first.match(self.TARGET_DATA, self.ARCHIVE_DATA, tol=0.1)
+
+            second = MatchCache(path=tmp)
+            out = second.match(self.TARGET_DATA, self.ARCHIVE_DATA, tol=0.1)
+            pd.testing.assert_frame_equal(out, expected)
+            self.assertEqual((second.hits, second.misses), (1, 0))
+
+            # The directory keeps max_entries matches too, and the other files in it
+            # are left alone.
+            other = os.path.join(tmp, "archive.pkl")
+            pd.to_pickle(self.ARCHIVE_DATA, other)
+            first.match(self.TARGET_DATA, self.ARCHIVE_DATA, tol=0.2)
+            self.assertEqual(len(first.cache_files()), 1)
+            self.assertTrue(os.path.exists(other))
+
+            first.clear()
+            self.assertEqual(os.listdir(tmp), ["archive.pkl"])
+            with self.assertRaises(TypeError):
+                MatchCache(path=os.path.join(tmp, "missing"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+import os
+import tempfile
+import unittest
+
+import pandas as pd
+
+from stitches.fx_catalog import PangeoCatalog, pangeo_catalog, read_catalog
+
+
+class TestCatalog(unittest.TestCase):
+    """Unit tests for the PangeoCatalog."""
+
+    PANGEO_TABLE = pd.DataFrame(
+        data={
+            "model": ["m1"] * 7 + ["m2"] * 2,
+            "experiment": ["ssp245"] * 5 + ["historical"] * 2 + ["ssp245"] * 2,
+            "ensemble": ["r1i1p1f1"] * 3 + ["r2i1p1f1"] * 2 + ["r1i1p1f1"] * 4,
+            "variable": ["tas", "pr", "tas", "tas", "pr", "tas", "pr", "tas", "pr"],
+            "domain": ["Amon", "Amon", "day", "Amon", "day", "Amon", "Amon"]
+            + ["Amon", "Amon"],
+            "zstore": ["gs://cmip6/" + str(i) for i in range(8)]
+            + ["gs://cmip6/AerChemMIP/8"],
+        }
+    )
+
+    def test_lookup(self):
+        """Test looking up files in the catalog."""
+        catalog = PangeoCatalog(self.PANGEO_TABLE)
+        self.assertEqual(catalog.variables, {"tas", "pr"})
+
+        tas = catalog.lookup(variable="tas", domain="Amon")
+        expected = self.PANGEO_TABLE.loc[
+            (self.PANGEO_TABLE["variable"] == "tas")
+            & (self.PANGEO_TABLE["domain"] == "Amon")
+        ]
+        self.assertEqual(set(tas["zstore"]), set(expected["zstore"]))
+        self.assertFalse(isinstance(tas["model"].dtype, pd.CategoricalDtype))
+
+        # Lists select several values, values the catalog does not have select nothing.
+        out = catalog.lookup(model="m1", experiment=["ssp245", "ssp585"], domain="day")
+        self.assertEqual(list(out["zstore"]), ["gs://cmip6/2", "gs://cmip6/4"])
+        self.assertEqual(len(catalog.lookup(model="m3")), 0)
+        self.assertEqual(len(catalog.lookup()), len(self.PANGEO_TABLE))
+
+    def test_coverage(self):
+        """Test the table of the files covering a set of variables."""
+        catalog = PangeoCatalog(self.PANGEO_TABLE)
+
+        # Only m1 r1i1p1f1 has both variables in monthly domains, m2 is from AerChemMIP.
+        wide_df = catalog.coverage("mon", ["pr", "tas"])
+        self.assertEqual(
+            list(wide_df.columns),
+            ["model", "ensemble", "experiment", "pr_file", "tas_file"],
+        )
+        self.assertEqual(
+            wide_df[["model", "ensemble", "experiment"]].values.tolist(),
+            [["m1", "r1i1p1f1", "historical"], ["m1", "r1i1p1f1", "ssp245"]],
+        )
+        self.assertEqual(list(wide_df["tas_file"]), ["gs://cmip6/5", "gs://cmip6/0"])
+
+        # The table is kept, and changing the returned copy does not change it.
+        wide_df["tas_file"] = None
+        pd.testing.assert_frame_equal(
+            catalog.coverage("mon", ["tas", "pr", "tas"]),
+            catalog.coverage("mon", ["pr", "tas"]),
+        )
+        self.assertEqual(len(catalog._coverage), 1)
+        self.assertEqual(len(catalog.coverage("day", ["pr", "tas"])), 0)
+
+    def test_pangeo_catalog(self):
+        """Test that the catalog of a table is loaded once and kept up to date."""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "pangeo_table.csv")
+            self.PANGEO_TABLE.to_csv(path, index=False)
+
+            catalog = pangeo_catalog(path)
+            self.assertIs(pangeo_catalog(path), catalog)
+            self.assertEqual(len(catalog.table), len(self.PANGEO_TABLE))
+
+            # Nothing is written without a cache directory.
+            self.assertEqual(os.listdir(tmp), ["pangeo_table.csv"])
+
+            # A new table is read again.
+            self.PANGEO_TABLE.head(3).to_csv(path, index=False)
+            os.utime(path, ns=(0, 0))
+            self.assertEqual(len(pangeo_catalog(path).table), 3)
+
+    def test_pangeo_catalog_cache_dir(self):
+        """Test the binary copy of the catalog kept in a cache directory."""
+        with tempfile.TemporaryDirectory() as tmp, tempfile.TemporaryDirectory() as cache:
+            path = os.path.join(tmp, "pangeo_table.csv")
+            self.PANGEO_TABLE.to_csv(path, index=False)
+
+            catalog = pangeo_catalog(path, cache_dir=cache)
+            self.assertEqual(os.listdir(tmp), ["pangeo_table.csv"])
+            files = os.listdir(cache)
+            self.assertEqual(len(files), 1)
+            self.assertTrue(files[0].startswith("pangeo-catalog-"))
+            self.assertEqual(
+                PangeoCatalog.load(os.path.join(cache, files[0])).source,
+                catalog.source,
+            )
+
+            # A table with other content with the same modification time and size is
+            # not read from the binary copy of the first one.
+            stat = os.stat(path)
+            swapped = self.PANGEO_TABLE.assign(
+                zstore=self.PANGEO_TABLE["zstore"].str.replace("cmip6", "cmip7")
+            )
+            swapped.to_csv(path, index=False)
+            self.assertEqual(os.stat(path).st_size, stat.st_size)
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            read_catalog.cache_clear()
+            out = pangeo_catalog(path, cache_dir=cache)
+            self.assertTrue(out.table["zstore"].str.contains("cmip7").all())
+            self.assertEqual(len(os.listdir(cache)), 2)
+
+            # A binary copy that cannot be read falls back on the CSV file.
+            for file in os.listdir(cache):
+                with open(os.path.join(cache, file), "wb") as f:
+                    f.write(b"not a catalog")
+            read_catalog.cache_clear()
+            out = pangeo_catalog(path, cache_dir=cache)
+            self.assertEqual(len(out.table), len(self.PANGEO_TABLE))
+
+            with self.assertRaises(TypeError):
+                pangeo_catalog(path, cache_dir=os.path.join(tmp, "missing"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from stitches.fx_compact import Recipe, as_recipe_frame
+
+
+class TestCompact(unittest.TestCase):
+    """Unit tests for the compact Recipe."""
+
+    RECIPE = pd.DataFrame(
+        data={
+            "target_start_yr": [1850, 1859, 1850, 1859],
+            "target_end_yr": [1858, 1867, 1858, 1867],
+            "archive_experiment": ["historical"] * 4,
+            "archive_variable": ["tas"] * 4,
+            "archive_model": ["m1"] * 4,
+            "archive_ensemble": ["r1i1p1f1", "r2i1p1f1", "r2i1p1f1", "r1i1p1f1"],
+            "stitching_id": ["ssp245~r1i1p1f1~1"] * 2 + ["ssp245~r1i1p1f1~2"] * 2,
+            "archive_start_yr": [1850, 1859, 1850, 1859],
+            "archive_end_yr": [1858, 1867, 1858, 1867],
+            "tas_file": ["gs://cmip6/r1", "gs://cmip6/r2", "gs://cmip6/r2", None],
+            "weight": [0.5, 1.0, 1.5, 2.0],
+        }
+    )
+
+    def test_recipe(self):
+        """Test that the Recipe is compact and expands into the recipe data frame."""
+        recipe = Recipe(TestCompact.RECIPE)
+        self.assertEqual(len(recipe), 4)
+        pd.testing.assert_frame_equal(recipe.to_frame(), TestCompact.RECIPE)
+        self.assertEqual(
+            list(recipe.stitching_ids()), ["ssp245~r1i1p1f1~1", "ssp245~r1i1p1f1~2"]
+        )
+
+        # Every string is kept once, the codes and years use small integer types.
+        self.assertEqual(len(recipe.strings), len(set(recipe.strings)))
+        self.assertEqual(recipe.codes["tas_file"][3], -1)
+        self.assertEqual(recipe.codes["stitching_id"].dtype, np.int8)
+        self.assertEqual(recipe.ints["target_start_yr"].dtype, np.uint16)
+        self.assertLess(recipe.nbytes, TestCompact.RECIPE.memory_usage(deep=True).sum())
+
+        self.assertIs(as_recipe_frame(TestCompact.RECIPE), TestCompact.RECIPE)
+        pd.testing.assert_frame_equal(as_recipe_frame(recipe), TestCompact.RECIPE)
+        with self.assertRaises(TypeError):
+            Recipe(TestCompact.RECIPE.to_dict())
+
+    def test_save_load(self):
+        """Test saving a Recipe to disk and loading it back."""
+        recipe = Recipe(TestCompact.RECIPE)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "recipe.pkl")
+            recipe.save(path)
+            pd.testing.assert_frame_equal(
+                Recipe.load(path).to_frame(), TestCompact.RECIPE
+            )
+
+            # Files of other objects are rejected.
+            pd.to_pickle(TestCompact.RECIPE, path)
+            with self.assertRaises(TypeError):
+                Recipe.load(path)
+
+
+if __name__ == "__main__":
+    unittest.main()
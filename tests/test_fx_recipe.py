@@ -1,13 +1,28 @@
+import math
 import unittest
 from importlib import resources
 
+import numpy as np
 import pandas as pd
 
+from stitches.fx_cache import MatchCache
+from stitches.fx_catalog import PangeoCatalog
 from stitches.fx_match import match_neighborhood
 from stitches.fx_recipe import (
+    RecipeSampler,
+    assign_stitching_recipes,
     get_num_perms,
+    handle_final_period,
+    handle_transition_periods,
+    iter_recipes,
+    make_recipe,
+    make_recipes_batch,
+    max_disjoint_recipes,
     permute_stitching_recipes,
+    plan_recipes,
     remove_duplicates,
+    serial_recipes,
+    tolerance_sweep,
 )
 from stitches.fx_util import check_columns
 
@@ -507,6 +522,142 @@ class TestRecipe(unittest.TestCase):
         )
         self.assertEqual(len(out), 2, "Test get_num_perms")
 
+    def test_num_perms_log(self):
+        """Test that the number of permutations is also reported in log space."""
+        matched = match_neighborhood(
+            TestRecipe.TARGET_DATA, TestRecipe.ARCHIVE_DATA, tol=0.2
+        )
+        out = get_num_perms(matched)
+
+        # The exact number of permutations, it does not fit in an int64.
+        total = 1
+        for n in out[1]["n_matches"]:
+            total *= int(n)
+        self.assertGreater(total, np.iinfo(np.int64).max)
+        self.assertAlmostEqual(
+            out[0]["log10TotalNumPerms"].iloc[0], math.log10(total), places=9
+        )
+
+    def test_tolerance_sweep(self):
+        """Test that tolerance_sweep counts the same matches as matching each tol."""
+        tols = [0.0, 0.05, 0.1, 0.2]
+        out = tolerance_sweep(TestRecipe.TARGET_DATA, TestRecipe.ARCHIVE_DATA, tols)
+        self.assertEqual(len(out), 2)
+        self.assertEqual(len(out[0]), len(tols))
+
+        for tol in tols:
+            matched = match_neighborhood(
+                TestRecipe.TARGET_DATA, TestRecipe.ARCHIVE_DATA, tol=tol
+            )
+            perms = get_num_perms(matched)
+            counts = out[1].loc[out[1]["tol"] == tol]
+            self.assertEqual(
+                list(counts["n_matches"]), list(perms[1]["n_matches"]), tol
+            )
+            summary = out[0].loc[out[0]["tol"] == tol]
+            self.assertEqual(
+                summary["minNumMatches"].iloc[0], perms[0]["minNumMatches"].iloc[0]
+            )
+            self.assertEqual(
+                summary["maxNumRecipes"].iloc[0],
+                max_disjoint_recipes(matched)["maxNumRecipes"].iloc[0],
+            )
+
+        with self.assertRaises(TypeError):
+            tolerance_sweep(TestRecipe.TARGET_DATA, TestRecipe.ARCHIVE_DATA, [-0.1])
+
+    def test_handle_periods(self):
+        """Test splitting the transition periods and trimming the final periods."""
+        recipe = pd.DataFrame(
+            data={
+                "target_variable": ["tas"] * 6,
+                "target_experiment": ["ssp245"] * 6,
+                "target_ensemble": ["r1i1p1f1"] * 6,
+                "target_model": ["test_model"] * 6,
+                "target_start_yr": [1850, 2008, 2094, 1850, 2005, 2094],
+                "target_end_yr": [1858, 2016, 2099, 1858, 2013, 2100],
+                "target_year": [1854, 2012, 2096, 1854, 2009, 2097],
+                "target_fx": [0.0] * 6,
+                "target_dx": [0.0] * 6,
+                "archive_experiment": [
+                    "ssp245",
+                    "ssp585",
+                    "ssp126",
+                    "ssp585",
+                    "ssp126",
+                    "ssp585",
+                ],
+                "archive_variable": ["tas"] * 6,
+                "archive_model": ["test_model"] * 6,
+                "archive_ensemble": [
+                    "r2i1p1f1",
+                    "r1i1p1f1",
+                    "r3i1p1f1",
+                    "r1i1p1f1",
+                    "r2i1p1f1",
+                    "r3i1p1f1",
+                ],
+                "archive_start_yr": [1850, 2010, 2094, 1859, 2014, 2092],
+                "archive_end_yr": [1858, 2018, 2100, 1867, 2022, 2097],
+                "archive_year": [1854, 2014, 2097, 1863, 2018, 2094],
+                "archive_fx": [0.0] * 6,
+                "archive_dx": [0.0] * 6,
+                "dist_dx": [0.0] * 6,
+                "dist_fx": [0.0] * 6,
+                "dist_l2": [0.0] * 6,
+                "stitching_id": ["ssp245~r1i1p1f1~1"] * 3 + ["ssp245~r1i1p1f1~2"] * 3,
+            }
+        )
+
+        # The output of the previous row by row implementation.
+        expected = pd.DataFrame(
+            data={
+                "target_start_yr": [1850, 2008, 2013, 2094, 1850, 2005, 2006, 2094],
+                "target_end_yr": [1858, 2012, 2016, 2099, 1858, 2005, 2013, 2100],
+                "archive_experiment": [
+                    "ssp245",
+                    "historical",
+                    "ssp585",
+                    "ssp126",
+                    "ssp585",
+                    "historical",
+                    "ssp126",
+                    "ssp585",
+                ],
+                "archive_variable": ["tas"] * 8,
+                "archive_model": ["test_model"] * 8,
+                "archive_ensemble": [
+                    "r2i1p1f1",
+                    "r1i1p1f1",
+                    "r1i1p1f1",
+                    "r3i1p1f1",
+                    "r1i1p1f1",
+                    "r2i1p1f1",
+                    "r2i1p1f1",
+                    "r3i1p1f1",
+                ],
+                "stitching_id": ["ssp245~r1i1p1f1~1"] * 4 + ["ssp245~r1i1p1f1~2"] * 4,
+                "archive_start_yr": [1850, 2010, 2015, 2094, 1859, 2014, 2015, 2091],
+                "archive_end_yr": [1858, 2014, 2018, 2099, 1867, 2014, 2022, 2097],
+            }
+        )
+        out = handle_final_period(handle_transition_periods(recipe))
+        pd.testing.assert_frame_equal(out, expected, check_dtype=False)
+
+        # The transition periods are split in place, the final periods are unchanged.
+        out = handle_transition_periods(recipe)
+        self.assertEqual(
+            list(out["archive_end_yr"]),
+            [1858, 2014, 2018, 2100, 1867, 2014, 2022, 2097],
+        )
+        self.assertEqual(list(out.columns), list(expected.columns))
+
+        # A target period that is too short for the split archive period.
+        with self.assertRaises(TypeError):
+            handle_transition_periods(
+                recipe.assign(target_end_yr=recipe["target_end_yr"] - 1)
+            )
+
     def test_remove_duplicates(self):
         """
         Test the remove_duplicates function for correct operation.
@@ -551,6 +702,409 @@ class TestRecipe(unittest.TestCase):
             TestRecipe.NEW_MATCHES,
         )
 
+    def test_recipe_sampler(self):
+        """Test drawing candidate recipes with the RecipeSampler."""
+        matched = match_neighborhood(
+            TestRecipe.TARGET_DATA, TestRecipe.ARCHIVE_DATA, tol=0.1
+        ).reset_index(drop=True)
+        sampler = RecipeSampler(matched)
+        windows = sampler.target_windows("tas", "ssp245", "test_model", "r1i1p1f1")
+        self.assertEqual(len(windows), len(TestRecipe.TARGET_DATA))
+
+        # The candidate counts are the counts of get_num_perms.
+        counts = get_num_perms(matched)[1].sort_values("target_start_yr")
+        self.assertEqual(list(sampler.counts(windows)), list(counts["n_matches"]))
+
+        # A draw has one candidate of each window, in window order, and can be repeated.
+        rows = sampler.draw(windows, testing=True)
+        recipe = matched.take(rows)
+        self.assertEqual(
+            list(recipe["target_start_yr"]), sorted(TestRecipe.TARGET_DATA["start_yr"])
+        )
+        np.testing.assert_array_equal(rows, sampler.draw(windows, testing=True))
+
+        # Used candidates are never drawn again.
+        sampler.remove(recipe)
+        self.assertEqual(list(sampler.counts(windows)), list(counts["n_matches"] - 1))
+        while np.all(sampler.counts(windows) > 0):
+            rows = sampler.draw(windows)
+            self.assertTrue(len(set(rows).intersection(recipe.index)) == 0)
+            sampler.remove(matched.take(rows))
+
+    def test_permute_rejected_draws(self):
+        """Test that the recipe draws are logged with the number of rejected draws."""
+        with self.assertLogs("stitches.fx_recipe", "INFO") as logs:
+            recipes = permute_stitching_recipes(
+                N_matches=2,
+                matched_data=match_neighborhood(
+                    TestRecipe.TARGET_DATA, TestRecipe.ARCHIVE_DATA, tol=0.2
+                ),
+                archive=TestRecipe.ARCHIVE_DATA,
+                testing=True,
+            )
+        n_recipes = len(recipes["stitching_id"].unique())
+        self.assertIn(
+            f"ssp245~r1i1p1f1: drew {n_recipes} recipes, rejected 0 draws",
+            logs.output[0],
+        )
+
+    def test_permute_seed(self):
+        """Test that seeded recipe draws are reproducible."""
+        matched = match_neighborhood(
+            TestRecipe.TARGET_DATA, TestRecipe.ARCHIVE_DATA, tol=0.2
+        )
+
+        def draw(seed):
+            return permute_stitching_recipes(
+                N_matches=3,
+                matched_data=matched,
+                archive=TestRecipe.ARCHIVE_DATA,
+                seed=seed,
+            )
+
+        pd.testing.assert_frame_equal(draw(42), draw(42))
+        pd.testing.assert_frame_equal(
+            draw(np.random.default_rng(7)), draw(np.random.default_rng(7))
+        )
+        pd.testing.assert_frame_equal(
+            draw(np.random.SeedSequence(3)), draw(np.random.SeedSequence(3))
+        )
+        self.assertFalse(draw(42).equals(draw(43)))
+
+        with self.assertRaises(TypeError):
+            draw("42")
+        with self.assertRaises(TypeError):
+            permute_stitching_recipes(
+                N_matches=3,
+                matched_data=matched,
+                archive=TestRecipe.ARCHIVE_DATA,
+                testing=True,
+                seed=42,
+            )
+
+    def test_permute_seed_workers(self):
+        """Test that seeded recipe draws of several targets do not depend on the workers."""
+        targets = pd.concat(
+            [
+                TestRecipe.TARGET_DATA,
+                TestRecipe.TARGET_DATA.assign(
+                    ensemble="r2i1p1f1", fx=TestRecipe.TARGET_DATA["fx"] + 0.1
+                ),
+            ]
+        )
+        matched = match_neighborhood(targets, TestRecipe.ARCHIVE_DATA, tol=0.2)
+
+        def draw(seed, n_workers=None):
+            return permute_stitching_recipes(
+                N_matches=3,
+                matched_data=matched,
+                archive=TestRecipe.ARCHIVE_DATA,
+                seed=seed,
+                n_workers=n_workers,
+            )
+
+        for seed in [
+            lambda: 4,
+            lambda: np.random.default_rng(7),
+            lambda: np.random.SeedSequence(3),
+        ]:
+            recipes = draw(seed())
+            self.assertEqual(len(recipes["target_ensemble"].unique()), 2)
+            pd.testing.assert_frame_equal(recipes, draw(seed(), n_workers=2))
+
+    def test_permute_parallel(self):
+        """Test drawing the recipes of several targets in a process pool."""
+        targets = pd.concat(
+            [
+                TestRecipe.TARGET_DATA,
+                TestRecipe.TARGET_DATA.assign(
+                    ensemble="r2i1p1f1", fx=TestRecipe.TARGET_DATA["fx"] + 0.3
+                ),
+            ]
+        )
+        matched = match_neighborhood(targets, TestRecipe.ARCHIVE_DATA, tol=0.2)
+
+        def draw(matched, **kwargs):
+            return permute_stitching_recipes(
+                N_matches=3,
+                matched_data=matched,
+                archive=TestRecipe.ARCHIVE_DATA,
+                **kwargs,
+            )
+
+        # The recipes do not depend on the number of workers and every recipe is complete.
+        recipes = draw(matched, seed=11, n_workers=2)
+        pd.testing.assert_frame_equal(recipes, draw(matched, seed=11, n_workers=3))
+        self.assertEqual(set(recipes["target_ensemble"]), {"r1i1p1f1", "r2i1p1f1"})
+        self.assertTrue(
+            (
+                recipes.groupby("stitching_id").size() == len(TestRecipe.TARGET_DATA)
+            ).all()
+        )
+
+        # The recipes of several targets do not depend on drawing them in a process pool.
+        pd.testing.assert_frame_equal(draw(matched, seed=11), recipes)
+        pd.testing.assert_frame_equal(
+            draw(matched, seed=11, n_workers=1), draw(matched, seed=11, n_workers=2)
+        )
+
+        # A single target draws the same recipes as in one process.
+        single = matched.loc[matched["target_ensemble"] == "r1i1p1f1"]
+        pd.testing.assert_frame_equal(
+            draw(single, seed=11, n_workers=2), draw(single, seed=11)
+        )
+
+        with self.assertRaises(TypeError):
+            draw(matched, n_workers=0)
+
+    def test_serial_recipes(self):
+        """Test that drawing the recipes one at a time draws the permuted recipes."""
+        matched = match_neighborhood(
+            TestRecipe.TARGET_DATA, TestRecipe.ARCHIVE_DATA, tol=0.2
+        )
+        data, targets, generators, n_windows, start_yrs = plan_recipes(
+            3, matched, seed=5
+        )
+        state = generators[0].bit_generator.state
+        recipes = serial_recipes(
+            data,
+            targets,
+            generators,
+            3,
+            TestRecipe.ARCHIVE_DATA,
+            n_windows,
+            start_yrs,
+        )
+
+        # Nothing is drawn until the first recipe is taken.
+        self.assertEqual(generators[0].bit_generator.state, state)
+        first = next(recipes)
+        self.assertEqual(list(first["stitching_id"].unique()), ["ssp245~r1i1p1f1~1"])
+        self.assertNotEqual(generators[0].bit_generator.state, state)
+
+        pd.testing.assert_frame_equal(
+            pd.concat([first] + list(recipes)).reset_index(drop=True),
+            permute_stitching_recipes(3, matched, TestRecipe.ARCHIVE_DATA, seed=5),
+        )
+
+    def test_assign_stitching_recipes(self):
+        """Test building the recipes by min-cost assignment."""
+        targets = pd.concat(
+            [
+                TestRecipe.TARGET_DATA,
+                TestRecipe.TARGET_DATA.assign(
+                    ensemble="r2i1p1f1", fx=TestRecipe.TARGET_DATA["fx"] + 0.05
+                ),
+            ]
+        )
+        matched = match_neighborhood(targets, TestRecipe.ARCHIVE_DATA, tol=0.2)
+        max_recipes = max_disjoint_recipes(matched)
+        self.assertEqual(list(max_recipes["target_ensemble"]), ["r1i1p1f1", "r2i1p1f1"])
+        num_perms = get_num_perms(matched)[0]
+        self.assertTrue(
+            (max_recipes["maxNumRecipes"] <= num_perms["minNumMatches"]).all()
+        )
+
+        # Every recipe is complete and collapse free, and no pair is used twice.
+        recipes = assign_stitching_recipes(50, matched)
+        archive_cols = [
+            col for col in RecipeSampler.PAIR_COLUMNS if col.startswith("archive_")
+        ]
+        for _, recipe in recipes.groupby("stitching_id"):
+            self.assertEqual(len(recipe), len(TestRecipe.TARGET_DATA))
+            self.assertFalse(recipe.duplicated(subset=archive_cols).any())
+        self.assertFalse(recipes.duplicated(subset=RecipeSampler.PAIR_COLUMNS).any())
+
+        # A single target gets the maximum number of disjoint recipes, and the first
+        # recipe is the collapse free recipe closest to the target.
+        single = matched.loc[matched["target_ensemble"] == "r1i1p1f1"]
+        recipes = assign_stitching_recipes(50, single)
+        self.assertEqual(
+            recipes["stitching_id"].nunique(), max_recipes["maxNumRecipes"].iloc[0]
+        )
+        first = recipes.loc[recipes["stitching_id"] == "ssp245~r1i1p1f1~1"]
+        self.assertAlmostEqual(
+            first["dist_l2"].sum(),
+            recipes.groupby("stitching_id")["dist_l2"].sum().min(),
+        )
+
+        # Asking for fewer recipes returns the first of them.
+        pd.testing.assert_frame_equal(
+            assign_stitching_recipes(1, single), first.reset_index(drop=True)
+        )
+
+        # Without N_matches every target gets as many recipes as it can support.
+        recipes = assign_stitching_recipes(None, single)
+        self.assertEqual(
+            recipes["stitching_id"].nunique(), max_recipes["maxNumRecipes"].iloc[0]
+        )
+
+        with self.assertRaises(TypeError):
+            assign_stitching_recipes(1.5, matched)
+
+    def test_max_disjoint_recipes(self):
+        """Test the maximum number of disjoint recipes on a small candidate graph."""
+        target = TestRecipe.TARGET_DATA.head(3)
+        matched = match_neighborhood(target, target, tol=10.0)
+
+        # Three target windows matching the same three archive windows make three
+        # disjoint recipes.
+        self.assertEqual(max_disjoint_recipes(matched)["maxNumRecipes"].iloc[0], 3)
+
+        # Every target window keeps two candidates but the first archive window is a
+        # candidate of all of them, so two recipes would need it three times.
+        years = list(target["year"])
+        keep = {(years[i], years[j]) for i, j in [(0, 0), (0, 1), (1, 0), (1, 2)]}
+        keep |= {(years[2], years[0]), (years[2], years[2])}
+        shared = matched.loc[
+            [
+                pair in keep
+                for pair in zip(matched["target_year"], matched["archive_year"])
+            ]
+        ]
+        self.assertEqual(get_num_perms(shared)[0]["minNumMatches"].iloc[0], 2)
+        self.assertEqual(max_disjoint_recipes(shared)["maxNumRecipes"].iloc[0], 1)
+
+    def test_make_recipes_batch(self):
+        """Test that the jobs of a batch are checked before any recipe is made."""
+        job = {"target_data": TestRecipe.TARGET_DATA, "N_matches": 2}
+        with self.assertRaises(TypeError):
+            make_recipes_batch(job, TestRecipe.ARCHIVE_DATA)
+        with self.assertRaises(TypeError):
+            make_recipes_batch(
+                [job, {**job, "tolerance": 0.1}], TestRecipe.ARCHIVE_DATA
+            )
+        with self.assertRaises(TypeError):
+            make_recipes_batch(
+                [job, {"target_data": TestRecipe.TARGET_DATA}], TestRecipe.ARCHIVE_DATA
+            )
+        with self.assertRaises(TypeError):
+            make_recipes_batch(
+                {"a": job, "b": {**job, "recipe_method": "greedy"}},
+                TestRecipe.ARCHIVE_DATA,
+            )
+        self.assertEqual(make_recipes_batch({}, TestRecipe.ARCHIVE_DATA), {})
+
+    def test_make_recipes_batch_jobs(self):
+        """Test that a batch makes the recipes of make_recipe and shares the matches."""
+        target = TestRecipe.TARGET_DATA.assign(unit="degC")
+        archive = TestRecipe.ARCHIVE_DATA.assign(unit="degC")
+        catalog = PangeoCatalog(
+            pd.DataFrame(
+                data={
+                    "model": "test_model",
+                    "experiment": ["ssp245", "ssp245", "historical", "historical"],
+                    "ensemble": ["r2i1p1f1", "r3i1p1f1"] * 2,
+                    "variable": "tas",
+                    "domain": "Amon",
+                    "zstore": ["gs://cmip6/" + str(i) for i in range(4)],
+                }
+            )
+        )
+
+        # The second job matches an equal copy of the target data.
+        jobs = {
+            "a": {"target_data": target, "N_matches": 2, "reproducible": True},
+            "b": {"target_data": target.copy(), "N_matches": 1, "reproducible": True},
+            "c": {"target_data": target, "N_matches": 1, "recipe_method": "assignment"},
+        }
+        cache = MatchCache()
+        out = make_recipes_batch(jobs, archive, match_cache=cache, catalog=catalog)
+        self.assertEqual(list(out), ["a", "b", "c"])
+        self.assertEqual(cache.stats()["misses"], 1)
+        self.assertEqual(cache.stats()["hits"], 0)
+
+        for key, job in jobs.items():
+            job = dict(job)
+            expected = make_recipe(
+                job.pop("target_data"),
+                archive,
+                job.pop("N_matches"),
+                catalog=catalog,
+                **job,
+            )
+            self.assertGreater(len(out[key]), 0)
+            pd.testing.assert_frame_equal(out[key], expected)
+
+    def test_iter_recipes(self):
+        """Test that the recipes are generated lazily and are the ones of make_recipe."""
+        target = pd.concat(
+            [
+                TestRecipe.TARGET_DATA,
+                TestRecipe.TARGET_DATA.assign(
+                    ensemble="r2i1p1f1", fx=TestRecipe.TARGET_DATA["fx"] + 0.1
+                ),
+            ]
+        ).assign(unit="degC")
+        archive = TestRecipe.ARCHIVE_DATA.assign(unit="degC")
+
+        class CountingCatalog(PangeoCatalog):
+            """A catalog counting the files it looks up."""
+
+            n_lookups = 0
+
+            def lookup(self, *args, **kwargs):
+                """Count and look up the files."""
+                self.n_lookups += 1
+                return super().lookup(*args, **kwargs)
+
+        catalog = CountingCatalog(
+            pd.DataFrame(
+                data={
+                    "model": "test_model",
+                    "experiment": ["ssp245", "ssp245", "historical", "historical"],
+                    "ensemble": ["r2i1p1f1", "r3i1p1f1"] * 2,
+                    "variable": "tas",
+                    "domain": "Amon",
+                    "zstore": ["gs://cmip6/" + str(i) for i in range(4)],
+                }
+            )
+        )
+
+        # Nothing is drawn or formatted until the first recipe is taken, and then only
+        # that recipe is formatted.
+        with self.assertLogs("stitches.fx_recipe", "INFO") as logs:
+            recipes = iter_recipes(target, archive, 2, tol=0.2, seed=6, catalog=catalog)
+            self.assertEqual(len(logs.records), 0)
+            self.assertEqual(catalog.n_lookups, 0)
+            first = next(recipes)
+            self.assertGreater(len(logs.records), 0)
+        self.assertEqual(catalog.n_lookups, 1)
+        self.assertEqual(len(first["stitching_id"].unique()), 1)
+
+        # The recipes are generated in target order, make_recipe sorts them.
+        out = (
+            pd.concat([first] + list(recipes))
+            .sort_values(["stitching_id", "target_start_yr"])
+            .reset_index(drop=True)
+        )
+        self.assertEqual(catalog.n_lookups, len(out["stitching_id"].unique()))
+        self.assertEqual(
+            set(out["stitching_id"].str.split("~").str[1]), {"r1i1p1f1", "r2i1p1f1"}
+        )
+        pd.testing.assert_frame_equal(
+            out,
+            make_recipe(target, archive, 2, tol=0.2, seed=6, catalog=catalog),
+        )
+
+    def test_no_recipes(self):
+        """Test that no recipe is drawn when the matches can not support any."""
+        # Both target windows only match the same archive window.
+        target = TestRecipe.TARGET_DATA.head(2).assign(unit="degC")
+        archive = TestRecipe.ARCHIVE_DATA.head(1).assign(unit="degC")
+        matched = match_neighborhood(target, archive, tol=0.1)
+        self.assertEqual(list(max_disjoint_recipes(matched)["maxNumRecipes"]), [0])
+
+        for n_workers in [None, 2]:
+            out = permute_stitching_recipes(
+                0, matched, archive, seed=1, n_workers=n_workers
+            )
+            self.assertEqual(len(out), 0)
+            self.assertEqual(out.columns[-1], "stitching_id")
+
+        with self.assertRaises(TypeError):
+            make_recipe(target, archive, None, tol=0.1)
+
     def test_permute_stitching_recipes(self):
         """Test the permute_stitching_recipes function for correct operation."""
         # With tol < 0.17, the test data can only support one collapse free
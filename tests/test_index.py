@@ -0,0 +1,91 @@
+import os
+import tempfile
+import unittest
+from importlib import resources
+
+import numpy as np
+import pandas as pd
+
+from stitches.fx_index import ArchiveIndex, as_archive_frame, as_archive_index
+from stitches.fx_match import match_neighborhood
+from stitches.fx_recipe import remove_duplicates
+
+
+class TestIndex(unittest.TestCase):
+    """Unit tests for the ArchiveIndex."""
+
+    path = resources.files("stitches") / "data" / "example" / "test-target_dat.csv"
+    TARGET_DATA = pd.read_csv(path)
+    path = resources.files("stitches") / "data" / "example" / "test-archive_dat.csv"
+    ARCHIVE_DATA = pd.read_csv(path)
+
+    def test_archive_index(self):
+        """Test building, saving and loading an ArchiveIndex."""
+        index = ArchiveIndex(self.ARCHIVE_DATA)
+        self.assertEqual(len(index), len(self.ARCHIVE_DATA))
+        self.assertEqual(index.windowsize, 8)
+        self.assertEqual(index.coords.shape, (len(self.ARCHIVE_DATA), 2))
+
+        # The integer codes map back to the archive metadata.
+        for col in ArchiveIndex.META_COLUMNS:
+            self.assertTrue(
+                (
+                    index.categories[col][index.codes[col]]
+                    == self.ARCHIVE_DATA[col].to_numpy()
+                ).all()
+            )
+
+        self.assertIs(as_archive_index(index), index)
+        self.assertIs(as_archive_frame(index), index.data)
+
+        with tempfile.TemporaryDirectory() as tdir:
+            f = os.path.join(tdir, "archive.pkl")
+            index.save(f)
+            loaded = ArchiveIndex.load(f)
+        pd.testing.assert_frame_equal(loaded.data, index.data)
+
+        subset = index.subset(self.ARCHIVE_DATA["experiment"] == "ssp1")
+        self.assertEqual(len(subset), sum(self.ARCHIVE_DATA["experiment"] == "ssp1"))
+
+        with self.assertRaises(TypeError):
+            ArchiveIndex(self.ARCHIVE_DATA.drop(columns="fx"))
+
+    def test_match_with_index(self):
+        """Test that matching against an ArchiveIndex is the same as matching the data frame."""
+        index = ArchiveIndex(self.ARCHIVE_DATA)
+        for method in ["kdtree", "scan"]:
+            pd.testing.assert_frame_equal(
+                match_neighborhood(
+                    self.TARGET_DATA, self.ARCHIVE_DATA, tol=0.1, method=method
+                ),
+                match_neighborhood(self.TARGET_DATA, index, tol=0.1, method=method),
+            )
+
+        md = match_neighborhood(self.TARGET_DATA, index, tol=0)
+        md = md.drop_duplicates("target_year").reset_index(drop=True)
+        pd.testing.assert_frame_equal(
+            remove_duplicates(md, self.ARCHIVE_DATA), remove_duplicates(md, index)
+        )
+
+    def test_query_used(self):
+        """Test that used archive windows are skipped like they were never indexed."""
+        index = ArchiveIndex(self.ARCHIVE_DATA)
+        used = np.zeros(len(index), dtype=bool)
+        used[index.locate(self.ARCHIVE_DATA.iloc[::3])] = True
+        self.assertEqual(used.sum(), len(self.ARCHIVE_DATA.iloc[::3]))
+
+        fx = self.TARGET_DATA["fx"]
+        dx = self.TARGET_DATA["dx"]
+        masked = index.query(fx, dx, used=used)
+        expected = index.subset(~used).query(fx, dx)
+        rows = np.flatnonzero(~used)
+        np.testing.assert_array_equal(masked[0], expected[0])
+        np.testing.assert_array_equal(masked[1], rows[expected[1]])
+        np.testing.assert_array_equal(masked[4], expected[4])
+
+        with self.assertRaises(TypeError):
+            index.query(fx, dx, used=np.ones(len(index), dtype=bool))
+
+
+if __name__ == "__main__":
+    unittest.main()
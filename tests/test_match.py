@@ -1,13 +1,19 @@
 import unittest
 from importlib import resources
 
+import numpy as np
 import pandas as pd
 
+from stitches.fx_index import ArchiveIndex
 from stitches.fx_match import (
+    FAR_NEIGHBOR_THRESHOLD,
     drop_hist_false_duplicates,
+    far_neighbors,
     internal_dist,
     match_neighborhood,
+    match_topk,
     shuffle_function,
+    update_matches,
 )
 from stitches.fx_util import nrow, remove_obs_from_match
 
@@ -69,6 +75,229 @@ class TestMatch(unittest.TestCase):
         ].unique()
         self.assertEqual(len(hist_target_experiments), 1)
 
+    def test_match_methods(self):
+        """
+        Test that the kdtree, batch and scan engines of `match_neighborhood` agree.
+
+        The KD-tree is only used to find the candidates so it must return exactly
+        the same matches as comparing every target window to the entire archive.
+        """
+        path = resources.files("stitches") / "data" / "example" / "test-target_dat.csv"
+        data = pd.read_csv(path)
+        path = resources.files("stitches") / "data" / "example" / "test-archive_dat.csv"
+        archive = pd.read_csv(path)
+
+        for tol in [0, 0.05, 0.3]:
+            for drop_hist in [True, False]:
+                scan = match_neighborhood(
+                    data,
+                    archive,
+                    tol=tol,
+                    drop_hist_duplicates=drop_hist,
+                    method="scan",
+                )
+                kdtree = match_neighborhood(
+                    data,
+                    archive,
+                    tol=tol,
+                    drop_hist_duplicates=drop_hist,
+                    method="kdtree",
+                )
+                pd.testing.assert_frame_equal(scan, kdtree)
+                # Use a tiny memory ceiling to force one target window per tile.
+                batch = match_neighborhood(
+                    data,
+                    archive,
+                    tol=tol,
+                    drop_hist_duplicates=drop_hist,
+                    method="batch",
+                    max_memory=1,
+                )
+                pd.testing.assert_frame_equal(scan, batch)
+
+        with self.assertRaises(TypeError):
+            match_neighborhood(data, archive, method="brute")
+
+    def test_match_shared_target_values(self):
+        """Test that target windows sharing fx and dx values keep their own matches."""
+        path = resources.files("stitches") / "data" / "example" / "test-target_dat.csv"
+        data = pd.read_csv(path)
+        path = resources.files("stitches") / "data" / "example" / "test-archive_dat.csv"
+        archive = pd.read_csv(path)
+
+        # A second target ensemble member with exactly the same fx and dx values.
+        two_targets = pd.concat([data, data.assign(ensemble="test2")])
+        match1 = match_neighborhood(data, archive, tol=0.1)
+        match2 = match_neighborhood(two_targets, archive, tol=0.1)
+        self.assertEqual(nrow(match2), 2 * nrow(match1))
+        for ens in ["test1", "test2"]:
+            self.assertEqual(
+                nrow(match2.loc[match2["target_ensemble"] == ens]), nrow(match1)
+            )
+
+        # Duplicated target windows are only matched once.
+        match3 = match_neighborhood(pd.concat([data, data]), archive, tol=0.1)
+        self.assertEqual(nrow(match3), nrow(match1))
+
+    def test_match_duplicated_archive(self):
+        """Test that duplicated archive windows are only matched once."""
+        path = resources.files("stitches") / "data" / "example" / "test-target_dat.csv"
+        data = pd.read_csv(path)
+        path = resources.files("stitches") / "data" / "example" / "test-archive_dat.csv"
+        archive = pd.read_csv(path)
+
+        expected = match_neighborhood(data, archive, tol=0.1)
+        archive = pd.concat([archive, archive.iloc[[0, 3]]], ignore_index=True)
+        for method in ["kdtree", "batch", "scan"]:
+            pd.testing.assert_frame_equal(
+                match_neighborhood(data, archive, tol=0.1, method=method), expected
+            )
+
+        # An ArchiveIndex flags the duplicated windows once, when it is built.
+        index = ArchiveIndex(archive)
+        self.assertEqual(list(np.flatnonzero(index.duplicated)), [84, 85])
+        for method in ["kdtree", "scan"]:
+            pd.testing.assert_frame_equal(
+                match_neighborhood(data, index, tol=0.1, method=method), expected
+            )
+
+    def test_far_neighbors(self):
+        """Test that far away nearest neighbors are reported and logged."""
+        path = resources.files("stitches") / "data" / "example" / "test-target_dat.csv"
+        data = pd.read_csv(path)
+
+        # Every archive point is 0.5 degC away from its target window.
+        shifted = data.assign(fx=data["fx"] + 0.5)
+        with self.assertLogs("stitches.fx_match", level="WARNING") as logs:
+            matched = match_neighborhood(data, shifted, tol=1.0)
+        self.assertIn(f"more than {FAR_NEIGHBOR_THRESHOLD}degC away", logs.output[0])
+
+        far = far_neighbors(matched)
+        self.assertEqual(nrow(far), nrow(data))
+        self.assertTrue((far["dist_l2"] > 0.25).all())
+        self.assertEqual(list(far.columns), list(matched.columns))
+        self.assertTrue(far_neighbors(matched, threshold=1).empty)
+
+        # Self matches are never far away.
+        self.assertTrue(far_neighbors(match_neighborhood(data, data)).empty)
+
+    def test_match_topk(self):
+        """Test the compact top k matching."""
+        path = resources.files("stitches") / "data" / "example" / "test-target_dat.csv"
+        data = pd.read_csv(path)
+        path = resources.files("stitches") / "data" / "example" / "test-archive_dat.csv"
+        archive = pd.read_csv(path)
+
+        topk = match_topk(data, archive, k=3)
+        self.assertEqual(topk.archive_ids.shape, (nrow(data), 3))
+        self.assertEqual(topk.distances.shape, (nrow(data), 3))
+        self.assertTrue((topk.counts == 3).all())
+        self.assertTrue((np.diff(topk.distances, axis=1) >= 0).all())
+
+        # With k larger than the archive and a tolerance the matches are the same as
+        # the neighborhood returned by match_neighborhood.
+        topk = match_topk(data, archive, k=nrow(archive) + 5, tol=0.1)
+        self.assertTrue((topk.archive_ids[:, -5:] == -1).all())
+        cols = ["target_year", "archive_experiment", "archive_ensemble", "archive_year"]
+        pd.testing.assert_frame_equal(
+            topk.to_frame().sort_values(cols).reset_index(drop=True),
+            match_neighborhood(data, archive, tol=0.1, drop_hist_duplicates=False)
+            .sort_values(cols)
+            .reset_index(drop=True),
+        )
+
+        with self.assertRaises(TypeError):
+            match_topk(data, archive, k=0)
+
+    def test_match_parallel(self):
+        """Test that matching in a process pool is the same as in one process."""
+        path = resources.files("stitches") / "data" / "example" / "test-target_dat.csv"
+        data = pd.read_csv(path)
+        path = resources.files("stitches") / "data" / "example" / "test-archive_dat.csv"
+        archive = pd.read_csv(path)
+        targets = pd.concat([data, data.assign(ensemble="test2", fx=data["fx"] + 0.1)])
+
+        for method in ["kdtree", "batch"]:
+            pd.testing.assert_frame_equal(
+                match_neighborhood(targets, archive, tol=0.2, method=method),
+                match_neighborhood(
+                    targets, archive, tol=0.2, method=method, n_workers=2
+                ),
+            )
+
+        with self.assertRaises(TypeError):
+            match_neighborhood(targets, archive, n_workers=0)
+        with self.assertRaises(TypeError):
+            match_neighborhood(targets, archive, method="scan", n_workers=2)
+
+    def test_match_metric(self):
+        """Test matching with a weighted or scaled distance metric."""
+        path = resources.files("stitches") / "data" / "example" / "test-target_dat.csv"
+        data = pd.read_csv(path)
+        path = resources.files("stitches") / "data" / "example" / "test-archive_dat.csv"
+        archive = pd.read_csv(path)
+
+        # Unit weights are the default Euclidean distance.
+        pd.testing.assert_frame_equal(
+            match_neighborhood(data, archive, tol=0.1),
+            match_neighborhood(data, archive, tol=0.1, metric=(1, 1)),
+        )
+
+        # The engines agree with a metric, and only dist_l2 is weighted.
+        for metric in [(2, 0.5), [[1, 0.5], [0, 2]], {"ssp1": (1, 3)}]:
+            kdtree = match_neighborhood(data, archive, tol=0.1, metric=metric)
+            batch = match_neighborhood(
+                data, archive, tol=0.1, metric=metric, method="batch"
+            )
+            pd.testing.assert_frame_equal(kdtree, batch)
+
+        weighted = match_neighborhood(data, archive, tol=0, metric=(2, 0.5))
+        expected = (
+            (2 * weighted["dist_fx"]) ** 2 + (0.5 * weighted["dist_dx"]) ** 2
+        ) ** 0.5
+        self.assertTrue(np.allclose(weighted["dist_l2"], expected))
+
+        with self.assertRaises(TypeError):
+            match_neighborhood(data, archive, metric=(1, 2, 3))
+        with self.assertRaises(TypeError):
+            match_neighborhood(data, archive, metric=(1, 2), method="scan")
+
+    def test_update_matches(self):
+        """Test that updating matches gives the same rows as matching from scratch."""
+        path = resources.files("stitches") / "data" / "example" / "test-target_dat.csv"
+        data = pd.read_csv(path)
+        path = resources.files("stitches") / "data" / "example" / "test-archive_dat.csv"
+        archive = pd.read_csv(path)
+        matched = match_neighborhood(data, archive, tol=0.1)
+
+        # Change the last window, add a new ensemble member and remove the first window.
+        changed = data.tail(1).assign(fx=data["fx"].iloc[-1] + 0.3)
+        added = pd.concat([changed, data.assign(ensemble="test2", fx=data["fx"] + 0.1)])
+        removed = data.head(1)
+        target = pd.concat([data.iloc[1:-1], added])
+
+        updated, diff = update_matches(
+            matched, archive, added=added, removed=removed, tol=0.1
+        )
+        expected = match_neighborhood(target, archive, tol=0.1)
+        sort_cols = list(expected.columns)
+        pd.testing.assert_frame_equal(
+            updated.sort_values(sort_cols).reset_index(drop=True),
+            expected.sort_values(sort_cols).reset_index(drop=True),
+        )
+        self.assertEqual(set(diff["change"]), {"added", "removed"})
+        self.assertEqual(
+            nrow(updated),
+            nrow(matched)
+            + sum(diff["change"] == "added")
+            - sum(diff["change"] == "removed"),
+        )
+
+        # Without any changes the matches stay the same.
+        updated, diff = update_matches(matched, archive, tol=0.1)
+        self.assertEqual(nrow(updated), nrow(matched))
+        self.assertEqual(nrow(diff), 0)
+
 
 if __name__ == "__main__":
     unittest.main()